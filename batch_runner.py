@@ -0,0 +1,406 @@
+"""
+Generación por lotes sin interfaz para IGIA
+Expande el plan completo de config/prompts_templates.json (categorías × animaciones ×
+biomas × semillas), lo genera de forma desatendida y se reanuda tras un fallo
+
+Uso:
+    python batch_runner.py --output output/nightly --seeds 1,2,3
+    python batch_runner.py --output output/nightly --categorias personajes --biomas forest,cave
+    python batch_runner.py --output output/nightly --server unix:/tmp/igia.sock
+    python batch_runner.py --output output/nightly --dry-run
+
+Volver a lanzar el mismo comando continúa donde se quedó: cada imagen terminada se anota
+en <output>/manifest.jsonl y se identifica por el hash de su prompt y parámetros.
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sys
+import time
+from datetime import datetime
+
+from src.prompt_manager import PromptManager
+
+
+SIN_ANIMACION = "ninguna"
+SIN_BIOMA = "ninguno"
+PLAN_FILE = "plan.json"
+MANIFEST_FILE = "manifest.jsonl"
+STAGING_DIR = ".staging"
+MODEL_CONFIG_PATH = "config/model_config.json"
+
+
+def load_model_config(config_path=MODEL_CONFIG_PATH):
+    """Lee model_config.json; vacío si no existe"""
+    try:
+        with open(config_path, 'r', encoding='utf-8') as f:
+            return json.load(f).get("model_config", {})
+    except (OSError, ValueError):
+        return {}
+
+
+def parse_choices(value, available, extra=()):
+    """
+    Convierte una lista separada por comas en valores válidos
+    
+    Args:
+        value: 'a,b,c', 'all' o None (= todos los disponibles)
+        available: Valores disponibles en la configuración
+        extra: Valores especiales aceptados además (p. ej. SIN_BIOMA)
+    
+    Returns:
+        list: Valores elegidos, en el orden indicado
+    
+    Raises:
+        ValueError: Si algún valor no existe
+    """
+    if value is None or value == "all":
+        return list(available) + list(extra)
+    chosen = [v.strip() for v in value.split(",") if v.strip()]
+    unknown = [v for v in chosen if v not in available and v not in extra]
+    if unknown:
+        raise ValueError(f"No existen: {', '.join(unknown)} (disponibles: {', '.join(list(available) + list(extra))})")
+    return chosen
+
+
+def parse_resolutions(value, presets, steps=None):
+    """
+    Convierte 'WxH,WxH' en (ancho, alto, pasos); los pasos salen de los presets de
+    model_config.json salvo que se indiquen con --steps
+    """
+    resolutions = []
+    for item in value.split(","):
+        width, height = map(int, item.strip().lower().split("x"))
+        preset = presets.get(f"{width}x{height}", {})
+        resolutions.append((width, height, steps or preset.get("steps", 40)))
+    return resolutions
+
+
+def job_id(prompt, params):
+    """Identificador estable de un trabajo: hash de su prompt y parámetros"""
+    key = json.dumps({"prompt": prompt, "params": params}, sort_keys=True)
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+
+
+def expand_plan(prompt_manager, categorias, animaciones, biomas, seeds, resolutions,
+                descripcion="", base_params=None):
+    """
+    Expande el producto categorías × animaciones × biomas × resoluciones × semillas
+    
+    Los prompts idénticos (mismo texto, parámetros y semilla) se generan una sola vez:
+    cada entrada del plan apunta a su trabajo y las repetidas se enlazan al mismo archivo.
+    
+    Returns:
+        tuple: (dict id -> trabajo, lista de entradas del plan)
+    """
+    base_params = base_params or {}
+    jobs = {}
+    entries = []
+    for categoria in categorias:
+        for animacion in animaciones:
+            for bioma in biomas:
+                bioma_key = None if bioma == SIN_BIOMA else bioma
+                if animacion == SIN_ANIMACION:
+                    prompts = [prompt_manager.build_full_prompt(categoria, descripcion, bioma_key)]
+                else:
+                    prompts = prompt_manager.get_animation_prompts(
+                        animacion, categoria, descripcion, bioma_key
+                    )
+                for frame, prompt in enumerate(prompts):
+                    for width, height, steps in resolutions:
+                        for seed in seeds:
+                            params = {
+                                **base_params,
+                                "width": width,
+                                "height": height,
+                                "num_inference_steps": steps,
+                                "seed": seed,
+                            }
+                            file = os.path.join(
+                                categoria, animacion, bioma, f"{width}x{height}",
+                                f"frame{frame + 1:02d}_seed{seed}.png"
+                            )
+                            job = job_id(prompt, params)
+                            jobs.setdefault(job, {"id": job, "prompt": prompt,
+                                                  "params": params, "file": file})
+                            entries.append({
+                                "categoria": categoria, "animacion": animacion,
+                                "bioma": bioma, "frame": frame + 1, "width": width,
+                                "height": height, "seed": seed, "job": job, "file": file
+                            })
+    return jobs, entries
+
+
+def order_jobs(jobs):
+    """
+    Ordena los trabajos para reutilizar todo lo posible entre imágenes consecutivas
+    
+    Primero por resolución, pasos y CFG, para que cada tramo se agrupe en samplings
+    batched y reutilice el embedding posicional ya recortado; dentro de cada uno por
+    prompt, para que sus semillas caigan en la misma ventana de codificación y el
+    condicionamiento se calcule una sola vez.
+    """
+    return sorted(jobs, key=lambda job: (
+        job["params"]["width"],
+        job["params"]["height"],
+        job["params"]["num_inference_steps"],
+        job["params"].get("guidance_scale", 0),
+        job["prompt"],
+        job["params"]["seed"],
+    ))
+
+
+class BatchRunner:
+    """Genera un plan por tramos, guardando cada tramo y anotándolo en el manifest"""
+    
+    def __init__(self, generator, output_dir, batch_size=4, chunk_size=32, encode_window=8,
+                 callback=None):
+        """
+        Args:
+            generator: Cualquier objeto con generate_batch (SD3ImageGenerator,
+                       GenerationClient o WorkerPool)
+            output_dir: Carpeta de salida del plan
+            batch_size: Imágenes por sampling (o peticiones en vuelo con el servidor)
+            chunk_size: Imágenes por tramo; lo máximo que se repite tras un fallo
+            encode_window: Prompts codificados juntos
+            callback: Función para reportar progreso (recibe un mensaje)
+        """
+        self.generator = generator
+        self.output_dir = output_dir
+        self.batch_size = batch_size
+        self.chunk_size = max(1, chunk_size)
+        self.encode_window = encode_window
+        self.callback = callback or print
+        self.manifest_path = os.path.join(output_dir, MANIFEST_FILE)
+    
+    def write_plan(self, jobs, entries):
+        """Guarda el plan completo de forma atómica"""
+        os.makedirs(self.output_dir, exist_ok=True)
+        plan = {
+            "created": datetime.now().isoformat(),
+            "jobs": len(jobs),
+            "entries": entries,
+        }
+        tmp_path = os.path.join(self.output_dir, PLAN_FILE + ".tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(plan, f, indent=1, ensure_ascii=False)
+        os.replace(tmp_path, os.path.join(self.output_dir, PLAN_FILE))
+    
+    def completed(self):
+        """
+        Lee el manifest de una ejecución anterior
+        
+        Returns:
+            dict: id -> ruta relativa de los trabajos terminados cuyo archivo sigue existiendo
+        """
+        done = {}
+        if not os.path.exists(self.manifest_path):
+            return done
+        with open(self.manifest_path, 'r+b') as f:
+            valid = 0
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break  # Última línea a medio escribir si el proceso murió
+                valid += len(line)
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record.get("status") == "done":
+                    done[record["job"]] = record["file"]
+            # Se descarta el resto para que los registros nuevos empiecen en su propia línea
+            f.truncate(valid)
+        return {job: file for job, file in done.items()
+                if os.path.exists(os.path.join(self.output_dir, file))}
+    
+    def _record(self, records):
+        """Añade registros al manifest y los fuerza a disco"""
+        with open(self.manifest_path, 'a', encoding='utf-8') as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+    
+    def run(self, jobs, entries, token=None):
+        """
+        Genera los trabajos pendientes del plan
+        
+        Args:
+            jobs: dict id -> trabajo (de expand_plan)
+            entries: Entradas del plan (de expand_plan)
+            token: CancellationToken opcional para parar entre tramos
+        
+        Returns:
+            dict: Recuento de trabajos 'done', 'skipped' y 'failed'
+        """
+        self.write_plan(jobs, entries)
+        done = self.completed()
+        pending = order_jobs([job for job in jobs.values() if job["id"] not in done])
+        stats = {"done": 0, "skipped": len(jobs) - len(pending), "failed": 0}
+        self.callback(f"Plan: {len(entries)} entradas, {len(jobs)} imágenes únicas, "
+                      f"{stats['skipped']} ya generadas, {len(pending)} pendientes")
+        
+        staging = os.path.join(self.output_dir, STAGING_DIR)
+        start = time.monotonic()
+        for offset in range(0, len(pending), self.chunk_size):
+            if token is not None and token.cancelled.is_set():
+                break
+            chunk = pending[offset:offset + self.chunk_size]
+            shutil.rmtree(staging, ignore_errors=True)
+            
+            self.generator.generate_batch(
+                [{"prompt": job["prompt"], "params": job["params"]} for job in chunk],
+                {}, staging, "job", self._progress(offset, len(pending)),
+                encode_window=self.encode_window, batch_size=self.batch_size, token=token
+            )
+            
+            records = []
+            for idx, job in enumerate(chunk):
+                record = self._collect(staging, idx, job)
+                stats[record["status"]] += 1
+                if record["status"] == "done":
+                    done[job["id"]] = job["file"]
+                records.append(record)
+            self._record(records)
+            
+            finished = offset + len(chunk)
+            elapsed = time.monotonic() - start
+            eta = elapsed / finished * (len(pending) - finished)
+            self.callback(f"Tramo terminado: {finished}/{len(pending)} "
+                          f"({finished / elapsed * 60:.1f} img/min, quedan ~{eta / 60:.0f} min)")
+        
+        shutil.rmtree(staging, ignore_errors=True)
+        self._link_duplicates(entries, done)
+        return stats
+    
+    def _progress(self, offset, total):
+        """Adapta el callback de generate_batch al índice global del plan"""
+        def progress(current, _, message):
+            self.callback(f"[{offset + current}/{total}] {message}")
+        return progress
+    
+    def _collect(self, staging, idx, job):
+        """Mueve la imagen y la metadata de un trabajo del staging a su ruta final"""
+        image_path = os.path.join(staging, f"job_{idx + 1:03d}.png")
+        metadata_path = os.path.join(staging, f"job_{idx + 1:03d}_metadata.json")
+        if not os.path.exists(image_path):
+            return {"job": job["id"], "status": "failed", "file": job["file"]}
+        
+        target = os.path.join(self.output_dir, job["file"])
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if os.path.exists(metadata_path):
+            os.replace(metadata_path, os.path.splitext(target)[0] + "_metadata.json")
+        # La imagen se mueve la última: si existe, el trabajo está completo
+        os.replace(image_path, target)
+        return {"job": job["id"], "status": "done", "file": job["file"],
+                "timestamp": datetime.now().isoformat()}
+    
+    def _link_duplicates(self, entries, done):
+        """Enlaza las entradas repetidas del plan al archivo de su trabajo"""
+        for entry in entries:
+            source = done.get(entry["job"])
+            if source is None or source == entry["file"]:
+                continue
+            target = os.path.join(self.output_dir, entry["file"])
+            if os.path.exists(target):
+                continue
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            try:
+                os.link(os.path.join(self.output_dir, source), target)
+            except OSError:
+                shutil.copy2(os.path.join(self.output_dir, source), target)
+
+
+def create_generator(args, model_config):
+    """Crea el generador según los argumentos: servidor, pool de procesos o local"""
+    model_folder = args.model_folder or model_config.get("model_folder", "ia/sd3.5-main/models")
+    if args.server:
+        from src.generation_client import GenerationClient
+        generator = GenerationClient(args.server)
+        return generator if generator.load_model(callback=print) else None
+    if args.workers:
+        from src.worker_pool import WorkerPool
+        generator = WorkerPool(model_folder, args.workers, args.threads_per_worker,
+                               args.precision)
+        return generator if generator.start(callback=print) else None
+    
+    from src.sd3_generator import SD3ImageGenerator
+    generator = SD3ImageGenerator(model_folder=model_folder, device=args.device,
+                                  precision=args.precision)
+    return generator if generator.load_model(callback=print) else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generación por lotes de IGIA sin interfaz")
+    parser.add_argument("--output", required=True, help="Carpeta de salida (y del manifest)")
+    parser.add_argument("--templates", default="config/prompts_templates.json")
+    parser.add_argument("--categorias", default=None, help="Lista separada por comas (por defecto todas)")
+    parser.add_argument("--animaciones", default=None,
+                        help=f"Lista separada por comas; '{SIN_ANIMACION}' = prompt sin animación")
+    parser.add_argument("--biomas", default=None,
+                        help=f"Lista separada por comas; '{SIN_BIOMA}' = sin bioma")
+    parser.add_argument("--seeds", default=None, help="Semillas separadas por comas")
+    parser.add_argument("--descripcion", default="", help="Descripción añadida a cada prompt")
+    parser.add_argument("--resoluciones", default="1024x1024", help="Lista de WxH separada por comas")
+    parser.add_argument("--steps", type=int, default=None, help="Pasos (por defecto los del preset)")
+    parser.add_argument("--cfg", type=float, default=4.5)
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--chunk", type=int, default=32, help="Imágenes por tramo del manifest")
+    parser.add_argument("--encode-window", type=int, default=8)
+    parser.add_argument("--model-folder", default=None)
+    parser.add_argument("--device", default="auto")
+    parser.add_argument("--precision", default=None)
+    parser.add_argument("--server", default=None, help="Usar el servidor de generación (http://... o unix:...)")
+    parser.add_argument("--workers", type=int, default=None, help="Usar un pool de N procesos")
+    parser.add_argument("--threads-per-worker", type=int, default=None)
+    parser.add_argument("--dry-run", action="store_true", help="Solo mostrar el plan")
+    args = parser.parse_args()
+    
+    prompt_manager = PromptManager(args.templates)
+    model_config = load_model_config()
+    defaults = prompt_manager.get_default_params()
+    try:
+        categorias = parse_choices(args.categorias, prompt_manager.get_categories())
+        animaciones = parse_choices(args.animaciones, prompt_manager.get_animations(), (SIN_ANIMACION,))
+        biomas = parse_choices(args.biomas, prompt_manager.get_biomas(), (SIN_BIOMA,))
+        resolutions = parse_resolutions(args.resoluciones, model_config.get("resolutions", {}), args.steps)
+        if args.seeds:
+            seeds = [int(s) for s in args.seeds.split(",")]
+        else:
+            # Semillas fijas: sin ellas no se puede reanudar ni deduplicar
+            seeds = [max(0, defaults.get("seed", 0))]
+    except ValueError as e:
+        parser.error(str(e))
+    
+    base_params = {
+        "negative_prompt": defaults.get("negative_prompt", ""),
+        "guidance_scale": args.cfg,
+    }
+    jobs, entries = expand_plan(prompt_manager, categorias, animaciones, biomas, seeds,
+                                resolutions, args.descripcion, base_params)
+    print(f"Plan: {len(entries)} entradas -> {len(jobs)} imágenes únicas "
+          f"({len(categorias)} categorías × {len(animaciones)} animaciones × "
+          f"{len(biomas)} biomas × {len(resolutions)} resoluciones × {len(seeds)} semillas)")
+    if args.dry_run:
+        return 0
+    
+    generator = create_generator(args, model_config)
+    if generator is None:
+        print("✗ No se pudo cargar el generador")
+        return 1
+    
+    runner = BatchRunner(generator, args.output, args.batch_size, args.chunk, args.encode_window)
+    try:
+        stats = runner.run(jobs, entries)
+    finally:
+        if hasattr(generator, "close"):
+            generator.close()
+    
+    print(f"✅ Generadas {stats['done']}, ya existentes {stats['skipped']}, fallidas {stats['failed']}")
+    return 1 if stats["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
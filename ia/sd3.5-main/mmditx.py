@@ -1,6 +1,7 @@
 ### This file contains impls for MM-DiT, the core model component of SD3
 
 import math
+import threading
 from typing import Dict, List, Optional
 
 import numpy as np
@@ -69,6 +70,16 @@ def modulate(x, shift, scale):
     return x * (1 + scale.unsqueeze(1)) + shift.unsqueeze(1)
 
 
+def adaLN(module, c):
+    """`module.adaLN_modulation(c)`, looked up instead when `c` is the vector the active ModulationSchedule
+    returned for the current step"""
+    if module.modulation_schedule is not None:
+        out = module.modulation_schedule.modulation(module, c)
+        if out is not None:
+            return out
+    return module.adaLN_modulation(c)
+
+
 #################################################################################
 #                   Sine/Cosine Positional Embedding Functions                  #
 #################################################################################
@@ -216,6 +227,25 @@ def optimized_attention(qkv, num_heads):
     return attention(qkv[0], qkv[1], qkv[2], num_heads)
 
 
+_joint_buffers = threading.local()
+
+
+def joint_qkv_buffer(shape, dtype, device, max_entries=4):
+    """Persistent (B, L, 3, heads, head_dim) buffer the joint blocks project q/k/v into. The blocks run one after
+    another, so they all share one buffer per shape and thread instead of concatenating fresh q/k/v each time.
+    """
+    buffers = getattr(_joint_buffers, "buffers", None)
+    if buffers is None:
+        buffers = _joint_buffers.buffers = {}
+    key = (tuple(shape), dtype, torch.device(device))
+    buffer = buffers.get(key)
+    if buffer is None:
+        if len(buffers) >= max_entries:
+            del buffers[next(iter(buffers))]
+        buffer = buffers[key] = torch.empty(shape, dtype=dtype, device=device)
+    return buffer
+
+
 class SelfAttention(nn.Module):
 
     def __init__(
@@ -275,7 +305,9 @@ class SelfAttention(nn.Module):
         else:
             raise ValueError(qk_norm)
 
-    def pre_attention(self, x: torch.Tensor):
+    def pre_attention(self, x: torch.Tensor, out: Optional[torch.Tensor] = None):
+        if out is not None:
+            return self.pre_attention_into(x, out)
         B, L, C = x.shape
         qkv = self.qkv(x)
         q, k, v = split_qkv(qkv, self.head_dim)
@@ -283,6 +315,22 @@ class SelfAttention(nn.Module):
         k = self.ln_k(k).reshape(q.shape[0], q.shape[1], -1)
         return (q, k, v)
 
+    def pre_attention_into(self, x: torch.Tensor, out: torch.Tensor):
+        """`pre_attention` projecting straight into `out`, a (B, L, 3, heads, head_dim) slice of a joint
+        buffer, q/k/v are returned as views of it"""
+        weight, bias = self.qkv.weight, self.qkv.bias
+        x = x.to(weight.dtype)
+        for b in range(x.shape[0]):
+            rows = out[b].view(x.shape[1], -1)
+            if bias is None:
+                torch.mm(x[b], weight.t(), out=rows)
+            else:
+                torch.addmm(bias, x[b], weight.t(), out=rows)
+        for i, norm in ((0, self.ln_q), (1, self.ln_k)):
+            if not isinstance(norm, nn.Identity):
+                out[:, :, i] = norm(out[:, :, i])
+        return tuple(out[:, :, i].flatten(2) for i in range(3))
+
     def post_attention(self, x: torch.Tensor) -> torch.Tensor:
         assert not self.pre_only
         x = self.proj(x)
@@ -481,29 +529,36 @@ class DismantledBlock(nn.Module):
             ),
         )
         self.pre_only = pre_only
+        self.modulation_schedule = None
 
-    def pre_attention(self, x: torch.Tensor, c: torch.Tensor):
+    def pre_attention(
+        self, x: torch.Tensor, c: torch.Tensor, out: Optional[torch.Tensor] = None
+    ):
         assert x is not None, "pre_attention called with None input"
         if not self.pre_only:
             if not self.scale_mod_only:
-                shift_msa, scale_msa, gate_msa, shift_mlp, scale_mlp, gate_mlp = (
-                    self.adaLN_modulation(c).chunk(6, dim=1)
-                )
+                shift_msa, scale_msa, gate_msa, shift_mlp, scale_mlp, gate_mlp = adaLN(
+                    self, c
+                ).chunk(6, dim=1)
             else:
                 shift_msa = None
                 shift_mlp = None
-                scale_msa, gate_msa, scale_mlp, gate_mlp = self.adaLN_modulation(
-                    c
-                ).chunk(4, dim=1)
-            qkv = self.attn.pre_attention(modulate(self.norm1(x), shift_msa, scale_msa))
+                scale_msa, gate_msa, scale_mlp, gate_mlp = adaLN(self, c).chunk(
+                    4, dim=1
+                )
+            qkv = self.attn.pre_attention(
+                modulate(self.norm1(x), shift_msa, scale_msa), out
+            )
             return qkv, (x, gate_msa, shift_mlp, scale_mlp, gate_mlp)
         else:
             if not self.scale_mod_only:
-                shift_msa, scale_msa = self.adaLN_modulation(c).chunk(2, dim=1)
+                shift_msa, scale_msa = adaLN(self, c).chunk(2, dim=1)
             else:
                 shift_msa = None
-                scale_msa = self.adaLN_modulation(c)
-            qkv = self.attn.pre_attention(modulate(self.norm1(x), shift_msa, scale_msa))
+                scale_msa = adaLN(self, c)
+            qkv = self.attn.pre_attention(
+                modulate(self.norm1(x), shift_msa, scale_msa), out
+            )
             return qkv, None
 
     def post_attention(self, attn, x, gate_msa, shift_mlp, scale_mlp, gate_mlp):
@@ -514,7 +569,9 @@ class DismantledBlock(nn.Module):
         )
         return x
 
-    def pre_attention_x(self, x: torch.Tensor, c: torch.Tensor) -> torch.Tensor:
+    def pre_attention_x(
+        self, x: torch.Tensor, c: torch.Tensor, out: Optional[torch.Tensor] = None
+    ) -> torch.Tensor:
         assert self.x_block_self_attn
         (
             shift_msa,
@@ -526,9 +583,9 @@ class DismantledBlock(nn.Module):
             shift_msa2,
             scale_msa2,
             gate_msa2,
-        ) = self.adaLN_modulation(c).chunk(9, dim=1)
+        ) = adaLN(self, c).chunk(9, dim=1)
         x_norm = self.norm1(x)
-        qkv = self.attn.pre_attention(modulate(x_norm, shift_msa, scale_msa))
+        qkv = self.attn.pre_attention(modulate(x_norm, shift_msa, scale_msa), out)
         qkv2 = self.attn2.pre_attention(modulate(x_norm, shift_msa2, scale_msa2))
         return (
             qkv,
@@ -590,21 +647,37 @@ class DismantledBlock(nn.Module):
 
 def block_mixing(context, x, context_block, x_block, c):
     assert context is not None, "block_mixing called with None context"
-    context_qkv, context_intermediates = context_block.pre_attention(context, c)
+    context_len = context.shape[1]
+    buffer = context_out = x_out = None
+    if not torch.is_grad_enabled():
+        # Both streams project into one joint buffer, q/k/v for the attention are views of it
+        attn = x_block.attn
+        buffer = joint_qkv_buffer(
+            (x.shape[0], context_len + x.shape[1], 3, attn.num_heads, attn.head_dim),
+            attn.qkv.weight.dtype,
+            x.device,
+        )
+        context_out, x_out = buffer[:, :context_len], buffer[:, context_len:]
+    context_qkv, context_intermediates = context_block.pre_attention(
+        context, c, context_out
+    )
 
     if x_block.x_block_self_attn:
-        x_qkv, x_qkv2, x_intermediates = x_block.pre_attention_x(x, c)
+        x_qkv, x_qkv2, x_intermediates = x_block.pre_attention_x(x, c, x_out)
     else:
-        x_qkv, x_intermediates = x_block.pre_attention(x, c)
+        x_qkv, x_intermediates = x_block.pre_attention(x, c, x_out)
 
-    q, k, v = tuple(
-        torch.cat(tuple(qkv[i] for qkv in [context_qkv, x_qkv]), dim=1)
-        for i in range(3)
-    )
+    if buffer is not None:
+        q, k, v = (buffer[:, :, i].flatten(2) for i in range(3))
+    else:
+        q, k, v = tuple(
+            torch.cat(tuple(qkv[i] for qkv in [context_qkv, x_qkv]), dim=1)
+            for i in range(3)
+        )
     attn = attention(q, k, v, x_block.attn.num_heads)
     context_attn, x_attn = (
-        attn[:, : context_qkv[0].shape[1]],
-        attn[:, context_qkv[0].shape[1] :],
+        attn[:, :context_len],
+        attn[:, context_len:],
     )
 
     if not context_block.pre_only:
@@ -684,14 +757,221 @@ class FinalLayer(nn.Module):
                 hidden_size, 2 * hidden_size, bias=True, dtype=dtype, device=device
             ),
         )
+        self.modulation_schedule = None
 
     def forward(self, x: torch.Tensor, c: torch.Tensor) -> torch.Tensor:
-        shift, scale = self.adaLN_modulation(c).chunk(2, dim=1)
+        shift, scale = adaLN(self, c).chunk(2, dim=1)
         x = modulate(self.norm_final(x), shift, scale)
         x = self.linear(x)
         return x
 
 
+class ModulationSchedule:
+    """The conditioning vector c and every adaLN modulation of an MMDiTX for a sigma schedule, computed up
+    front with one batched matmul per block instead of 2 x depth small ones per step.
+    `timesteps` are the model timesteps of the schedule and `ys` the pooled conditionings (one per batch layout
+    the sampler will use, e.g. cond+uncond and cond only), both exactly as `forward` will receive them.
+    The modulations of every step take `bytes_per_step(...)` bytes, only the leading steps that fit in
+    `max_bytes` are precomputed and later ones are evaluated live.
+    """
+
+    def __init__(self, model, timesteps, ys, dtype, max_bytes=None):
+        self.timesteps = timesteps
+        self.groups = []
+        self.hits = 0
+        self.misses = 0
+        self.active = None
+        modules = [m for m in model.modules() if hasattr(m, "adaLN_modulation")]
+        steps = len(timesteps)
+        per_step = self.bytes_per_step(model, ys, dtype)
+        self.steps = steps if max_bytes is None else min(steps, max_bytes // per_step)
+        self.bytes = self.steps * per_step
+        # lookups[module][group][step]
+        self.lookups = {m: [] for m in modules}
+        with torch.no_grad():
+            for y in ys:
+                batch = y.shape[0]
+                c = model.t_embedder(timesteps.repeat_interleave(batch), dtype=dtype)
+                c = c + model.y_embedder(y.to(dtype)).repeat(steps, 1)
+                covered = c[: self.steps * batch]
+                for module in modules:
+                    if self.steps == 0:
+                        # Not even one step fits the budget, every modulation is evaluated live
+                        self.lookups[module].append(())
+                        continue
+                    out = module.adaLN_modulation(covered)
+                    self.lookups[module].append(out.view(self.steps, batch, -1).unbind(0))
+                self.groups.append((y, c.view(steps, batch, -1).unbind(0)))
+
+    @staticmethod
+    def bytes_per_step(model, ys, dtype):
+        """Size of the modulations of one step for every batch layout in `ys`"""
+        width = sum(
+            m.adaLN_modulation[-1].out_features
+            for m in model.modules()
+            if hasattr(m, "adaLN_modulation")
+        )
+        rows = sum(y.shape[0] for y in ys)
+        return max(1, rows * width * torch.empty((), dtype=dtype).element_size())
+
+    def lookup(self, t, y):
+        """The precomputed c for a forward at timesteps `t` with pooled conditioning `y`, None if not part of
+        the schedule. The matched group and step stay active for `modulation` until the next lookup."""
+        self.active = None
+        if y is not None and bool((t == t[0]).all()):
+            step = (self.timesteps == t[0]).nonzero()
+            for group, (group_y, vectors) in enumerate(self.groups):
+                if len(step) and group_y.shape == y.shape and torch.equal(group_y, y):
+                    self.hits += 1
+                    c = vectors[int(step[0])]
+                    self.active = (group, int(step[0]), c)
+                    return c
+        self.misses += 1
+        return None
+
+    def modulation(self, module, c):
+        """Precomputed `module.adaLN_modulation(c)` for the active step, None if `c` is not the vector of that
+        step or the step is past the byte budget"""
+        if self.active is None:
+            return None
+        group, step, active_c = self.active
+        # The active c is referenced here, so identity can't match a different tensor
+        if c is not active_c or step >= self.steps:
+            return None
+        return self.lookups[module][group][step]
+
+    def stats(self):
+        return {
+            "steps": len(self.timesteps),
+            "precomputed_steps": self.steps,
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+class ContextEmbedCache:
+    """Memoizes `context_embedder` per conditioning row for one generation. The context is the same at every
+    step, and the cond/uncond rows of a CFG batch reappear in the cond-only batches of the skip-layer and
+    adaptive denoisers, so rows are matched by value and only unseen ones are embedded.
+    """
+
+    def __init__(self, max_rows=64):
+        self.max_rows = max_rows
+        self.rows = []
+        self.hits = 0
+        self.misses = 0
+
+    def find(self, row):
+        for cached, embedded in self.rows:
+            if cached.shape == row.shape and cached.dtype == row.dtype and torch.equal(cached, row):
+                return embedded
+        return None
+
+    def __call__(self, embedder, context):
+        found = [self.find(row) for row in context]
+        missing = [i for i, embedded in enumerate(found) if embedded is None]
+        if missing:
+            embedded = embedder(context[missing])
+            for i, row in zip(missing, embedded):
+                found[i] = row
+                if len(self.rows) < self.max_rows:
+                    self.rows.append((context[i], row))
+        self.hits += len(found) - len(missing)
+        self.misses += len(missing)
+        return torch.stack(found)
+
+    def stats(self):
+        return {"rows": len(self.rows), "hits": self.hits, "misses": self.misses}
+
+
+class BlockCache:
+    """Cross-step reuse of the middle joint blocks (DeepCache / TeaCache style).
+    The first `head` and last `tail` blocks run on every step. On a refresh the blocks in between run too and
+    their residual (output - input, for both streams) is stored; on other steps that residual is added back
+    instead. Refreshes happen during the first `warmup` steps, at least every `interval` steps, and, with a
+    `threshold`, as soon as the relative change of the head output accumulated since the last refresh exceeds it.
+    """
+
+    def __init__(self, head=1, tail=1, interval=3, threshold=None, warmup=2):
+        assert head >= 0 and tail >= 1
+        self.head = head
+        self.tail = tail
+        self.interval = interval
+        self.threshold = threshold
+        self.warmup = warmup
+        self.reset()
+
+    def reset(self):
+        # Separate state per input shape, so cond+uncond and cond-only batches don't mix
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def should_refresh(self, entry, x):
+        if self.threshold is not None:
+            previous = entry["previous"]
+            if previous is not None:
+                change = (x - previous).abs().mean()
+                change = change / previous.abs().mean().clamp(min=1e-8)
+                entry["accumulated"] += change.item()
+            entry["previous"] = x
+        if entry["residual"] is None or entry["step"] < self.warmup:
+            return True
+        if entry["since_refresh"] + 1 >= self.interval:
+            return True
+        return self.threshold is not None and entry["accumulated"] >= self.threshold
+
+    def run(self, blocks, context, x, c_mod):
+        if self.head + self.tail >= len(blocks):
+            for block in blocks:
+                context, x = block(context, x, c=c_mod)
+            return context, x
+        for block in blocks[: self.head]:
+            context, x = block(context, x, c=c_mod)
+
+        entry = self.entries.setdefault(
+            (tuple(x.shape), tuple(context.shape)),
+            {
+                "residual": None,
+                "previous": None,
+                "step": 0,
+                "since_refresh": 0,
+                "accumulated": 0.0,
+            },
+        )
+        if self.should_refresh(entry, x):
+            context_in, x_in = context, x
+            for block in blocks[self.head : len(blocks) - self.tail]:
+                context, x = block(context, x, c=c_mod)
+            entry["residual"] = (context - context_in, x - x_in)
+            entry["since_refresh"] = 0
+            entry["accumulated"] = 0.0
+            self.misses += 1
+        else:
+            context = context + entry["residual"][0]
+            x = x + entry["residual"][1]
+            entry["since_refresh"] += 1
+            self.hits += 1
+        entry["step"] += 1
+
+        for block in blocks[len(blocks) - self.tail :]:
+            context, x = block(context, x, c=c_mod)
+        return context, x
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "head": self.head,
+            "tail": self.tail,
+            "interval": self.interval,
+            "threshold": self.threshold,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
 class MMDiTX(nn.Module):
     """Diffusion model with a Transformer backbone."""
 
@@ -810,8 +1090,43 @@ class MMDiTX(nn.Module):
         self.final_layer = FinalLayer(
             hidden_size, patch_size, self.out_channels, dtype=dtype, device=device
         )
+        # Set for the duration of a sampling run to reuse middle blocks across steps, see BlockCache
+        self.block_cache = None
+        self.modulation_schedule = None
+        self.context_cache = None
+        self.pos_embed_cache = {}
 
     def cropped_pos_embed(self, hw):
+        """`crop_pos_embed` memoized per latent size. The memo is kept per dtype and device of the pos_embed
+        buffer, so moving the model between the execution and offload devices keeps it; call
+        `clear_pos_embed_cache` whenever the buffer is replaced or modified.
+        """
+        weight = self.pos_embed
+        crops = self.pos_embed_cache.setdefault((weight.dtype, weight.device), {})
+        key = tuple(hw)
+        spatial_pos_embed = crops.get(key)
+        if spatial_pos_embed is None:
+            spatial_pos_embed = self.crop_pos_embed(hw).contiguous()
+            crops[key] = spatial_pos_embed
+        return spatial_pos_embed
+
+    def precompute_pos_embeds(self, sizes, device=None):
+        """Fills the cropped pos_embed memo for the latent sizes (h, w) expected to be sampled, for `device` too
+        when the model will run on a different device than the one it is on now"""
+        for hw in sizes:
+            spatial_pos_embed = self.cropped_pos_embed(hw)
+            if device is not None:
+                # Keyed on the device the tensor ends up on, so "cuda" and "cuda:0" match
+                spatial_pos_embed = spatial_pos_embed.to(device)
+                self.pos_embed_cache.setdefault(
+                    (spatial_pos_embed.dtype, spatial_pos_embed.device), {}
+                )[tuple(hw)] = spatial_pos_embed
+
+    def clear_pos_embed_cache(self):
+        """Drops the cropped pos_embed memo, for after the weights have been replaced"""
+        self.pos_embed_cache = {}
+
+    def crop_pos_embed(self, hw):
         assert self.pos_embed_max_size is not None
         p = self.x_embedder.patch_size[0]
         h, w = hw
@@ -832,6 +1147,12 @@ class MMDiTX(nn.Module):
         spatial_pos_embed = rearrange(spatial_pos_embed, "1 h w c -> 1 (h w) c")
         return spatial_pos_embed
 
+    def set_modulation_schedule(self, schedule: Optional[ModulationSchedule]):
+        self.modulation_schedule = schedule
+        for module in self.modules():
+            if hasattr(module, "adaLN_modulation"):
+                module.modulation_schedule = schedule
+
     def unpatchify(self, x, hw=None):
         """
         x: (N, T, patch_size**2 * C)
@@ -871,6 +1192,14 @@ class MMDiTX(nn.Module):
 
         # context is B, L', D
         # x is B, L, D
+        if (
+            self.block_cache is not None
+            and not skip_layers
+            and controlnet_hidden_states is None
+        ):
+            context, x = self.block_cache.run(self.joint_blocks, context, x, c_mod)
+            return self.final_layer(x, c_mod)
+
         for i, block in enumerate(self.joint_blocks):
             if i in skip_layers:
                 continue
@@ -901,12 +1230,19 @@ class MMDiTX(nn.Module):
         """
         hw = x.shape[-2:]
         x = self.x_embedder(x) + self.cropped_pos_embed(hw)
-        c = self.t_embedder(t, dtype=x.dtype)  # (N, D)
-        if y is not None:
-            y = self.y_embedder(y)  # (N, D)
-            c = c + y  # (N, D)
-
-        context = self.context_embedder(context)
+        c = None
+        if self.modulation_schedule is not None:
+            c = self.modulation_schedule.lookup(t, y)
+        if c is None:
+            c = self.t_embedder(t, dtype=x.dtype)  # (N, D)
+            if y is not None:
+                y = self.y_embedder(y)  # (N, D)
+                c = c + y  # (N, D)
+
+        if self.context_cache is not None:
+            context = self.context_cache(self.context_embedder, context)
+        else:
+            context = self.context_embedder(context)
 
         x = self.forward_core_with_concat(x, c, context, skip_layers, controlnet_hidden_states)
 
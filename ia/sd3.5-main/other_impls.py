@@ -3,6 +3,7 @@
 import logging
 import math
 import os
+import threading
 
 import torch
 from torch import nn
@@ -14,14 +15,115 @@ from einops import rearrange
 #################################################################################################
 
 
+class AttentionBackend:
+    """Runs (B, heads, L, dim_head) attention for every model. 'sdpa' always calls torch's
+    scaled_dot_product_attention, 'chunked' splits the queries so that at most `memory_budget` bytes of
+    attention scores exist at once, and 'auto' chunks only where sdpa may materialize more scores than the
+    budget. Chunking gives the same result, rows are independent. The largest attention working set (inputs,
+    output and materialized scores) computed from the shapes, not measured, is kept in `estimated_peak_bytes`.
+    Statistics are per thread, so a VAE decode overlapped with sampling doesn't mix into the sampling's counts.
+    """
+
+    def __init__(self, backend="auto", memory_budget=512 * 2**20):
+        self.local = threading.local()
+        self.configure(backend, memory_budget)
+
+    def configure(self, backend="auto", memory_budget=None):
+        assert backend in ("auto", "sdpa", "chunked"), f"Unknown backend {backend}"
+        self.backend = backend
+        if memory_budget is not None:
+            self.memory_budget = int(memory_budget)
+
+    def counters(self):
+        """Statistics of the calling thread"""
+        counters = getattr(self.local, "counters", None)
+        if counters is None:
+            counters = self.local.counters = {
+                "calls": 0,
+                "chunked_calls": 0,
+                "estimated_peak_bytes": 0,
+            }
+        return counters
+
+    def reset_stats(self):
+        self.local.counters = None
+
+    def stats(self):
+        return {
+            "backend": self.backend,
+            "memory_budget": self.memory_budget,
+            **self.counters(),
+        }
+
+    @staticmethod
+    def materializes_scores(q, k, v, mask):
+        """Whether sdpa may build the full score matrix. Only the CUDA kernel choice is trusted: on CPU
+        `_fused_sdp_choice` reports flash for these inputs, and masked calls mostly fall back to the math
+        kernel, so both count as materializing and get chunked above the budget."""
+        if mask is not None or q.device.type != "cuda":
+            return True
+        try:
+            return torch._fused_sdp_choice(q, k, v, mask, 0.0, False) == 0
+        except (AttributeError, RuntimeError):
+            return True
+
+    def __call__(self, q, k, v, mask=None):
+        b, heads, length, _ = q.shape
+        # Scores and their softmax, kept in fp32 by the math kernel
+        row_bytes = 2 * b * heads * k.shape[-2] * 4
+        math_kernel = self.materializes_scores(q, k, v, mask)
+        chunk = length
+        if self.backend == "chunked" or (
+            self.backend == "auto"
+            and math_kernel
+            and row_bytes * length > self.memory_budget
+        ):
+            chunk = max(1, min(length, self.memory_budget // row_bytes))
+        # q, k, v and an output the size of q, plus the scores of one chunk for the math kernel
+        working_set = sum(t.numel() * t.element_size() for t in (q, k, v, q))
+        if math_kernel:
+            working_set += row_bytes * chunk
+        counters = self.counters()
+        counters["calls"] += 1
+        counters["chunked_calls"] += chunk < length
+        counters["estimated_peak_bytes"] = max(
+            counters["estimated_peak_bytes"], working_set
+        )
+        if chunk >= length:
+            return torch.nn.functional.scaled_dot_product_attention(
+                q, k, v, attn_mask=mask, dropout_p=0.0, is_causal=False
+            )
+        out = q.new_empty(q.shape[:-1] + v.shape[-1:])
+        for start in range(0, length, chunk):
+            rows = slice(start, start + chunk)
+            chunk_mask = mask
+            if mask is not None and mask.shape[-2] > 1:
+                chunk_mask = mask[..., rows, :]
+            out[..., rows, :] = torch.nn.functional.scaled_dot_product_attention(
+                q[..., rows, :],
+                k,
+                v,
+                attn_mask=chunk_mask,
+                dropout_p=0.0,
+                is_causal=False,
+            )
+        return out
+
+
+ATTENTION = AttentionBackend()
+
+
+def set_attention_backend(backend="auto", memory_budget=None):
+    """Selects the attention backend used by the MMDiT, the text encoders and the VAE, see AttentionBackend"""
+    ATTENTION.configure(backend, memory_budget)
+
+
 def attention(q, k, v, heads, mask=None):
     """Convenience wrapper around a basic attention operation"""
     b, _, dim_head = q.shape
     dim_head //= heads
     q, k, v = map(lambda t: t.view(b, -1, heads, dim_head).transpose(1, 2), (q, k, v))
-    out = torch.nn.functional.scaled_dot_product_attention(
-        q, k, v, attn_mask=mask, dropout_p=0.0, is_causal=False
-    )
+    out = ATTENTION(q, k, v, mask)
     return out.transpose(1, 2).reshape(b, -1, heads * dim_head)
 
 class Mlp(nn.Module):
@@ -314,6 +416,7 @@ class SDTokenizer:
         pad_to_max_length=True,
         min_length=None,
         extra_padding_token=None,
+        word_cache_size=16384,
     ):
         self.tokenizer = tokenizer
         self.max_length = max_length
@@ -335,6 +438,27 @@ class SDTokenizer:
         vocab = self.tokenizer.get_vocab()
         self.inv_vocab = {v: k for k, v in vocab.items()}
         self.max_word_length = 8
+        # word -> token ids (without start/end), bounded, oldest entries evicted first
+        self.word_cache = {}
+        self.word_cache_size = word_cache_size
+        self.word_cache_lock = threading.Lock()
+
+    def tokenize_words(self, words):
+        """Token ids of each word exactly as `self.tokenizer(word)` gives them, minus start/end tokens.
+        Words missing from the cache are tokenized together in a single tokenizer call.
+        """
+        with self.word_cache_lock:
+            known = {w: self.word_cache[w] for w in words if w in self.word_cache}
+        missing = [w for w in dict.fromkeys(words) if w not in known]
+        if missing:
+            for word, ids in zip(missing, self.tokenizer(missing)["input_ids"]):
+                known[word] = ids[self.tokens_start : -1]
+            with self.word_cache_lock:
+                for word in missing:
+                    self.word_cache[word] = known[word]
+                while len(self.word_cache) > self.word_cache_size:
+                    del self.word_cache[next(iter(self.word_cache))]
+        return [known[w] for w in words]
 
     def tokenize_with_weights(self, text: str, return_word_ids=False):
         """
@@ -349,23 +473,17 @@ class SDTokenizer:
         text = escape_important(text)
         parsed_weights = token_weights(text, 1.0)
 
-        # tokenize words
-        tokens = []
+        # tokenize words, all segments at once
+        words = []
         for weighted_segment, weight in parsed_weights:
             to_tokenize = (
                 unescape_important(weighted_segment).replace("\n", " ").split(" ")
             )
-            to_tokenize = [x for x in to_tokenize if x != ""]
-            for word in to_tokenize:
-                # parse word
-                tokens.append(
-                    [
-                        (t, weight)
-                        for t in self.tokenizer(word)["input_ids"][
-                            self.tokens_start : -1
-                        ]
-                    ]
-                )
+            words += [(x, weight) for x in to_tokenize if x != ""]
+        word_ids = self.tokenize_words([word for word, _ in words])
+        tokens = [
+            [(t, weight) for t in ids] for ids, (_, weight) in zip(word_ids, words)
+        ]
 
         # reshape token array to CLIP input size
         batched_tokens = []
@@ -433,6 +551,9 @@ class SD3Tokenizer:
         clip_tokenizer = CLIPTokenizer.from_pretrained("openai/clip-vit-large-patch14")
         self.clip_l = SDTokenizer(tokenizer=clip_tokenizer)
         self.clip_g = SDXLClipGTokenizer(clip_tokenizer)
+        # Same HF tokenizer and start token handling, so L and G can share their word cache
+        self.clip_g.word_cache = self.clip_l.word_cache
+        self.clip_g.word_cache_lock = self.clip_l.word_cache_lock
         self.t5xxl = T5XXLTokenizer()
 
     def tokenize_with_weights(self, text: str):
@@ -442,6 +563,9 @@ class SD3Tokenizer:
         out["t5xxl"] = self.t5xxl.tokenize_with_weights(text[:226])
         return out
 
+    def tokenize_with_weights_batch(self, texts):
+        return [self.tokenize_with_weights(text) for text in texts]
+
 
 class ClipTokenWeightEncoder:
     def encode_token_weights(self, token_weight_pairs):
@@ -454,6 +578,28 @@ class ClipTokenWeightEncoder:
         output = [out[0:1]]
         return torch.cat(output, dim=-2).cpu(), first_pooled
 
+    def encode_token_weights_batch(self, token_weight_pairs_list, max_batch=16):
+        """Batched `encode_token_weights`: prompts whose first chunks have the same length share one forward
+        (all of them for CLIP, which pads to 77; T5 is bucketed by length since it runs without an attention mask)
+        """
+        buckets = {}
+        for i, token_weight_pairs in enumerate(token_weight_pairs_list):
+            tokens = [t for t, _ in token_weight_pairs[0]]
+            buckets.setdefault(len(tokens), []).append((i, tokens))
+        results = [None] * len(token_weight_pairs_list)
+        for bucket in buckets.values():
+            for start in range(0, len(bucket), max_batch):
+                group = bucket[start : start + max_batch]
+                out, pooled = self([tokens for _, tokens in group])
+                out = out.cpu()
+                pooled = pooled.cpu() if pooled is not None else None
+                for j, (i, _) in enumerate(group):
+                    results[i] = (
+                        out[j : j + 1],
+                        pooled[j : j + 1] if pooled is not None else None,
+                    )
+        return results
+
 
 class SDClipModel(torch.nn.Module, ClipTokenWeightEncoder):
     """Uses the CLIP transformer encoder for text (from huggingface)"""
@@ -649,6 +795,9 @@ class T5Attention(torch.nn.Module):
             self.relative_attention_bias = torch.nn.Embedding(
                 self.relative_attention_num_buckets, self.num_heads, device=device
             )
+            # (query_length, key_length, device) -> bias, see cached_bias
+            self.bias_cache = {}
+            self.bias_cache_key = None
 
     @staticmethod
     def _relative_position_bucket(
@@ -727,12 +876,33 @@ class T5Attention(torch.nn.Module):
         )  # shape (1, num_heads, query_length, key_length)
         return values
 
+    def cached_bias(self, query_length, key_length, device, max_entries=8):
+        """`compute_bias`, memoized per (query_length, key_length, device). The bias only depends on the
+        embedding weight, so the memo is dropped whenever that weight is replaced or modified in place.
+        """
+        weight = self.relative_attention_bias.weight
+        if weight.requires_grad and torch.is_grad_enabled():
+            return self.compute_bias(query_length, key_length, device)
+        weight_key = (weight.data_ptr(), weight._version, weight.dtype, weight.device)
+        if weight_key != self.bias_cache_key:
+            self.bias_cache = {}
+            self.bias_cache_key = weight_key
+        key = (query_length, key_length, torch.device(device))
+        bias = self.bias_cache.get(key)
+        if bias is None:
+            bias = self.compute_bias(query_length, key_length, device)
+            if len(self.bias_cache) >= max_entries:
+                del self.bias_cache[next(iter(self.bias_cache))]
+            self.bias_cache[key] = bias
+        return bias
+
     def forward(self, x, past_bias=None):
         q = self.q(x)
         k = self.k(x)
         v = self.v(x)
         if self.relative_attention_bias is not None:
-            past_bias = self.compute_bias(x.shape[1], x.shape[1], x.device)
+            # (1, heads, L, L), broadcast over the batch and shared with every later layer
+            past_bias = self.cached_bias(x.shape[1], x.shape[1], x.device)
         if past_bias is not None:
             mask = past_bias
         out = attention(
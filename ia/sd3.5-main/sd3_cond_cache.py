@@ -0,0 +1,98 @@
+### Prompt conditioning cache: a byte-bounded in-memory LRU backed by an optional on-disk store
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+from safetensors.torch import save_file
+from sd3_weights import SafetensorsFile
+
+
+def encoder_fingerprint(*paths):
+    """Identifies a set of text encoder weights by file name, size and mtime, cheap enough to compute per load"""
+    parts = []
+    for path in paths:
+        stat = os.stat(path)
+        parts.append(f"{os.path.basename(path)}:{stat.st_size}:{stat.st_mtime_ns}")
+    return hashlib.sha256("|".join(parts).encode()).hexdigest()[:16]
+
+
+class ConditioningCache:
+    """Maps a prompt to its (context, pooled) conditioning for one set of encoder weights.
+    Entries are evicted least-recently-used once `max_bytes` is exceeded; with `cache_dir` set, every entry is
+    also written to disk and memory-mapped back in on a later miss, so the cache survives restarts.
+    """
+
+    def __init__(self, fingerprint="", max_bytes=256 * 2**20, cache_dir=None):
+        self.fingerprint = fingerprint
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, prompt):
+        return hashlib.sha256(f"{self.fingerprint}\0{prompt}".encode()).hexdigest()
+
+    def disk_path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.safetensors")
+
+    def get(self, prompt):
+        key = self.key(prompt)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+        if self.cache_dir is not None and os.path.exists(self.disk_path(key)):
+            with SafetensorsFile(self.disk_path(key)) as f:
+                cond = (f.get_tensor("context"), f.get_tensor("pooled"))
+            with self.lock:
+                self.disk_hits += 1
+                self.remember(key, cond)
+            return cond
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, prompt, cond):
+        key = self.key(prompt)
+        cond = tuple(t.detach().cpu().contiguous() for t in cond)
+        with self.lock:
+            self.remember(key, cond)
+        if self.cache_dir is not None and not os.path.exists(self.disk_path(key)):
+            tmp_path = f"{self.disk_path(key)}.{threading.get_ident()}.tmp"
+            save_file(
+                {"context": cond[0], "pooled": cond[1]},
+                tmp_path,
+                metadata={"fingerprint": self.fingerprint},
+            )
+            os.replace(tmp_path, self.disk_path(key))
+        return cond
+
+    def remember(self, key, cond):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return
+        self.entries[key] = cond
+        self.bytes += sum(t.numel() * t.element_size() for t in cond)
+        while self.bytes > self.max_bytes and len(self.entries) > 1:
+            _, evicted = self.entries.popitem(last=False)
+            self.bytes -= sum(t.numel() * t.element_size() for t in evicted)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def __repr__(self):
+        return (
+            f"ConditioningCache({len(self.entries)} entries, {self.bytes / 2**20:.1f} MiB, "
+            f"hits={self.hits}, disk_hits={self.disk_hits}, misses={self.misses})"
+        )
@@ -1,7 +1,13 @@
 ### Impls of the SD3 core diffusion model and VAE
 
+import copy
+import functools
 import math
+import os
 import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import einops
 from safetensors import safe_open
@@ -13,8 +19,109 @@ import torch.nn as nn
 
 from dit_embedder import ControlNetEmbedder
 from mmditx import MMDiTX
+from other_impls import ATTENTION
 from typing import Tuple
 
+#################################################################################################
+### Execution device / precision policy
+#################################################################################################
+
+
+PRECISIONS = {
+    "fp16": torch.float16,
+    "bf16": torch.bfloat16,
+    "fp32": torch.float32,
+}
+
+
+def cpu_supports_bf16():
+    """True when the host CPU has native bf16 matmul support (AVX512-BF16 / AMX)"""
+    for probe in ("_is_amx_tile_supported", "_is_avx512_bf16_supported"):
+        check = getattr(torch.cpu, probe, None)
+        if check is not None and check():
+            return True
+    return False
+
+
+def autocast_for(device, dtype):
+    """Autocast context for the given device/dtype, a no-op for full precision"""
+    device = torch.device(device)
+    return torch.autocast(
+        device.type,
+        dtype=dtype,
+        enabled=dtype in (torch.float16, torch.bfloat16),
+    )
+
+
+class ExecutionPolicy:
+    """Single device/precision policy honored by the MMDiT, VAE and samplers.
+    CUDA runs fp16 as before, CPU runs bf16 where the hardware supports it (fp32 otherwise)
+    and keeps the conv-heavy VAE in channels-last."""
+
+    def __init__(self, device="auto", dtype=None, vae_dtype=None, channels_last=None):
+        if device == "auto":
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.device = torch.device(device)
+        if isinstance(dtype, str):
+            dtype = PRECISIONS[dtype]
+        if isinstance(vae_dtype, str):
+            vae_dtype = PRECISIONS[vae_dtype]
+        if dtype is None:
+            if self.device.type == "cuda":
+                dtype = torch.float16
+            else:
+                dtype = torch.bfloat16 if cpu_supports_bf16() else torch.float32
+        self.dtype = dtype
+        self.vae_dtype = vae_dtype or dtype
+        if channels_last is None:
+            channels_last = self.device.type == "cpu"
+        self.channels_last = channels_last
+        # Where idle models are parked between uses, only meaningful for accelerators
+        self.offload_device = torch.device("cpu")
+
+    def memory_format(self):
+        return torch.channels_last if self.channels_last else torch.contiguous_format
+
+    def prepare_image(self, tensor):
+        """Moves a NCHW tensor to the execution device in the preferred memory format"""
+        return tensor.to(device=self.device).contiguous(
+            memory_format=self.memory_format()
+        )
+
+    def activate(self, module, channels_last=False):
+        """Moves a model to the execution device, optionally switching conv weights to channels-last"""
+        module = module.to(self.device)
+        if channels_last and self.channels_last:
+            module = module.to(memory_format=torch.channels_last)
+        return module
+
+    def offload(self, module):
+        """Parks a model off the accelerator between uses (no-op when running on CPU)"""
+        if self.device == self.offload_device:
+            return module
+        return module.to(self.offload_device)
+
+    def reset_peak_memory(self):
+        """Starts a new peak_memory window, returns False where the peak can't be reset (the RSS peak is per process)"""
+        if self.device.type != "cuda":
+            return False
+        torch.cuda.reset_peak_memory_stats(self.device)
+        return True
+
+    def peak_memory(self):
+        """Peak memory in bytes: allocated memory on CUDA since the last reset_peak_memory, the process-lifetime peak RSS elsewhere"""
+        if self.device.type == "cuda":
+            return torch.cuda.max_memory_allocated(self.device)
+        try:
+            import resource
+        except ImportError:
+            return None
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def __repr__(self):
+        return f"ExecutionPolicy(device={self.device}, dtype={self.dtype}, vae_dtype={self.vae_dtype}, channels_last={self.channels_last})"
+
+
 #################################################################################################
 ### MMDiT Model Wrapping
 #################################################################################################
@@ -55,6 +162,73 @@ class ModelSamplingDiscreteFlow(torch.nn.Module):
         return sigma * noise + (1.0 - sigma) * latent_image
 
 
+# Probed descriptors, keyed by (file fingerprint, prefix)
+_MMDIT_CONFIGS = {}
+
+
+def file_fingerprint(file):
+    """(path, size, mtime) of an open checkpoint, or None if it does not expose its path"""
+    path = getattr(file, "path", None)
+    if path is None:
+        return None
+    stat = os.stat(path)
+    return (os.path.realpath(path), stat.st_size, stat.st_mtime_ns)
+
+
+def mmdit_config(file, prefix=""):
+    """Architecture descriptor of an MM-DiT checkpoint, the kwargs BaseModel needs to build a matching MMDiTX"""
+    fingerprint = file_fingerprint(file)
+    if fingerprint is not None and (fingerprint, prefix) in _MMDIT_CONFIGS:
+        return copy.deepcopy(_MMDIT_CONFIGS[(fingerprint, prefix)])
+    # Important configuration values can be quickly determined by checking shapes in the source file
+    # Some of these will vary between models (eg 2B vs 8B primarily differ in their depth, but also other details change)
+    # Shapes come from the header via get_slice, no tensor data is read
+    def shape(key):
+        return file.get_slice(f"{prefix}{key}").get_shape()
+
+    x_embedder_shape = shape("x_embedder.proj.weight")
+    patch_size = x_embedder_shape[2]
+    depth = x_embedder_shape[0] // 64
+    num_patches = shape("pos_embed")[1]
+    pos_embed_max_size = round(math.sqrt(num_patches))
+    adm_in_channels = shape("y_embedder.mlp.0.weight")[1]
+    context_shape = shape("context_embedder.weight")
+
+    keys = list(file.keys())
+    qk_norm = (
+        "rms"
+        if f"{prefix}joint_blocks.0.context_block.attn.ln_k.weight" in keys
+        else None
+    )
+    x_block_self_attn_layers = sorted(
+        [
+            int(key.split(".x_block.attn2.ln_k.weight")[0].split(".")[-1])
+            for key in list(
+                filter(re.compile(".*.x_block.attn2.ln_k.weight").match, keys)
+            )
+        ]
+    )
+    config = {
+        "patch_size": patch_size,
+        "depth": depth,
+        "num_patches": num_patches,
+        "pos_embed_max_size": pos_embed_max_size,
+        "adm_in_channels": adm_in_channels,
+        "context_embedder_config": {
+            "target": "torch.nn.Linear",
+            "params": {
+                "in_features": context_shape[1],
+                "out_features": context_shape[0],
+            },
+        },
+        "qk_norm": qk_norm,
+        "x_block_self_attn_layers": x_block_self_attn_layers,
+    }
+    if fingerprint is not None:
+        _MMDIT_CONFIGS[(fingerprint, prefix)] = copy.deepcopy(config)
+    return config
+
+
 class BaseModel(torch.nn.Module):
     """Wrapper around the core MM-DiT model"""
 
@@ -67,53 +241,19 @@ class BaseModel(torch.nn.Module):
         prefix="",
         control_model_ckpt=None,
         verbose=False,
+        config=None,
     ):
         super().__init__()
-        # Important configuration values can be quickly determined by checking shapes in the source file
-        # Some of these will vary between models (eg 2B vs 8B primarily differ in their depth, but also other details change)
-        patch_size = file.get_tensor(f"{prefix}x_embedder.proj.weight").shape[2]
-        depth = file.get_tensor(f"{prefix}x_embedder.proj.weight").shape[0] // 64
-        num_patches = file.get_tensor(f"{prefix}pos_embed").shape[1]
-        pos_embed_max_size = round(math.sqrt(num_patches))
-        adm_in_channels = file.get_tensor(f"{prefix}y_embedder.mlp.0.weight").shape[1]
-        context_shape = file.get_tensor(f"{prefix}context_embedder.weight").shape
-
-        qk_norm = (
-            "rms"
-            if f"{prefix}joint_blocks.0.context_block.attn.ln_k.weight" in file.keys()
-            else None
-        )
-        x_block_self_attn_layers = sorted(
-            [
-                int(key.split(".x_block.attn2.ln_k.weight")[0].split(".")[-1])
-                for key in list(
-                    filter(
-                        re.compile(".*.x_block.attn2.ln_k.weight").match, file.keys()
-                    )
-                )
-            ]
-        )
-
-        context_embedder_config = {
-            "target": "torch.nn.Linear",
-            "params": {
-                "in_features": context_shape[1],
-                "out_features": context_shape[0],
-            },
-        }
+        # `config` is a cached descriptor (see mmdit_config), otherwise it is probed from the file
+        config = config or mmdit_config(file, prefix)
+        depth = config["depth"]
+        patch_size = config["patch_size"]
         self.diffusion_model = MMDiTX(
             input_size=None,
             pos_embed_scaling_factor=None,
             pos_embed_offset=None,
-            pos_embed_max_size=pos_embed_max_size,
-            patch_size=patch_size,
             in_channels=16,
-            depth=depth,
-            num_patches=num_patches,
-            adm_in_channels=adm_in_channels,
-            context_embedder_config=context_embedder_config,
-            qk_norm=qk_norm,
-            x_block_self_attn_layers=x_block_self_attn_layers,
+            **config,
             device=device,
             dtype=dtype,
             verbose=verbose,
@@ -133,7 +273,11 @@ class BaseModel(torch.nn.Module):
             hidden_size = 64 * depth
             num_heads = depth
             head_dim = hidden_size // num_heads
-            pooled_projection_size = control_model_ckpt.get_tensor('time_text_embed.text_embedder.linear_1.weight').shape[1]
+            y_key = "time_text_embed.text_embedder.linear_1.weight"
+            if y_key not in control_model_ckpt.keys():
+                # prepared ControlNet files already carry the remapped key names
+                y_key = "y_embedder.mlp.0.weight"
+            pooled_projection_size = control_model_ckpt.get_slice(y_key).get_shape()[1]
             if verbose:
                 print(
                     f"Initializing ControlNetEmbedder with {n_controlnet_layers} layers, y_in of {pooled_projection_size}"
@@ -268,6 +412,122 @@ class SkipLayerCFGDenoiser(torch.nn.Module):
         return scaled
 
 
+# Defaults per mode, `start` is the fraction of steps always run with full CFG
+ADAPTIVE_CFG_DEFAULTS = {
+    "truncate": {"start": 0.5},
+    "alternate": {"start": 0.2},
+    "converge": {"start": 0.2, "threshold": 0.05},
+}
+
+
+class AdaptiveCFGDenoiser(torch.nn.Module):
+    """CFG that runs the uncond branch only where it matters. After the first `start` fraction of steps:
+    - truncate: drops the uncond branch, the model output is the cond prediction alone
+    - alternate: runs uncond every other step, reusing the last uncond prediction in between
+    - converge: keeps running uncond until the guidance delta |cond - uncond| / |cond| falls below
+      `threshold`, then drops it like truncate, guidance being negligible from there on
+    A `skip_layer_config` with scale > 0 adds skip-layer guidance on top, as in SkipLayerCFGDenoiser; it only
+    needs the cond prediction, so it applies whether or not uncond ran."""
+
+    def __init__(self, model, steps, config, skip_layer_config=None):
+        super().__init__()
+        if isinstance(config, str):
+            config = {"mode": config}
+        self.model = model
+        self.steps = steps
+        self.mode = config["mode"]
+        options = {**ADAPTIVE_CFG_DEFAULTS[self.mode], **config}
+        self.start = options["start"]
+        self.threshold = options.get("threshold")
+        self.step = 0
+        self.stale_uncond = None
+        self.converged = False
+        self.trace = []
+        self.skip_layer_config = None
+        if skip_layer_config and skip_layer_config.get("scale", 0) > 0:
+            self.skip_layer_config = skip_layer_config
+        self.skip_layer_passes = 0
+
+    def run_skip_layer(self):
+        config = self.skip_layer_config
+        return (
+            config is not None
+            and self.step > config["start"] * self.steps
+            and self.step < config["end"] * self.steps
+        )
+
+    def run_uncond(self):
+        if self.step < self.start * self.steps or self.stale_uncond is None:
+            return True
+        if self.mode == "truncate":
+            return False
+        if self.mode == "alternate":
+            return self.step % 2 == 0
+        return not self.converged
+
+    def forward(
+        self,
+        x,
+        timestep,
+        cond,
+        uncond,
+        cond_scale,
+        **kwargs,
+    ):
+        if self.run_uncond():
+            # Run cond and uncond in a batch together
+            batched = self.model.apply_model(
+                torch.cat([x, x]),
+                torch.cat([timestep, timestep]),
+                c_crossattn=torch.cat([cond["c_crossattn"], uncond["c_crossattn"]]),
+                y=torch.cat([cond["y"], uncond["y"]]),
+                **kwargs,
+            )
+            pos_out, neg_out = batched.chunk(2)
+            self.stale_uncond = neg_out
+            if self.mode == "converge" and self.step >= self.start * self.steps:
+                delta = (pos_out - neg_out).norm() / pos_out.norm().clamp(min=1e-8)
+                self.converged = delta.item() < self.threshold
+            self.trace.append("full")
+        else:
+            pos_out = self.model.apply_model(
+                x, timestep, c_crossattn=cond["c_crossattn"], y=cond["y"], **kwargs
+            )
+            self.trace.append("cond")
+        if self.mode != "alternate" and self.trace[-1] == "cond":
+            scaled = pos_out
+        else:
+            neg_out = self.stale_uncond
+            scaled = neg_out + (pos_out - neg_out) * cond_scale
+        if self.run_skip_layer():
+            skip_layer_out = self.model.apply_model(
+                x,
+                timestep,
+                c_crossattn=cond["c_crossattn"],
+                y=cond["y"],
+                skip_layers=self.skip_layer_config["layers"],
+            )
+            scale = self.skip_layer_config["scale"]
+            scaled = scaled + (pos_out - skip_layer_out) * scale
+            self.skip_layer_passes += 1
+        self.step += 1
+        return scaled
+
+    def stats(self):
+        """Guidance schedule that was actually run and the share of model evaluations it saved"""
+        skipped = self.trace.count("cond")
+        return {
+            "mode": self.mode,
+            "start": self.start,
+            "threshold": self.threshold,
+            "steps": len(self.trace),
+            "uncond_skipped": skipped,
+            "skip_layer_passes": self.skip_layer_passes,
+            "compute_saving": skipped / (2 * len(self.trace)) if self.trace else 0.0,
+            "schedule": "".join("F" if t == "full" else "c" for t in self.trace),
+        }
+
+
 class SD3LatentFormat:
     """Latents are slightly shifted from center - this class must be called after VAE Decode to correct for the shift"""
 
@@ -281,38 +541,50 @@ class SD3LatentFormat:
     def process_out(self, latent):
         return (latent / self.scale_factor) + self.shift_factor
 
-    def decode_latent_to_preview(self, x0):
-        """Quick RGB approximate preview of sd3 latents"""
-        factors = torch.tensor(
-            [
-                [-0.0645, 0.0177, 0.1052],
-                [0.0028, 0.0312, 0.0650],
-                [0.1848, 0.0762, 0.0360],
-                [0.0944, 0.0360, 0.0889],
-                [0.0897, 0.0506, -0.0364],
-                [-0.0020, 0.1203, 0.0284],
-                [0.0855, 0.0118, 0.0283],
-                [-0.0539, 0.0658, 0.1047],
-                [-0.0057, 0.0116, 0.0700],
-                [-0.0412, 0.0281, -0.0039],
-                [0.1106, 0.1171, 0.1220],
-                [-0.0248, 0.0682, -0.0481],
-                [0.0815, 0.0846, 0.1207],
-                [-0.0120, -0.0055, -0.0867],
-                [-0.0749, -0.0634, -0.0456],
-                [-0.1418, -0.1457, -0.1259],
-            ],
-            device="cpu",
+    # Projection of the 16 latent channels onto RGB, for previews
+    PREVIEW_FACTORS = [
+        [-0.0645, 0.0177, 0.1052],
+        [0.0028, 0.0312, 0.0650],
+        [0.1848, 0.0762, 0.0360],
+        [0.0944, 0.0360, 0.0889],
+        [0.0897, 0.0506, -0.0364],
+        [-0.0020, 0.1203, 0.0284],
+        [0.0855, 0.0118, 0.0283],
+        [-0.0539, 0.0658, 0.1047],
+        [-0.0057, 0.0116, 0.0700],
+        [-0.0412, 0.0281, -0.0039],
+        [0.1106, 0.1171, 0.1220],
+        [-0.0248, 0.0682, -0.0481],
+        [0.0815, 0.0846, 0.1207],
+        [-0.0120, -0.0055, -0.0867],
+        [-0.0749, -0.0634, -0.0456],
+        [-0.1418, -0.1457, -0.1259],
+    ]
+    _preview_factors = {}
+
+    def preview_factors(self, device):
+        device = torch.device(device)
+        factors = self._preview_factors.get(device)
+        if factors is None:
+            factors = torch.tensor(self.PREVIEW_FACTORS, device=device)
+            self._preview_factors[device] = factors
+        return factors
+
+    def latents_to_preview(self, x0):
+        """Quick RGB approximate previews of a batch of sd3 latents, as a (B, H, W, 3) uint8 tensor on their device"""
+        latent_image = torch.einsum(
+            "bchw,cr->bhwr", x0.float(), self.preview_factors(x0.device)
         )
-        latent_image = x0[0].permute(1, 2, 0).cpu() @ factors
-
-        latents_ubyte = (
+        return (
             ((latent_image + 1) / 2)
             .clamp(0, 1)  # change scale from -1..1 to 0..1
             .mul(0xFF)  # to 0..255
             .byte()
-        ).cpu()
+        )
 
+    def decode_latent_to_preview(self, x0):
+        """Quick RGB approximate preview of sd3 latents"""
+        latents_ubyte = self.latents_to_preview(x0[:1])[0].cpu()
         return Image.fromarray(latents_ubyte.numpy())
 
 
@@ -332,46 +604,370 @@ def to_d(x, sigma, denoised):
     return (x - denoised) / append_dims(sigma, x.ndim)
 
 
-@torch.no_grad()
-@torch.autocast("cuda", dtype=torch.float16)
-def sample_euler(model, x, sigmas, extra_args=None):
-    """Implements Algorithm 2 (Euler steps) from Karras et al. (2022)."""
-    extra_args = {} if extra_args is None else extra_args
-    s_in = x.new_ones([x.shape[0]])
-    for i in tqdm(range(len(sigmas) - 1)):
-        sigma_hat = sigmas[i]
-        denoised = model(x, sigma_hat * s_in, **extra_args)
-        d = to_d(x, sigma_hat, denoised)
-        dt = sigmas[i + 1] - sigma_hat
-        # Euler method
-        x = x + d * dt
+def autocast_sampler(sampler):
+    """Runs a sampler under the autocast matching the device/dtype of its input latent"""
+
+    @functools.wraps(sampler)
+    def wrapper(model, x, *args, **kwargs):
+        with autocast_for(x.device, x.dtype):
+            return sampler(model, x, *args, **kwargs)
+
+    return wrapper
+
+
+def euler_step(x, denoised, sigmas, i, state):
+    """One Euler step from sigmas[i] to sigmas[i + 1]"""
+    sigma_hat = sigmas[i]
+    d = to_d(x, sigma_hat, denoised)
+    dt = sigmas[i + 1] - sigma_hat
+    # Euler method
+    return x + d * dt
+
+
+def sigma_fn(t):
+    return t.neg().exp()
+
+
+def t_fn(sigma):
+    return sigma.log().neg()
+
+
+def dpmpp_2m_step(x, denoised, sigmas, i, state):
+    """One DPM-Solver++(2M) step from sigmas[i] to sigmas[i + 1], `state` carries the previous prediction"""
+    old_denoised = state.get("old_denoised")
+    t, t_next = t_fn(sigmas[i]), t_fn(sigmas[i + 1])
+    h = t_next - t
+    if old_denoised is None or sigmas[i + 1] == 0:
+        x = (sigma_fn(t_next) / sigma_fn(t)) * x - (-h).expm1() * denoised
+    else:
+        h_last = t - t_fn(sigmas[i - 1])
+        r = h_last / h
+        denoised_d = (1 + 1 / (2 * r)) * denoised - (1 / (2 * r)) * old_denoised
+        x = (sigma_fn(t_next) / sigma_fn(t)) * x - (-h).expm1() * denoised_d
+    state["old_denoised"] = denoised
     return x
 
 
-@torch.no_grad()
-@torch.autocast("cuda", dtype=torch.float16)
-def sample_dpmpp_2m(model, x, sigmas, extra_args=None):
-    """DPM-Solver++(2M)."""
+SAMPLER_STEPS = {
+    "euler": euler_step,
+    "dpmpp_2m": dpmpp_2m_step,
+}
+
+
+class GenerationCancelled(Exception):
+    """Raised at a step or image boundary once the CancellationToken of a generation is cancelled"""
+
+
+class GenerationPreempted(Exception):
+    """Raised at a step boundary while a generation is paused, `snapshot` resumes it where it stopped"""
+
+    def __init__(self, snapshot):
+        super().__init__(f"Preempted before step {snapshot.index}")
+        self.snapshot = snapshot
+
+
+class SamplingSnapshot:
+    """In-flight latent and sampler state of a preempted sampling, enough to continue at step `index`
+    without redoing finished steps. `extras` holds the stateful helpers of the run (denoiser, block cache)."""
+
+    def __init__(self, x, index, state, extras=None):
+        self.x = x
+        self.index = index
+        self.state = state
+        self.extras = extras or {}
+
+
+class CancellationToken:
+    """Shared by a generation and whoever controls it. `cancel()` stops the generation at its next step or
+    image boundary; `preempt()` pauses it at the next step boundary, freeing the model for another job until
+    `resume()`."""
+
+    def __init__(self):
+        self.cancelled = threading.Event()
+        self.running = threading.Event()
+        self.running.set()
+
+    def cancel(self):
+        self.cancelled.set()
+        self.running.set()
+
+    def preempt(self):
+        self.running.clear()
+
+    def resume(self):
+        self.running.set()
+
+    @property
+    def paused(self):
+        return not self.running.is_set()
+
+    def check(self):
+        """Image boundary: raises once cancelled, blocks while paused"""
+        self.running.wait()
+        if self.cancelled.is_set():
+            raise GenerationCancelled()
+
+    def check_step(self, x, index, state):
+        """Step boundary: raises once cancelled, preempts with a snapshot while paused"""
+        if self.cancelled.is_set():
+            raise GenerationCancelled()
+        if self.paused:
+            raise GenerationPreempted(SamplingSnapshot(x, index, dict(state)))
+
+
+def run_sampler(
+    step_fn, model, x, sigmas, extra_args=None, callback=None, token=None, resume=None
+):
+    """Shared sampler loop: `step_fn` advances x from sigmas[i] to sigmas[i + 1]. `token` is checked before
+    every step, `resume` (a SamplingSnapshot) continues a preempted run."""
     extra_args = {} if extra_args is None else extra_args
     s_in = x.new_ones([x.shape[0]])
-    sigma_fn = lambda t: t.neg().exp()
-    t_fn = lambda sigma: sigma.log().neg()
-    old_denoised = None
-    for i in tqdm(range(len(sigmas) - 1)):
+    state = {}
+    start = 0
+    if resume is not None:
+        x, start, state = resume.x, resume.index, dict(resume.state)
+    for i in tqdm(range(start, len(sigmas) - 1)):
+        if token is not None:
+            token.check_step(x, i, state)
         denoised = model(x, sigmas[i] * s_in, **extra_args)
-        t, t_next = t_fn(sigmas[i]), t_fn(sigmas[i + 1])
-        h = t_next - t
-        if old_denoised is None or sigmas[i + 1] == 0:
-            x = (sigma_fn(t_next) / sigma_fn(t)) * x - (-h).expm1() * denoised
-        else:
-            h_last = t - t_fn(sigmas[i - 1])
-            r = h_last / h
-            denoised_d = (1 + 1 / (2 * r)) * denoised - (1 / (2 * r)) * old_denoised
-            x = (sigma_fn(t_next) / sigma_fn(t)) * x - (-h).expm1() * denoised_d
-        old_denoised = denoised
+        if callback is not None:
+            callback({"x": x, "i": i, "sigma": sigmas[i], "denoised": denoised})
+        x = step_fn(x, denoised, sigmas, i, state)
     return x
 
 
+@torch.no_grad()
+@autocast_sampler
+def sample_euler(
+    model, x, sigmas, extra_args=None, callback=None, token=None, resume=None
+):
+    """Implements Algorithm 2 (Euler steps) from Karras et al. (2022)."""
+    return run_sampler(
+        euler_step, model, x, sigmas, extra_args, callback, token, resume
+    )
+
+
+@torch.no_grad()
+@autocast_sampler
+def sample_dpmpp_2m(
+    model, x, sigmas, extra_args=None, callback=None, token=None, resume=None
+):
+    """DPM-Solver++(2M)."""
+    return run_sampler(
+        dpmpp_2m_step, model, x, sigmas, extra_args, callback, token, resume
+    )
+
+
+class LatentPreviewer:
+    """Sampler callback handing `on_preview(step, steps, previews)` the approximate RGB of the current denoised
+    latents, a (B, H/8, W/8, 3) uint8 array, every `every` steps. Previews are skipped while their total cost
+    (projection, copy and `on_preview` itself) exceeds `budget` of the sampling time so far; the last step is
+    always previewed.
+    """
+
+    def __init__(self, on_preview, steps, every=1, budget=0.05):
+        self.on_preview = on_preview
+        self.steps = steps
+        self.every = max(1, every)
+        self.budget = budget
+        self.start = time.perf_counter()
+        self.spent = 0.0
+        self.emitted = 0
+        self.skipped = 0
+
+    def __call__(self, info):
+        step = info["i"] + 1
+        if step % self.every and step != self.steps:
+            return
+        now = time.perf_counter()
+        if self.spent > self.budget * (now - self.start) and step != self.steps:
+            self.skipped += 1
+            return
+        previews = SD3LatentFormat().latents_to_preview(info["denoised"])
+        self.on_preview(step, self.steps, previews.cpu().numpy())
+        self.emitted += 1
+        self.spent += time.perf_counter() - now
+
+    def stats(self):
+        return {"emitted": self.emitted, "skipped": self.skipped, "seconds": self.spent}
+
+
+#################################################################################################
+### Continuous batching
+#################################################################################################
+
+
+class SamplingJob:
+    """One sample walking its own sigma schedule inside a ContinuousBatchScheduler. `callback` receives the
+    same per-step dict as the samplers' callback; a paused `token` keeps the job out of the batch until it
+    resumes and a cancelled one drops it with GenerationCancelled."""
+
+    def __init__(
+        self,
+        x,
+        sigmas,
+        cond,
+        uncond,
+        cond_scale,
+        sampler="dpmpp_2m",
+        callback=None,
+        token=None,
+    ):
+        self.x = x
+        self.sigmas = sigmas
+        self.cond = cond
+        self.uncond = uncond
+        self.cond_scale = cond_scale
+        self.step_fn = SAMPLER_STEPS[sampler]
+        self.callback = callback
+        self.token = token
+        self.state = {}
+        self.index = 0
+        self.error = None
+        self.done = threading.Event()
+        # Only jobs with matching latent and context shapes can share a forward
+        self.key = (
+            tuple(x.shape[1:]),
+            tuple(cond["c_crossattn"].shape[1:]),
+            tuple(uncond["c_crossattn"].shape[1:]),
+            x.dtype,
+            x.device,
+        )
+
+    @property
+    def finished(self):
+        return self.index >= len(self.sigmas) - 1
+
+    def result(self, timeout=None):
+        if not self.done.wait(timeout):
+            raise TimeoutError("Sampling job still running")
+        if self.error is not None:
+            raise self.error
+        return self.x
+
+
+class ContinuousBatchScheduler:
+    """Step-level batching for CFG sampling. Every forward of the model advances up to `max_batch` jobs by one
+    step, each at its own point of its own sigma schedule (apply_model takes a per-sample sigma) and with its own
+    sampler state. Jobs join at any step boundary and leave as soon as their schedule ends."""
+
+    def __init__(self, model, max_batch=4):
+        self.model = model
+        self.max_batch = max_batch
+        self.jobs = []
+        self.condition = threading.Condition()
+        self.forwards = 0
+        self.samples = 0
+        self.stopped = threading.Event()
+
+    def submit(
+        self,
+        x,
+        sigmas,
+        cond,
+        uncond,
+        cond_scale,
+        sampler="dpmpp_2m",
+        callback=None,
+        token=None,
+    ):
+        """Queues one sample, `x` is its (1, C, H, W) noised latent and cond/uncond as given to CFGDenoiser"""
+        job = SamplingJob(
+            x, sigmas, cond, uncond, cond_scale, sampler, callback, token
+        )
+        with self.condition:
+            self.jobs.append(job)
+            self.condition.notify_all()
+        return job
+
+    def select(self):
+        # The oldest job picks the batch, so nothing starves behind a stream of other shapes
+        with self.condition:
+            for job in [j for j in self.jobs if j.token and j.token.cancelled.is_set()]:
+                job.error = GenerationCancelled()
+                self.retire(job)
+            ready = [job for job in self.jobs if not (job.token and job.token.paused)]
+            if not ready:
+                return []
+            key = ready[0].key
+            return [job for job in ready if job.key == key][: self.max_batch]
+
+    def retire(self, job):
+        with self.condition:
+            self.jobs.remove(job)
+        job.done.set()
+
+    @torch.no_grad()
+    def step(self):
+        """Runs one batched forward, returns False when there was nothing to run"""
+        jobs = self.select()
+        if not jobs:
+            return False
+        try:
+            x = torch.cat([job.x for job in jobs])
+            sigma = torch.cat(
+                [job.sigmas[job.index] * job.x.new_ones([1]) for job in jobs]
+            )
+            conds = [job.cond for job in jobs] + [job.uncond for job in jobs]
+            with autocast_for(x.device, x.dtype):
+                batched = self.model.apply_model(
+                    torch.cat([x, x]),
+                    torch.cat([sigma, sigma]),
+                    c_crossattn=torch.cat([c["c_crossattn"] for c in conds]),
+                    y=torch.cat([c["y"] for c in conds]),
+                )
+                pos_out, neg_out = batched.chunk(2)
+                for i, job in enumerate(jobs):
+                    denoised = neg_out[i : i + 1] + (
+                        pos_out[i : i + 1] - neg_out[i : i + 1]
+                    ) * job.cond_scale
+                    if job.callback is not None:
+                        job.callback(
+                            {
+                                "x": job.x,
+                                "i": job.index,
+                                "sigma": job.sigmas[job.index],
+                                "denoised": denoised,
+                            }
+                        )
+                    job.x = job.step_fn(job.x, denoised, job.sigmas, job.index, job.state)
+                    job.index += 1
+        except Exception as e:
+            for job in jobs:
+                job.error = e
+                self.retire(job)
+            return True
+        self.forwards += 1
+        self.samples += len(jobs)
+        for job in jobs:
+            if job.finished:
+                self.retire(job)
+        return True
+
+    def run_until_complete(self):
+        while self.step():
+            pass
+
+    def serve(self):
+        """Worker loop for a background thread: steps whenever jobs are queued, until `stop` is called"""
+        while not self.stopped.is_set():
+            with self.condition:
+                if not self.select():
+                    self.condition.wait(timeout=0.1)
+                    continue
+            self.step()
+
+    def stop(self):
+        self.stopped.set()
+        with self.condition:
+            self.condition.notify_all()
+
+    @property
+    def occupancy(self):
+        """Average number of samples per forward so far"""
+        return self.samples / self.forwards if self.forwards else 0.0
+
+
 #################################################################################################
 ### VAE
 #################################################################################################
@@ -495,9 +1091,7 @@ class AttnBlock(torch.nn.Module):
             lambda x: einops.rearrange(x, "b c h w -> b 1 (h w) c").contiguous(),
             (q, k, v),
         )
-        hidden = torch.nn.functional.scaled_dot_product_attention(
-            q, k, v
-        )  # scale is dim ** -0.5 per default
+        hidden = ATTENTION(q, k, v)  # scale is dim ** -0.5 per default
         hidden = einops.rearrange(hidden, "b 1 (h w) c -> b c h w", h=h, w=w, c=c, b=b)
         hidden = self.proj_out(hidden)
         return x + hidden
@@ -723,19 +1317,80 @@ class VAEDecoder(torch.nn.Module):
         return hidden
 
 
+def tile_starts(size, tile, overlap):
+    """Start offsets of tiles of `tile` covering `size` with at least `overlap` shared between neighbours"""
+    if size <= tile:
+        return [0]
+    return list(range(0, size - tile, tile - overlap)) + [size - tile]
+
+
+def feather(size, ramp, device):
+    """1D blending weights rising linearly over `ramp` samples at both ends, never zero"""
+    i = torch.arange(size, device=device, dtype=torch.float32)
+    return (torch.minimum(i + 1, size - i) / (ramp + 1)).clamp(max=1.0)
+
+
+def tiled_apply(fn, x, tile, overlap, scale, workers=1):
+    """Applies the convolutional `fn` to overlapping `tile` x `tile` tiles of the NCHW `x` and blends the results
+    with linear feathers across the overlap. `scale` is the output/input size ratio of `fn`. Up to `workers` tiles
+    run in parallel threads, results are blended in a fixed order so the output does not depend on it.
+    """
+    h, w = x.shape[-2:]
+    tiles = [
+        (top, left)
+        for top in tile_starts(h, tile, overlap)
+        for left in tile_starts(w, tile, overlap)
+    ]
+    if len(tiles) == 1:
+        return fn(x)
+
+    def run(position):
+        top, left = position
+        return fn(x[..., top : top + tile, left : left + tile]).float()
+
+    out_h, out_w, ramp = int(h * scale), int(w * scale), int(overlap * scale)
+    out = weight = None
+    with ThreadPoolExecutor(max(1, workers)) as pool:
+        for (top, left), y in zip(tiles, pool.map(run, tiles)):
+            if out is None:
+                out = y.new_zeros(y.shape[:2] + (out_h, out_w))
+                weight = y.new_zeros((out_h, out_w))
+            th, tw = y.shape[-2:]
+            mask = feather(th, ramp, y.device)[:, None] * feather(tw, ramp, y.device)
+            top, left = int(top * scale), int(left * scale)
+            out[..., top : top + th, left : left + tw] += y * mask
+            weight[top : top + th, left : left + tw] += mask
+    return out / weight
+
+
 class SDVAE(torch.nn.Module):
     def __init__(self, dtype=torch.float32, device=None):
         super().__init__()
+        self.dtype = dtype
         self.encoder = VAEEncoder(dtype=dtype, device=device)
         self.decoder = VAEDecoder(dtype=dtype, device=device)
 
-    @torch.autocast("cuda", dtype=torch.float16)
     def decode(self, latent):
-        return self.decoder(latent)
+        with autocast_for(latent.device, self.dtype):
+            return self.decoder(latent.to(self.dtype))
+
+    def decode_tiled(self, latent, tile=96, overlap=16, workers=1):
+        """`decode` over overlapping latent tiles, peak memory follows `tile` instead of the image size"""
+        return tiled_apply(self.decode, latent, tile, overlap, 8, workers)
+
+    def encode_moments(self, image):
+        with autocast_for(image.device, self.dtype):
+            return self.encoder(image.to(self.dtype))
 
-    @torch.autocast("cuda", dtype=torch.float16)
     def encode(self, image):
-        hidden = self.encoder(image)
+        return self.sample_latent(self.encode_moments(image))
+
+    def encode_tiled(self, image, tile=768, overlap=128, workers=1):
+        """`encode` over overlapping image tiles, `tile` and `overlap` in pixels (multiples of 8)"""
+        hidden = tiled_apply(self.encode_moments, image, tile, overlap, 1 / 8, workers)
+        return self.sample_latent(hidden)
+
+    def sample_latent(self, hidden):
         mean, logvar = torch.chunk(hidden, 2, dim=1)
         logvar = torch.clamp(logvar, -30.0, 20.0)
         std = torch.exp(0.5 * logvar)
@@ -11,20 +11,49 @@ import math
 import os
 import pickle
 import re
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import fire
 import numpy as np
 import sd3_impls
 import torch
-from other_impls import SD3Tokenizer, SDClipModel, SDXLClipG, T5XXLModel
+from mmditx import BlockCache, ContextEmbedCache, ModulationSchedule
+from other_impls import (
+    ATTENTION,
+    SD3Tokenizer,
+    SDClipModel,
+    SDXLClipG,
+    T5XXLModel,
+    set_attention_backend,
+)
 from PIL import Image
-from safetensors import safe_open
+from sd3_cond_cache import ConditioningCache, encoder_fingerprint
 from sd3_impls import (
     SDVAE,
+    AdaptiveCFGDenoiser,
     BaseModel,
     CFGDenoiser,
+    ContinuousBatchScheduler,
+    ExecutionPolicy,
+    GenerationPreempted,
+    LatentPreviewer,
     SD3LatentFormat,
     SkipLayerCFGDenoiser,
+    autocast_for,
+    mmdit_config,
+)
+from sd3_weights import (
+    MemoryBudget,
+    SafetensorsFile,
+    estimate_load_bytes,
+    is_fresh,
+    load_into,
+    materialize_missing,
+    open_checkpoint,
+    prepared_path,
+    read_descriptor,
+    write_prepared,
 )
 from tqdm import tqdm
 
@@ -32,42 +61,18 @@ from tqdm import tqdm
 ### Wrappers for model parts
 #################################################################################################
 
+# NOTE: every part is constructed on the meta device and gets its storage from the checkpoint in `load_into`,
+# so peak memory while loading matches the final model footprint instead of twice it.
+# Parts load from their prepared copy (see `prepare_checkpoints`) whenever a fresh one exists.
 
-def load_into(ckpt, model, prefix, device, dtype=None, remap=None):
-    """Just a debugging-friendly hack to apply the weights in a safetensors file to the pytorch module."""
-    for key in ckpt.keys():
-        model_key = key
-        if remap is not None and key in remap:
-            model_key = remap[key]
-        if model_key.startswith(prefix) and not model_key.startswith("loss."):
-            path = model_key[len(prefix) :].split(".")
-            obj = model
-            for p in path:
-                if obj is list:
-                    obj = obj[int(p)]
-                else:
-                    obj = getattr(obj, p, None)
-                    if obj is None:
-                        print(
-                            f"Skipping key '{model_key}' in safetensors file as '{p}' does not exist in python model"
-                        )
-                        break
-            if obj is None:
-                continue
-            try:
-                tensor = ckpt.get_tensor(key).to(device=device)
-                if dtype is not None and tensor.dtype != torch.int32:
-                    tensor = tensor.to(dtype=dtype)
-                obj.requires_grad_(False)
-                # print(f"K: {model_key}, O: {obj.shape} T: {tensor.shape}")
-                if obj.shape != tensor.shape:
-                    print(
-                        f"W: shape mismatch for key {model_key}, {obj.shape} != {tensor.shape}"
-                    )
-                obj.set_(tensor)
-            except Exception as e:
-                print(f"Failed to load key '{key}' in safetensors file: {e}")
-                raise e
+
+@torch.no_grad()
+def finish_clip_load(transformer, device):
+    missing = materialize_missing(transformer, device)
+    # CLIP checkpoints that don't ship a text projection keep the identity default from CLIPTextModel
+    if "text_projection.weight" in missing:
+        weight = transformer.text_projection.weight
+        weight.copy_(torch.eye(weight.shape[0], dtype=weight.dtype))
 
 
 CLIPG_CONFIG = {
@@ -80,12 +85,19 @@ CLIPG_CONFIG = {
 
 
 class ClipG:
-    def __init__(self, model_folder: str, device: str = "cpu"):
-        with safe_open(
-            f"{model_folder}/clip_g.safetensors", framework="pt", device="cpu"
-        ) as f:
-            self.model = SDXLClipG(CLIPG_CONFIG, device=device, dtype=torch.float32)
-            load_into(f, self.model.transformer, "", device, torch.float32)
+    def __init__(self, model_folder: str, device: str = "cpu", readonly=False):
+        f, _, _ = open_checkpoint(
+            f"{model_folder}/clip_g.safetensors",
+            "clip_g",
+            torch.float32,
+            readonly=readonly,
+        )
+        with f:
+            self.model = SDXLClipG(CLIPG_CONFIG, device="meta", dtype=torch.float32)
+            self.load_stats = load_into(
+                f, self.model.transformer, "", device, torch.float32
+            )
+            finish_clip_load(self.model.transformer, device)
 
 
 CLIPL_CONFIG = {
@@ -98,20 +110,27 @@ CLIPL_CONFIG = {
 
 
 class ClipL:
-    def __init__(self, model_folder: str):
-        with safe_open(
-            f"{model_folder}/clip_l.safetensors", framework="pt", device="cpu"
-        ) as f:
+    def __init__(self, model_folder: str, readonly=False):
+        f, _, _ = open_checkpoint(
+            f"{model_folder}/clip_l.safetensors",
+            "clip_l",
+            torch.float32,
+            readonly=readonly,
+        )
+        with f:
             self.model = SDClipModel(
                 layer="hidden",
                 layer_idx=-2,
-                device="cpu",
+                device="meta",
                 dtype=torch.float32,
                 layer_norm_hidden_state=False,
                 return_projected_pooled=False,
                 textmodel_json_config=CLIPL_CONFIG,
             )
-            load_into(f, self.model.transformer, "", "cpu", torch.float32)
+            self.load_stats = load_into(
+                f, self.model.transformer, "", "cpu", torch.float32
+            )
+            finish_clip_load(self.model.transformer, "cpu")
 
 
 T5_CONFIG = {
@@ -124,12 +143,20 @@ T5_CONFIG = {
 
 
 class T5XXL:
-    def __init__(self, model_folder: str, device: str = "cpu", dtype=torch.float32):
-        with safe_open(
-            f"{model_folder}/t5xxl.safetensors", framework="pt", device="cpu"
-        ) as f:
-            self.model = T5XXLModel(T5_CONFIG, device=device, dtype=dtype)
-            load_into(f, self.model.transformer, "", device, dtype)
+    def __init__(
+        self,
+        model_folder: str,
+        device: str = "cpu",
+        dtype=torch.float32,
+        readonly=False,
+    ):
+        f, _, _ = open_checkpoint(
+            f"{model_folder}/t5xxl.safetensors", "t5xxl", dtype, readonly=readonly
+        )
+        with f:
+            self.model = T5XXLModel(T5_CONFIG, device="meta", dtype=dtype)
+            self.load_stats = load_into(f, self.model.transformer, "", device, dtype)
+            materialize_missing(self.model.transformer, device)
 
 
 CONTROLNET_MAP = {
@@ -148,41 +175,50 @@ CONTROLNET_MAP = {
 
 class SD3:
     def __init__(
-        self, model, shift, control_model_file=None, verbose=False, device="cpu"
+        self,
+        model,
+        shift,
+        control_model_file=None,
+        verbose=False,
+        device="cpu",
+        dtype=torch.float16,
+        readonly=False,
     ):
 
         # NOTE 8B ControlNets were trained with a slightly different forward pass and conditioning,
         # so this is a flag to enable that logic.
         self.using_8b_controlnet = False
 
-        with safe_open(model, framework="pt", device="cpu") as f:
+        f, prefix, prepared = open_checkpoint(
+            model, "mmdit", dtype, "model.", readonly=readonly
+        )
+        with f:
             control_model_ckpt = None
             if control_model_file is not None:
-                control_model_ckpt = safe_open(
-                    control_model_file, framework="pt", device=device
+                control_model_ckpt, _, control_prepared = open_checkpoint(
+                    control_model_file, "controlnet", dtype, readonly=readonly
                 )
             self.model = BaseModel(
                 shift=shift,
                 file=f,
-                prefix="model.diffusion_model.",
-                device="cuda",
-                dtype=torch.float16,
+                prefix=f"{prefix}diffusion_model.",
+                device="meta",
+                dtype=dtype,
                 control_model_ckpt=control_model_ckpt,
                 verbose=verbose,
+                config=read_descriptor(f) if prepared else None,
             ).eval()
-            load_into(f, self.model, "model.", "cuda", torch.float16)
+            self.load_stats = load_into(f, self.model, prefix, device, dtype)
+            # Crops taken from the meta/previous pos_embed are stale once it is loaded
+            self.model.diffusion_model.clear_pos_embed_cache()
         if control_model_file is not None:
-            control_model_ckpt = safe_open(
-                control_model_file, framework="pt", device=device
-            )
-            self.model.control_model = self.model.control_model.to(device)
             load_into(
                 control_model_ckpt,
                 self.model.control_model,
                 "",
                 device,
-                dtype=torch.float16,
-                remap=CONTROLNET_MAP,
+                dtype=dtype,
+                remap=None if control_prepared else CONTROLNET_MAP,
             )
 
             self.using_8b_controlnet = (
@@ -190,16 +226,97 @@ class SD3:
             )
             self.model.control_model.using_8b_controlnet = self.using_8b_controlnet
         control_model_ckpt = None
+        materialize_missing(self.model, device)
+
+
+def vae_prefix(ckpt):
+    if any(k.startswith("first_stage_model.") for k in ckpt.keys()):
+        return "first_stage_model."
+    return ""
 
 
 class VAE:
-    def __init__(self, model, dtype: torch.dtype = torch.float16):
-        with safe_open(model, framework="pt", device="cpu") as f:
-            self.model = SDVAE(device="cpu", dtype=dtype).eval().cpu()
-            prefix = ""
-            if any(k.startswith("first_stage_model.") for k in f.keys()):
-                prefix = "first_stage_model."
-            load_into(f, self.model, prefix, "cpu", dtype)
+    def __init__(self, model, dtype: torch.dtype = torch.float16, readonly=False):
+        f, _, prepared = open_checkpoint(model, "vae", dtype, readonly=readonly)
+        with f:
+            self.model = SDVAE(device="meta", dtype=dtype).eval()
+            prefix = "" if prepared else vae_prefix(f)
+            self.load_stats = load_into(f, self.model, prefix, "cpu", dtype)
+            materialize_missing(self.model, "cpu")
+
+
+def prepare_checkpoints(
+    model=None,
+    vae=None,
+    controlnet_ckpt=None,
+    model_folder=None,
+    policy: ExecutionPolicy = None,
+):
+    """One-time conversion of every checkpoint into prepared per-component files (remapped, pre-cast, aligned,
+    with a cached architecture descriptor) that `SD3Inferencer.load` then picks up automatically
+    """
+    policy = policy or ExecutionPolicy()
+    # (source file, component, source prefix or callable picking it, dtype, key remap, descriptor callable)
+    parts = [
+        (
+            f"{model_folder}/t5xxl.safetensors",
+            "t5xxl",
+            "",
+            torch.float32,
+            None,
+            lambda f: T5_CONFIG,
+        ),
+        (
+            f"{model_folder}/clip_l.safetensors",
+            "clip_l",
+            "",
+            torch.float32,
+            None,
+            lambda f: CLIPL_CONFIG,
+        ),
+        (
+            f"{model_folder}/clip_g.safetensors",
+            "clip_g",
+            "",
+            torch.float32,
+            None,
+            lambda f: CLIPG_CONFIG,
+        ),
+        (
+            model,
+            "mmdit",
+            "model.",
+            policy.dtype,
+            None,
+            lambda f: mmdit_config(f, "model.diffusion_model."),
+        ),
+        (vae or model, "vae", vae_prefix, policy.vae_dtype, None, None),
+    ]
+    if controlnet_ckpt is not None:
+        parts.append(
+            (controlnet_ckpt, "controlnet", "", policy.dtype, CONTROLNET_MAP, None)
+        )
+    for source, component, prefix, dtype, remap, describe in parts:
+        if not os.path.exists(source):
+            print(f"Skipping {component}: {source} not found")
+            continue
+        out_path = prepared_path(source, component, dtype)
+        if is_fresh(out_path, source):
+            print(f"{os.path.basename(out_path)} is up to date")
+            continue
+        print(f"Preparing {os.path.basename(out_path)}...")
+        start = time.perf_counter()
+        with SafetensorsFile(source) as f:
+            write_prepared(
+                f,
+                out_path,
+                component,
+                prefix(f) if callable(prefix) else prefix,
+                dtype,
+                remap,
+                describe(f) if describe else None,
+            )
+        print(f"  done in {time.perf_counter() - start:.1f}s")
 
 
 #################################################################################################
@@ -242,17 +359,82 @@ OUTDIR = "outputs"
 SAMPLER = "dpmpp_2m"
 # MODEL FOLDER
 MODEL_FOLDER = "models"
+# Memory for precomputed adaLN modulation, later steps are evaluated live (SD3.5 Large takes ~4.4MB per row and step in fp32)
+MODULATION_BUDGET_BYTES = 256 * 2**20
 
 
 class SD3Inferencer:
 
-    def __init__(self):
+    def __init__(self, policy: ExecutionPolicy = None):
         self.verbose = False
+        self.policy = policy or ExecutionPolicy()
+        self.load_times = {}
+        self.cond_cache = None
+        self.scheduler = None
+        self.last_sampling_stats = {}
+        self.shared_weights = False
+        # Images over `threshold` pixels run through the VAE in overlapping tiles of `tile` latent pixels,
+        # see SDVAE.decode_tiled; `workers` tiles run in parallel. Smaller images are decoded whole, in
+        # sub-batches of at most `threshold` pixels
+        self.vae_tiling = {
+            "threshold": 2048 * 2048,
+            "tile": 96,
+            "overlap": 16,
+            "workers": 1 if self.policy.device.type == "cuda" else 2,
+        }
+
+    def use_vae_tiling(self, tensor, scale):
+        """Whether a single image of `tensor` is over the tiling threshold. Tiling is not exactly equivalent to
+        a whole pass, so the batch size must not change the choice, or the same seed would give a different
+        image depending on what it was batched with"""
+        _, _, h, w = tensor.shape
+        return h * w * scale * scale > self.vae_tiling["threshold"]
+
+    def vae_sub_batch(self, tensor, scale):
+        """Images per whole VAE pass, bounding a pass to `threshold` pixels"""
+        _, _, h, w = tensor.shape
+        return max(1, self.vae_tiling["threshold"] // (h * w * scale * scale))
 
     def print(self, txt):
         if self.verbose:
             print(txt)
 
+    def timed_load(self, name, description, build, callback=None):
+        """Builds one model component, recording and reporting how long it took"""
+        print(f"Loading {description}...")
+        if callback:
+            callback(f"Loading {description}...")
+        start = time.perf_counter()
+        # Grad mode is thread-local, so it is disabled here rather than around `load`
+        with torch.no_grad():
+            component = build()
+        self.load_times[name] = time.perf_counter() - start
+        stats = getattr(component, "load_stats", None)
+        message = f"{description} loaded in {self.load_times[name]:.1f}s"
+        print(f"  {message}" + (f" ({stats})" if stats else ""))
+        if callback:
+            callback(message)
+        return component
+
+    def load_concurrent(
+        self, components, max_workers=None, memory_budget=None, callback=None
+    ):
+        """Builds the model components on a thread pool. Checkpoint reads and dtype conversion release the GIL,
+        so wall-clock approaches that of the largest component. `memory_budget` (bytes) bounds how much
+        weight is being loaded at once."""
+        budget = MemoryBudget(memory_budget)
+
+        def build(name, description, builder, cost):
+            with budget.reserve(cost):
+                return self.timed_load(name, description, builder, callback)
+
+        # Largest first, so the component that bounds wall-clock starts right away
+        components = sorted(components, key=lambda c: c[3], reverse=True)
+        with ThreadPoolExecutor(max_workers=max_workers or len(components)) as pool:
+            futures = [(c[0], pool.submit(build, *c)) for c in components]
+            for name, future in futures:
+                setattr(self, name, future.result())
+
     def load(
         self,
         model=MODEL,
@@ -263,28 +445,116 @@ class SD3Inferencer:
         text_encoder_device: str = "cpu",
         verbose=False,
         load_tokenizers: bool = True,
+        concurrent: bool = False,
+        max_workers: int = None,
+        memory_budget: int = None,
+        callback=None,
+        cond_cache_bytes: int = 256 * 2**20,
+        cond_cache_dir: str = None,
+        shared_weights: bool = False,
     ):
+        """Loads every model component. With `shared_weights` the checkpoints are mapped read-only, so CPU
+        weights already in their target dtype (always the case with prepared checkpoints, see
+        `prepare_checkpoints`) stay views on the page cache that every process loading the same files shares.
+        The VAE then keeps its conv weights in the mapped layout, as a channels-last copy would be private.
+        """
         self.verbose = verbose
+        self.shared_weights = shared_weights
         print("Loading tokenizers...")
         # NOTE: if you need a reference impl for a high performance CLIP tokenizer instead of just using the HF transformers one,
         # check https://github.com/Stability-AI/StableSwarmUI/blob/master/src/Utils/CliplikeTokenizer.cs
         # (T5 tokenizer is different though)
         self.tokenizer = SD3Tokenizer()
+        # (attribute, description, builder, estimated resident bytes)
+        components = []
         if load_tokenizers:
-            print("Loading Google T5-v1-XXL...")
-            self.t5xxl = T5XXL(model_folder, text_encoder_device, torch.float32)
-            print("Loading OpenAI CLIP L...")
-            self.clip_l = ClipL(model_folder)
-            print("Loading OpenCLIP bigG...")
-            self.clip_g = ClipG(model_folder, text_encoder_device)
-        print(f"Loading SD3 model {os.path.basename(model)}...")
-        self.sd3 = SD3(model, shift, controlnet_ckpt, verbose, "cuda")
-        print("Loading VAE model...")
-        self.vae = VAE(vae or model)
-        print("Models loaded.")
-
-    def get_empty_latent(self, batch_size, width, height, seed, device="cuda"):
+            components += [
+                (
+                    "t5xxl",
+                    "Google T5-v1-XXL",
+                    lambda: T5XXL(
+                        model_folder,
+                        text_encoder_device,
+                        torch.float32,
+                        shared_weights,
+                    ),
+                    estimate_load_bytes(
+                        f"{model_folder}/t5xxl.safetensors", torch.float32
+                    ),
+                ),
+                (
+                    "clip_l",
+                    "OpenAI CLIP L",
+                    lambda: ClipL(model_folder, shared_weights),
+                    estimate_load_bytes(
+                        f"{model_folder}/clip_l.safetensors", torch.float32
+                    ),
+                ),
+                (
+                    "clip_g",
+                    "OpenCLIP bigG",
+                    lambda: ClipG(model_folder, text_encoder_device, shared_weights),
+                    estimate_load_bytes(
+                        f"{model_folder}/clip_g.safetensors", torch.float32
+                    ),
+                ),
+            ]
+        components += [
+            (
+                "sd3",
+                f"SD3 model {os.path.basename(model)}",
+                lambda: SD3(
+                    model,
+                    shift,
+                    controlnet_ckpt,
+                    verbose,
+                    self.policy.device,
+                    self.policy.dtype,
+                    shared_weights,
+                ),
+                estimate_load_bytes(model, self.policy.dtype, "model.diffusion_model."),
+            ),
+            (
+                "vae",
+                "VAE model",
+                lambda: VAE(vae or model, self.policy.vae_dtype, shared_weights),
+                estimate_load_bytes(
+                    vae or model,
+                    self.policy.vae_dtype,
+                    "" if vae else "first_stage_model.",
+                ),
+            ),
+        ]
+        start = time.perf_counter()
+        if concurrent:
+            self.load_concurrent(components, max_workers, memory_budget, callback)
+        else:
+            for name, description, build, _ in components:
+                setattr(self, name, self.timed_load(name, description, build, callback))
+        print(f"Models loaded in {time.perf_counter() - start:.1f}s. {self.policy}")
+        if load_tokenizers:
+            # Keyed on the encoder weights, so a cache directory stays valid across restarts but not across models
+            self.cond_cache = ConditioningCache(
+                encoder_fingerprint(
+                    *(
+                        f"{model_folder}/{name}.safetensors"
+                        for name in ("clip_l", "clip_g", "t5xxl")
+                    )
+                ),
+                cond_cache_bytes,
+                cond_cache_dir,
+            )
+
+    def precompute_pos_embeds(self, resolutions):
+        """Crops the MMDiT positional embedding ahead of time for each (width, height) in pixels"""
+        self.sd3.model.diffusion_model.precompute_pos_embeds(
+            [(height // 8, width // 8) for width, height in resolutions],
+            self.policy.device,
+        )
+
+    def get_empty_latent(self, batch_size, width, height, seed, device=None):
         self.print("Prep an empty latent...")
+        device = device or self.policy.device
         shape = (batch_size, 16, height // 8, width // 8)
         latents = torch.zeros(shape, device=device)
         for i in range(shape[0]):
@@ -304,6 +574,11 @@ class SD3Inferencer:
         return torch.FloatTensor(sigs)
 
     def get_noise(self, seed, latent):
+        if isinstance(seed, (list, tuple)):
+            # One generator per sample, so every sample gets the noise it would get if sampled alone
+            return torch.cat(
+                [self.get_noise(s, latent[i : i + 1]) for i, s in enumerate(seed)]
+            )
         generator = torch.manual_seed(seed)
         self.print(
             f"dtype = {latent.dtype}, layout = {latent.layout}, device = {latent.device}"
@@ -317,6 +592,53 @@ class SD3Inferencer:
         ).to(latent.dtype)
 
     def get_cond(self, prompt):
+        if self.cond_cache is not None:
+            cond = self.cond_cache.get(prompt)
+            if cond is not None:
+                return cond
+        cond = self.encode_prompt(prompt)
+        if self.cond_cache is not None:
+            cond = self.cond_cache.put(prompt, cond)
+        return cond
+
+    def get_cond_batch(self, prompts):
+        """`get_cond` for many prompts at once, encoding every uncached distinct prompt in batched forwards"""
+        conds = {}
+        for prompt in dict.fromkeys(prompts):
+            cond = self.cond_cache.get(prompt) if self.cond_cache is not None else None
+            if cond is not None:
+                conds[prompt] = cond
+        missing = [prompt for prompt in dict.fromkeys(prompts) if prompt not in conds]
+        if missing:
+            for prompt, cond in zip(missing, self.encode_prompts(missing)):
+                if self.cond_cache is not None:
+                    cond = self.cond_cache.put(prompt, cond)
+                conds[prompt] = cond
+        return [conds[prompt] for prompt in prompts]
+
+    def encode_prompts(self, prompts):
+        self.print(f"Encode {len(prompts)} prompts...")
+        tokens = self.tokenizer.tokenize_with_weights_batch(prompts)
+        l_outs = self.clip_l.model.encode_token_weights_batch([t["l"] for t in tokens])
+        g_outs = self.clip_g.model.encode_token_weights_batch([t["g"] for t in tokens])
+        t5_outs = self.t5xxl.model.encode_token_weights_batch(
+            [t["t5xxl"] for t in tokens]
+        )
+        conds = []
+        for (l_out, l_pooled), (g_out, g_pooled), (t5_out, _) in zip(
+            l_outs, g_outs, t5_outs
+        ):
+            lg_out = torch.cat([l_out, g_out], dim=-1)
+            lg_out = torch.nn.functional.pad(lg_out, (0, 4096 - lg_out.shape[-1]))
+            conds.append(
+                (
+                    torch.cat([lg_out, t5_out], dim=-2),
+                    torch.cat((l_pooled, g_pooled), dim=-1),
+                )
+            )
+        return conds
+
+    def encode_prompt(self, prompt):
         self.print("Encode prompt...")
         tokens = self.tokenizer.tokenize_with_weights(prompt)
         l_out, l_pooled = self.clip_l.model.encode_token_weights(tokens["l"])
@@ -333,10 +655,104 @@ class SD3Inferencer:
         sigma = float(sigmas[0])
         return math.isclose(max_sigma, sigma, rel_tol=1e-05) or sigma > max_sigma
 
+    def batch_cond(self, cond, batch_size):
+        """Stacks a list of per-sample (context, pooled) pairs, a single pair is shared by the whole batch"""
+        if isinstance(cond, list):
+            return torch.cat([c[0] for c in cond]), torch.cat([c[1] for c in cond])
+        if cond[0].shape[0] != batch_size:
+            return cond[0].expand(batch_size, -1, -1), cond[1].expand(batch_size, -1)
+        return cond
+
     def fix_cond(self, cond):
-        cond, pooled = (cond[0].half().cuda(), cond[1].half().cuda())
+        device, dtype = self.policy.device, self.policy.dtype
+        cond, pooled = (
+            cond[0].to(device=device, dtype=dtype),
+            cond[1].to(device=device, dtype=dtype),
+        )
         return {"c_crossattn": cond, "y": pooled}
 
+    def prepare_sampling(self, latent, seed, conditioning, neg_cond, steps, denoise):
+        """Noised starting latent, sigma schedule and device-ready conditioning shared by every sampling path"""
+        device = self.policy.device
+        latent = latent.to(device=device, dtype=self.policy.dtype)
+        noise = self.get_noise(seed, latent).to(device)
+        sigmas = self.get_sigmas(self.sd3.model.model_sampling, steps).to(device)
+        sigmas = sigmas[int(steps * (1 - denoise)) :]
+        conditioning = self.fix_cond(self.batch_cond(conditioning, latent.shape[0]))
+        neg_cond = self.fix_cond(self.batch_cond(neg_cond, latent.shape[0]))
+        noise_scaled = self.sd3.model.model_sampling.noise_scaling(
+            sigmas[0], noise, latent, self.max_denoise(sigmas)
+        )
+        return noise_scaled, sigmas, conditioning, neg_cond
+
+    def modulation_schedule(
+        self, x, sigmas, conditioning, neg_cond, cond_only=False, max_bytes=None
+    ):
+        """Precomputed modulation for sampling `x` over `sigmas`. Covers the cond+uncond batch of CFG and, with
+        `cond_only`, the cond-only batch of the skip-layer and adaptive denoisers too, for as many leading steps
+        as fit in `max_bytes`"""
+        model = self.sd3.model
+        dtype = model.get_dtype()
+        # Same rounding as the samplers, which pass sigmas[i] * x.new_ones(...) to the model
+        timesteps = model.model_sampling.timestep(sigmas[:-1].to(x.dtype)).float()
+        y = conditioning["y"].to(dtype)
+        ys = [torch.cat([y, neg_cond["y"].to(dtype)])] + ([y] if cond_only else [])
+        with autocast_for(x.device, x.dtype):
+            return ModulationSchedule(
+                model.diffusion_model, timesteps, ys, dtype, max_bytes
+            )
+
+    def get_scheduler(self, max_batch=4):
+        """Continuous batching scheduler over the MMDiT, created on first use"""
+        if self.scheduler is None:
+            self.sd3.model = self.policy.activate(self.sd3.model)
+            self.scheduler = ContinuousBatchScheduler(self.sd3.model, max_batch)
+        return self.scheduler
+
+    def submit_sampling(
+        self,
+        latent,
+        seed,
+        conditioning,
+        neg_cond,
+        steps,
+        cfg_scale,
+        sampler="dpmpp_2m",
+        denoise=1.0,
+        scheduler=None,
+        callback=None,
+        token=None,
+    ):
+        """Queues the samples of `latent` on the continuous batching scheduler instead of sampling them as a
+        static batch. Returns one job per sample, pass them to `collect_sampling` for the final latents.
+        `callback` and `token` are shared by every sample, see SamplingJob.
+        """
+        scheduler = scheduler or self.get_scheduler()
+        noise_scaled, sigmas, conditioning, neg_cond = self.prepare_sampling(
+            latent, seed, conditioning, neg_cond, steps, denoise
+        )
+
+        def sample(cond, i):
+            return {k: v[i : i + 1] for k, v in cond.items()}
+
+        return [
+            scheduler.submit(
+                noise_scaled[i : i + 1],
+                sigmas,
+                sample(conditioning, i),
+                sample(neg_cond, i),
+                cfg_scale,
+                sampler,
+                callback,
+                token,
+            )
+            for i in range(noise_scaled.shape[0])
+        ]
+
+    def collect_sampling(self, jobs, timeout=None):
+        latent = torch.cat([job.result(timeout) for job in jobs])
+        return SD3LatentFormat().process_out(latent)
+
     def do_sampling(
         self,
         latent,
@@ -349,38 +765,118 @@ class SD3Inferencer:
         controlnet_cond=None,
         denoise=1.0,
         skip_layer_config={},
+        adaptive_cfg=None,
+        block_cache=None,
+        precompute_modulation=True,
+        modulation_bytes=MODULATION_BUDGET_BYTES,
+        cache_context=True,
+        preview=None,
+        preview_every=1,
+        token=None,
+        resume=None,
     ) -> torch.Tensor:
+        """Samples a batch of latents. `seed` and `conditioning` are either shared by the whole batch or
+        lists with one entry per sample, each sample then matches what it would give when sampled alone.
+        `adaptive_cfg` (a mode name or config dict, see AdaptiveCFGDenoiser) skips uncond passes, still applying
+        the skip-layer guidance of `skip_layer_config`, and `block_cache` (True or BlockCache kwargs) reuses
+        middle MMDiT blocks across steps, what they saved is left in `last_sampling_stats`.
+        `precompute_modulation` evaluates the timestep embedding and every adaLN modulation before the first step
+        for as many steps as fit in `modulation_bytes` (None = no limit), see ModulationSchedule, and
+        `cache_context` embeds each conditioning row once per run instead of once per step. `preview(step, steps, previews)`
+        receives throttled uint8 RGB previews of the batch every `preview_every` steps, see LatentPreviewer.
+        A CancellationToken `token` is checked before every step: cancelling raises GenerationCancelled,
+        preempting raises GenerationPreempted, whose snapshot passed back as `resume` (with the same other
+        arguments) continues from the last finished step.
+        """
         self.print("Sampling...")
-        latent = latent.half().cuda()
-        self.sd3.model = self.sd3.model.cuda()
-        noise = self.get_noise(seed, latent).cuda()
-        sigmas = self.get_sigmas(self.sd3.model.model_sampling, steps).cuda()
-        sigmas = sigmas[int(steps * (1 - denoise)) :]
-        conditioning = self.fix_cond(conditioning)
-        neg_cond = self.fix_cond(neg_cond)
+        # Stats of a cancelled or preempted run are not left looking like the previous run's
+        self.last_sampling_stats = {}
+        ATTENTION.reset_stats()
+        # On CUDA the peak covers this run only, the RSS peak of other devices can't be reset
+        peak_scope = "sampling" if self.policy.reset_peak_memory() else "process"
+        self.sd3.model = self.policy.activate(self.sd3.model)
+        noise_scaled, sigmas, conditioning, neg_cond = self.prepare_sampling(
+            latent, seed, conditioning, neg_cond, steps, denoise
+        )
         extra_args = {
             "cond": conditioning,
             "uncond": neg_cond,
             "cond_scale": cfg_scale,
             "controlnet_cond": controlnet_cond,
         }
-        noise_scaled = self.sd3.model.model_sampling.noise_scaling(
-            sigmas[0], noise, latent, self.max_denoise(sigmas)
-        )
         sample_fn = getattr(sd3_impls, f"sample_{sampler}")
-        denoiser = (
-            SkipLayerCFGDenoiser
-            if skip_layer_config.get("scale", 0) > 0
-            else CFGDenoiser
-        )
-        latent = sample_fn(
-            denoiser(self.sd3.model, steps, skip_layer_config),
-            noise_scaled,
-            sigmas,
-            extra_args=extra_args,
-        )
+        if adaptive_cfg:
+            denoiser = AdaptiveCFGDenoiser(
+                self.sd3.model, len(sigmas) - 1, adaptive_cfg, skip_layer_config
+            )
+        elif skip_layer_config.get("scale", 0) > 0:
+            denoiser = SkipLayerCFGDenoiser(self.sd3.model, steps, skip_layer_config)
+        else:
+            denoiser = CFGDenoiser(self.sd3.model, steps, skip_layer_config)
+        extras = resume.extras if resume is not None else {}
+        # The denoiser and block cache carry state across steps, a resumed run continues with them
+        denoiser = extras.get("denoiser", denoiser)
+        diffusion_model = self.sd3.model.diffusion_model
+        if block_cache:
+            diffusion_model.block_cache = extras.get("block_cache") or BlockCache(
+                **(block_cache if isinstance(block_cache, dict) else {})
+            )
+        if precompute_modulation:
+            diffusion_model.set_modulation_schedule(
+                self.modulation_schedule(
+                    noise_scaled,
+                    sigmas,
+                    conditioning,
+                    neg_cond,
+                    cond_only=not isinstance(denoiser, CFGDenoiser),
+                    max_bytes=modulation_bytes,
+                )
+            )
+        if cache_context:
+            diffusion_model.context_cache = ContextEmbedCache()
+        previewer = None
+        if preview is not None:
+            previewer = LatentPreviewer(preview, len(sigmas) - 1, preview_every)
+        try:
+            latent = sample_fn(
+                denoiser,
+                noise_scaled,
+                sigmas,
+                extra_args=extra_args,
+                callback=previewer,
+                token=token,
+                resume=resume,
+            )
+        except GenerationPreempted as e:
+            e.snapshot.extras = {
+                "denoiser": denoiser,
+                "block_cache": diffusion_model.block_cache,
+            }
+            raise
+        finally:
+            cache, diffusion_model.block_cache = diffusion_model.block_cache, None
+            context_cache, diffusion_model.context_cache = (
+                diffusion_model.context_cache,
+                None,
+            )
+            schedule = diffusion_model.modulation_schedule
+            diffusion_model.set_modulation_schedule(None)
+            # Also when cancelled or preempted, so the next VAE/text encoder phase gets the accelerator
+            self.sd3.model = self.policy.offload(self.sd3.model)
+        if isinstance(denoiser, AdaptiveCFGDenoiser):
+            self.last_sampling_stats["adaptive_cfg"] = denoiser.stats()
+        if cache is not None:
+            self.last_sampling_stats["block_cache"] = cache.stats()
+        if schedule is not None:
+            self.last_sampling_stats["modulation"] = schedule.stats()
+        if context_cache is not None:
+            self.last_sampling_stats["context_cache"] = context_cache.stats()
+        if previewer is not None:
+            self.last_sampling_stats["preview"] = previewer.stats()
+        self.last_sampling_stats["attention"] = ATTENTION.stats()
+        self.last_sampling_stats["peak_memory"] = self.policy.peak_memory()
+        self.last_sampling_stats["peak_memory_scope"] = peak_scope
         latent = SD3LatentFormat().process_out(latent)
-        self.sd3.model = self.sd3.model.cpu()
         self.print("Sampling done")
         return latent
 
@@ -392,17 +888,28 @@ class SD3Inferencer:
         image_np = np.array(image).astype(np.float32) / 255.0
         image_np = np.moveaxis(image_np, 2, 0)
         batch_images = np.expand_dims(image_np, axis=0).repeat(1, axis=0)
-        image_torch = torch.from_numpy(batch_images).cuda()
+        image_torch = torch.from_numpy(batch_images)
         if using_2b_controlnet:
             image_torch = image_torch * 2.0 - 1.0
         elif controlnet_type == 1:  # canny
             image_torch = image_torch * 255 * 0.5 + 0.5
         else:
             image_torch = 2.0 * image_torch - 1.0
-        image_torch = image_torch.cuda()
-        self.vae.model = self.vae.model.cuda()
-        latent = self.vae.model.encode(image_torch).cpu()
-        self.vae.model = self.vae.model.cpu()
+        image_torch = self.policy.prepare_image(image_torch)
+        self.vae.model = self.policy.activate(
+            self.vae.model, channels_last=not self.shared_weights
+        )
+        if self.use_vae_tiling(image_torch, 1):
+            latent = self.vae.model.encode_tiled(
+                image_torch,
+                self.vae_tiling["tile"] * 8,
+                self.vae_tiling["overlap"] * 8,
+                self.vae_tiling["workers"],
+            )
+        else:
+            latent = self.vae.model.encode(image_torch)
+        latent = latent.float().cpu()
+        self.vae.model = self.policy.offload(self.vae.model)
         self.print("Encoded")
         return latent
 
@@ -411,19 +918,44 @@ class SD3Inferencer:
         latent = SD3LatentFormat().process_in(latent)
         return latent
 
-    def vae_decode(self, latent) -> Image.Image:
+    def vae_decode_batch(self, latent) -> np.ndarray:
+        """Decodes a batch of latents to a (B, H, W, 3) uint8 array, converted on the device in one pass"""
         self.print("Decoding latent to image...")
-        latent = latent.cuda()
-        self.vae.model = self.vae.model.cuda()
-        image = self.vae.model.decode(latent)
-        image = image.float()
-        self.vae.model = self.vae.model.cpu()
-        image = torch.clamp((image + 1.0) / 2.0, min=0.0, max=1.0)[0]
-        decoded_np = 255.0 * np.moveaxis(image.cpu().numpy(), 0, 2)
-        decoded_np = decoded_np.astype(np.uint8)
-        out_image = Image.fromarray(decoded_np)
+        latent = self.policy.prepare_image(latent)
+        self.vae.model = self.policy.activate(
+            self.vae.model, channels_last=not self.shared_weights
+        )
+        if self.use_vae_tiling(latent, 8):
+            parts = [
+                self.vae.model.decode_tiled(
+                    latent,
+                    self.vae_tiling["tile"],
+                    self.vae_tiling["overlap"],
+                    self.vae_tiling["workers"],
+                )
+            ]
+        else:
+            sub_batches = latent.split(self.vae_sub_batch(latent, 8))
+            parts = (self.vae.model.decode(sub_batch) for sub_batch in sub_batches)
+        image = np.concatenate(
+            [
+                (255.0 * torch.clamp((part.float() + 1.0) / 2.0, min=0.0, max=1.0))
+                .permute(0, 2, 3, 1)
+                .to(torch.uint8)
+                .cpu()
+                .numpy()
+                for part in parts
+            ]
+        )
+        self.vae.model = self.policy.offload(self.vae.model)
         self.print("Decoded")
-        return out_image
+        return image
+
+    def vae_decode_images(self, latent) -> list:
+        return [Image.fromarray(image) for image in self.vae_decode_batch(latent)]
+
+    def vae_decode(self, latent) -> Image.Image:
+        return self.vae_decode_images(latent[:1])[0]
 
     def _image_to_latent(
         self,
@@ -454,13 +986,16 @@ class SD3Inferencer:
         init_image=INIT_IMAGE,
         denoise=DENOISE,
         skip_layer_config={},
+        batch_size=1,
+        adaptive_cfg=None,
+        block_cache=None,
     ):
         controlnet_cond = None
         if init_image:
             latent = self._image_to_latent(init_image, width, height)
         else:
             latent = self.get_empty_latent(1, width, height, seed, "cpu")
-            latent = latent.cuda()
+            latent = latent.to(self.policy.device)
         if controlnet_cond_image:
             using_2b, control_type = False, 0
             if self.sd3.model.control_model is not None:
@@ -470,20 +1005,34 @@ class SD3Inferencer:
                 controlnet_cond_image, width, height, using_2b, control_type
             )
         neg_cond = self.get_cond("")
+        seeds = []
         seed_num = None
-        pbar = tqdm(enumerate(prompts), total=len(prompts), position=0, leave=True)
-        for i, prompt in pbar:
+        for _ in prompts:
             if seed_type == "roll":
                 seed_num = seed if seed_num is None else seed_num + 1
             elif seed_type == "rand":
                 seed_num = torch.randint(0, 100000, (1,)).item()
             else:  # fixed
                 seed_num = seed
-            conditioning = self.get_cond(prompt)
+            seeds.append(seed_num)
+        conditionings = self.get_cond_batch(prompts)
+        # Prompts of one batch go through the MMDiT together, T5 context lengths must match to stack them
+        batches = []
+        for i in range(len(prompts)):
+            if (
+                batches
+                and len(batches[-1]) < batch_size
+                and conditionings[batches[-1][0]][0].shape == conditionings[i][0].shape
+            ):
+                batches[-1].append(i)
+            else:
+                batches.append([i])
+        pbar = tqdm(batches, total=len(batches), position=0, leave=True)
+        for batch in pbar:
             sampled_latent = self.do_sampling(
-                latent,
-                seed_num,
-                conditioning,
+                latent.repeat(len(batch), 1, 1, 1),
+                [seeds[i] for i in batch],
+                [conditionings[i] for i in batch],
                 neg_cond,
                 steps,
                 cfg_scale,
@@ -491,11 +1040,16 @@ class SD3Inferencer:
                 controlnet_cond,
                 denoise if init_image else 1.0,
                 skip_layer_config,
+                adaptive_cfg,
+                block_cache,
             )
-            image = self.vae_decode(sampled_latent)
-            save_path = os.path.join(out_dir, f"{i:06d}.png")
-            self.print(f"Saving to to {save_path}")
-            image.save(save_path)
+            if self.last_sampling_stats:
+                self.print(f"Sampling stats: {self.last_sampling_stats}")
+            images = self.vae_decode_images(sampled_latent)
+            for image, i in zip(images, batch):
+                save_path = os.path.join(out_dir, f"{i:06d}.png")
+                self.print(f"Saving to to {save_path}")
+                image.save(save_path)
             self.print("Done")
 
 
@@ -570,6 +1124,14 @@ def main(
     verbose=False,
     model_folder=MODEL_FOLDER,
     text_encoder_device="cpu",
+    device="auto",
+    precision=None,
+    prepare=False,
+    batch_size=1,
+    adaptive_cfg=None,
+    block_cache=None,
+    attention="auto",
+    attention_budget_mb=None,
     **kwargs,
 ):
     assert not kwargs, f"Unknown arguments: {kwargs}"
@@ -597,7 +1159,20 @@ def main(
         _cfg = cfg or controlnet_config.get("cfg", cfg)
         _sampler = sampler or controlnet_config.get("sampler", sampler)
 
-    inferencer = SD3Inferencer()
+    if prepare:
+        prepare_checkpoints(
+            model,
+            vae,
+            controlnet_ckpt,
+            model_folder,
+            ExecutionPolicy(device, precision),
+        )
+        return
+
+    set_attention_backend(
+        attention, attention_budget_mb * 2**20 if attention_budget_mb else None
+    )
+    inferencer = SD3Inferencer(ExecutionPolicy(device, precision))
 
     inferencer.load(
         model,
@@ -647,6 +1222,9 @@ def main(
         init_image,
         denoise,
         skip_layer_config,
+        batch_size,
+        adaptive_cfg,
+        block_cache,
     )
 
 
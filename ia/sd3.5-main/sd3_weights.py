@@ -0,0 +1,419 @@
+### Checkpoint reading/loading helpers: memory-mapped safetensors access and bulk weight loading
+
+import contextlib
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+import warnings
+
+import torch
+
+#################################################################################################
+### Memory-mapped safetensors reader
+#################################################################################################
+
+
+SAFETENSORS_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+if hasattr(torch, "float8_e4m3fn"):
+    SAFETENSORS_DTYPES["F8_E4M3"] = torch.float8_e4m3fn
+    SAFETENSORS_DTYPES["F8_E5M2"] = torch.float8_e5m2
+
+
+def read_safetensors_header(path):
+    """Parses only the JSON header of a safetensors file, returns (header, data_start)"""
+    with open(path, "rb") as f:
+        (header_size,) = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(header_size))
+    return header, 8 + header_size
+
+
+class SafetensorsFile:
+    """Drop-in for `safe_open(..., framework="pt", device="cpu")` that hands out tensors as
+    zero-copy views on a private (copy-on-write) memory map of the file. With `readonly` the map is
+    read-only instead, so its pages can never turn into private copies: processes mapping the same file
+    share one copy of the weights, and an in-place write to a loaded tensor faults rather than copying.
+    """
+
+    def __init__(self, path, readonly=False):
+        self.path = path
+        self.readonly = readonly
+        self.header, self.data_start = read_safetensors_header(path)
+        self._metadata = self.header.pop("__metadata__", None) or {}
+        with open(path, "rb") as f:
+            # ACCESS_COPY keeps the mapping writable for torch.frombuffer while sharing clean pages
+            # with the page cache (and any other process mapping the same file)
+            access = mmap.ACCESS_READ if readonly else mmap.ACCESS_COPY
+            self.mmap = mmap.mmap(f.fileno(), 0, access=access)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        # Loaded tensors may still be views on the mapping, so it is released by refcount only
+        self.mmap = None
+
+    def keys(self):
+        return self.header.keys()
+
+    def metadata(self):
+        return self._metadata
+
+    def dtype(self, key):
+        return SAFETENSORS_DTYPES[self.header[key]["dtype"]]
+
+    def shape(self, key):
+        return torch.Size(self.header[key]["shape"])
+
+    def nbytes(self, key):
+        begin, end = self.header[key]["data_offsets"]
+        return end - begin
+
+    def get_tensor(self, key):
+        info = self.header[key]
+        dtype = SAFETENSORS_DTYPES[info["dtype"]]
+        begin, end = info["data_offsets"]
+        shape = info["shape"]
+        if end == begin:
+            return torch.empty(shape, dtype=dtype)
+        count = (end - begin) // dtype.itemsize
+        with warnings.catch_warnings():
+            # torch warns that it cannot protect a read-only buffer from writes, which is the point of it
+            warnings.filterwarnings("ignore", "The given buffer is not writable")
+            tensor = torch.frombuffer(
+                self.mmap, dtype=dtype, count=count, offset=self.data_start + begin
+            )
+        return tensor.view(shape)
+
+    def get_slice(self, key):
+        return TensorSlice(self, key)
+
+
+class TensorSlice:
+    """Header-only handle mirroring safetensors' `get_slice`: shape and dtype without touching tensor data"""
+
+    def __init__(self, ckpt, key):
+        self.ckpt = ckpt
+        self.key = key
+
+    def get_shape(self):
+        return list(self.ckpt.header[self.key]["shape"])
+
+    def get_dtype(self):
+        return self.ckpt.header[self.key]["dtype"]
+
+
+def estimate_load_bytes(path, dtype=None, prefix=""):
+    """Resident size of the tensors under `prefix` once converted to `dtype`, from the header alone"""
+    header, _ = read_safetensors_header(path)
+    total = 0
+    for key, info in header.items():
+        if key == "__metadata__" or not key.startswith(prefix):
+            continue
+        source_dtype = SAFETENSORS_DTYPES[info["dtype"]]
+        numel = 1
+        for dim in info["shape"]:
+            numel *= dim
+        itemsize = source_dtype.itemsize
+        if dtype is not None and source_dtype != torch.int32:
+            itemsize = dtype.itemsize
+        total += numel * itemsize
+    return total
+
+
+class MemoryBudget:
+    """Counting semaphore over bytes, bounds how much weight is being loaded at the same time.
+    A reservation larger than the whole budget is admitted once nothing else is in flight.
+    """
+
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.in_use = 0
+        self.cond = threading.Condition()
+
+    def _fits(self, amount):
+        return (
+            self.limit is None or self.in_use == 0 or self.in_use + amount <= self.limit
+        )
+
+    @contextlib.contextmanager
+    def reserve(self, amount):
+        with self.cond:
+            self.cond.wait_for(lambda: self._fits(amount))
+            self.in_use += amount
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.in_use -= amount
+                self.cond.notify_all()
+
+
+#################################################################################################
+### Bulk weight loading
+#################################################################################################
+
+
+def on_device(tensor, device):
+    device = torch.device(device)
+    if tensor.device.type != device.type:
+        return False
+    return device.index is None or tensor.device.index == device.index
+
+
+def parameter_map(model):
+    """Maps every parameter/buffer name of a module to (owning module, attribute name, tensor), computed once per load"""
+    out = {}
+    for module_name, module in model.named_modules():
+        prefix = module_name + "." if module_name else ""
+        for name, tensor in module._parameters.items():
+            if tensor is not None:
+                out[prefix + name] = (module, name, tensor)
+        for name, tensor in module._buffers.items():
+            if tensor is not None:
+                out[prefix + name] = (module, name, tensor)
+    return out
+
+
+def resolve_attribute(model, path):
+    """Fallback for plain tensor attributes that are neither parameters nor buffers (eg ControlNet control_type)"""
+    *owner_path, attr = path.split(".")
+    owner = model
+    for p in owner_path:
+        owner = getattr(owner, p, None)
+        if owner is None:
+            return None
+    tensor = getattr(owner, attr, None)
+    return (owner, attr, tensor) if isinstance(tensor, torch.Tensor) else None
+
+
+def replace_tensor(owner, attr, tensor):
+    """Swaps the storage behind a parameter/buffer/attribute, used to materialize meta-device modules"""
+    if attr in owner._parameters:
+        owner._parameters[attr] = torch.nn.Parameter(tensor, requires_grad=False)
+    elif attr in owner._buffers:
+        owner._buffers[attr] = tensor
+    else:
+        setattr(owner, attr, tensor)
+
+
+def materialize_missing(model, device):
+    """Allocates (zero-filled) storage for whatever the checkpoint(s) did not provide on a meta-constructed module.
+    Returns the names that had to be filled so callers can apply non-zero defaults."""
+    missing = []
+    for name, (owner, attr, tensor) in parameter_map(model).items():
+        if tensor.is_meta:
+            replace_tensor(
+                owner,
+                attr,
+                torch.zeros(tensor.shape, dtype=tensor.dtype, device=device),
+            )
+            missing.append(name)
+    for module_name, module in model.named_modules():
+        prefix = module_name + "." if module_name else ""
+        for attr, value in list(vars(module).items()):
+            if isinstance(value, torch.Tensor) and value.is_meta:
+                setattr(module, attr, torch.zeros_like(value, device=device))
+                missing.append(prefix + attr)
+    if missing:
+        print(f"W: {len(missing)} tensors missing from checkpoint: {missing[:8]}")
+    return missing
+
+
+class LoadStats:
+    """Bookkeeping for one `load_into` call"""
+
+    def __init__(self):
+        self.tensors = 0
+        self.bytes = 0
+        self.seconds = 0.0
+
+    def __repr__(self):
+        return f"{self.tensors} tensors, {self.bytes / 2**30:.2f} GiB in {self.seconds:.1f}s"
+
+
+@torch.no_grad()
+def load_into(ckpt, model, prefix, device, dtype=None, remap=None):
+    """Applies the weights in a safetensors file to the pytorch module. The target parameter map is built once
+    and each tensor is read from the memory map and converted straight into the pre-sized parameter storage
+    (one copy, fused with the dtype conversion).
+    Modules constructed on the meta device get their storage here instead: the checkpoint tensor itself when it
+    already has the right dtype on CPU (no copy at all), or its single converted copy otherwise.
+    """
+    start = time.perf_counter()
+    stats = LoadStats()
+    params = parameter_map(model)
+    for key in ckpt.keys():
+        model_key = key
+        if remap is not None and key in remap:
+            model_key = remap[key]
+        if not model_key.startswith(prefix) or model_key.startswith("loss."):
+            continue
+        name = model_key[len(prefix) :]
+        entry = params.get(name) or resolve_attribute(model, name)
+        if entry is None:
+            print(
+                f"Skipping key '{model_key}' in safetensors file as it does not exist in python model"
+            )
+            continue
+        owner, attr, target = entry
+        try:
+            source = ckpt.get_tensor(key)
+            target_dtype = source.dtype
+            if dtype is not None and source.dtype != torch.int32:
+                target_dtype = dtype
+            target.requires_grad_(False)
+            if target.shape != source.shape:
+                print(
+                    f"W: shape mismatch for key {model_key}, {target.shape} != {source.shape}"
+                )
+            if target.is_meta:
+                replace_tensor(
+                    owner, attr, source.to(device=device, dtype=target_dtype)
+                )
+            elif (
+                target.shape == source.shape
+                and target.dtype == target_dtype
+                and on_device(target, device)
+            ):
+                target.copy_(source)
+            else:
+                target.set_(source.to(device=device, dtype=target_dtype))
+            stats.tensors += 1
+            stats.bytes += source.numel() * source.element_size()
+        except Exception as e:
+            print(f"Failed to load key '{key}' in safetensors file: {e}")
+            raise e
+    stats.seconds = time.perf_counter() - start
+    return stats
+
+
+#################################################################################################
+### Prepared checkpoints
+#################################################################################################
+
+# A prepared checkpoint holds one model component, keys already remapped and stripped of their prefix so they
+# load with prefix "", tensors already in the target dtype, the data section page aligned, and an architecture
+# descriptor in the metadata. It is still a regular safetensors file.
+
+PREPARED_FORMAT = "igia-prepared-1"
+PREPARED_ALIGNMENT = 4096
+
+DTYPE_NAMES = {v: k for k, v in SAFETENSORS_DTYPES.items()}
+PRECISION_NAMES = {
+    torch.float16: "fp16",
+    torch.bfloat16: "bf16",
+    torch.float32: "fp32",
+}
+
+
+def prepared_path(source, component, dtype):
+    """Where the prepared copy of `component` from `source` lives, in a `prepared` folder next to the source"""
+    stem = os.path.splitext(os.path.basename(source))[0]
+    folder = os.path.join(os.path.dirname(os.path.abspath(source)), "prepared")
+    return os.path.join(
+        folder, f"{stem}.{component}.{PRECISION_NAMES[dtype]}.safetensors"
+    )
+
+
+def is_fresh(prepared, *sources):
+    """A prepared file is usable when it exists and is newer than every file it was derived from"""
+    if not os.path.exists(prepared):
+        return False
+    mtime = os.path.getmtime(prepared)
+    return all(os.path.getmtime(source) <= mtime for source in sources)
+
+
+def read_descriptor(ckpt):
+    descriptor = ckpt.metadata().get("descriptor")
+    return json.loads(descriptor) if descriptor else None
+
+
+@torch.no_grad()
+def write_prepared(
+    ckpt, out_path, component, prefix="", dtype=None, remap=None, descriptor=None
+):
+    """Writes the tensors of `ckpt` that `load_into(ckpt, ..., prefix, dtype=dtype, remap=remap)` would load as a
+    prepared checkpoint. Tensors are converted and written one at a time. Only the start of the data section is
+    page aligned: safetensors requires contiguous offsets, so tensors are not padded individually. Ordering them
+    by element size, widest first, keeps every offset a multiple of the tensor's own element size.
+    """
+    entries = []
+    for key in ckpt.keys():
+        model_key = remap.get(key, key) if remap is not None else key
+        if not model_key.startswith(prefix) or model_key.startswith("loss."):
+            continue
+        source_dtype = ckpt.dtype(key)
+        target_dtype = source_dtype
+        if dtype is not None and source_dtype != torch.int32:
+            target_dtype = dtype
+        shape = list(ckpt.shape(key))
+        numel = 1
+        for dim in shape:
+            numel *= dim
+        entries.append(
+            (
+                model_key[len(prefix) :],
+                key,
+                shape,
+                target_dtype,
+                numel * target_dtype.itemsize,
+            )
+        )
+    entries.sort(key=lambda e: (e[3].itemsize, e[4]), reverse=True)
+
+    header = {}
+    offset = 0
+    for name, _, shape, target_dtype, nbytes in entries:
+        header[name] = {
+            "dtype": DTYPE_NAMES[target_dtype],
+            "shape": shape,
+            "data_offsets": [offset, offset + nbytes],
+        }
+        offset += nbytes
+    header["__metadata__"] = {
+        "format": PREPARED_FORMAT,
+        "component": component,
+        "source": os.path.basename(ckpt.path),
+        "descriptor": json.dumps(descriptor) if descriptor is not None else "",
+    }
+    header_bytes = json.dumps(header, separators=(",", ":")).encode("utf-8")
+    # Pad the header with spaces (allowed by the format) so the data section starts on a page boundary
+    padding = -(8 + len(header_bytes)) % PREPARED_ALIGNMENT
+    header_bytes += b" " * padding
+
+    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+    tmp_path = out_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(struct.pack("<Q", len(header_bytes)))
+        f.write(header_bytes)
+        for name, key, _, target_dtype, _ in entries:
+            tensor = ckpt.get_tensor(key).to(dtype=target_dtype).contiguous()
+            f.write(tensor.reshape(-1).view(torch.uint8).numpy())
+    os.replace(tmp_path, out_path)
+    return out_path
+
+
+def open_checkpoint(
+    source, component, dtype, prefix="", use_prepared=True, readonly=False
+):
+    """Opens the fresh prepared copy of a component if there is one, the source checkpoint otherwise.
+    Returns (file, prefix to load with, whether it is prepared). `readonly` maps it read-only, see
+    SafetensorsFile."""
+    prepared = prepared_path(source, component, dtype)
+    if use_prepared and is_fresh(prepared, source):
+        return SafetensorsFile(prepared, readonly), "", True
+    return SafetensorsFile(source, readonly), prefix, False
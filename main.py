@@ -9,7 +9,8 @@ import json
 from datetime import datetime
 from PIL import Image, ImageTk
 
-from src.sd3_generator import SD3ImageGenerator
+from src.sd3_generator import SD3ImageGenerator, CancellationToken
+from src.generation_client import GenerationClient
 from src.prompt_manager import PromptManager
 
 
@@ -25,6 +26,7 @@ class IGIAApp:
         self.prompt_manager = PromptManager()
         self.image_generator = None
         self.is_generating = False
+        self.cancel_token = None
         
         # Variables
         self.selected_category = tk.StringVar(value="personajes")
@@ -159,6 +161,10 @@ class IGIAApp:
                                      command=self.generate_images)
         self.gen_button.pack(fill=tk.X, ipady=10)
         
+        self.cancel_button = ttk.Button(gen_button_frame, text="⏹ Cancelar",
+                                        command=self.cancel_generation, state=tk.DISABLED)
+        self.cancel_button.pack(fill=tk.X, pady=(5, 0))
+        
         # ===== PANEL DERECHO =====
         
         # Preview de prompt final
@@ -173,6 +179,15 @@ class IGIAApp:
         ttk.Button(prompt_preview_frame, text="🔄 Actualizar Preview", 
                   command=self.update_prompt_preview).pack(fill=tk.X, pady=5)
         
+        # Preview del sampling en curso
+        sampling_frame = ttk.LabelFrame(right_frame, text="🖼 Preview del Sampling", padding=10)
+        sampling_frame.pack(fill=tk.X, padx=5, pady=5)
+        
+        self.sampling_preview = ttk.Label(sampling_frame, text="Sin generación en curso",
+                                          anchor=tk.CENTER, compound=tk.TOP)
+        self.sampling_preview.pack(fill=tk.X)
+        self.sampling_preview_image = None  # Referencia para que Tk no libere la imagen
+        
         # Log de generación
         log_frame = ttk.LabelFrame(right_frame, text="📋 Log de Generación", padding=10)
         log_frame.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
@@ -229,6 +244,17 @@ class IGIAApp:
             return
         
         def load_thread():
+            # Con IGIA_SERVER se usa el modelo ya cargado en el servidor local de generación
+            server = os.environ.get("IGIA_SERVER")
+            if server:
+                self.log(f"🔄 Conectando al servidor de generación {server}...")
+                self.image_generator = GenerationClient(server)
+                if self.image_generator.load_model(callback=self.log):
+                    self.model_status.config(text="✅ SD3.5 Large (servidor)", foreground="green")
+                else:
+                    self.model_status.config(text="❌ Error", foreground="red")
+                return
+            
             self.log("🔄 Iniciando carga del modelo SD3.5...")
             self.model_status.config(text="Cargando...", foreground="orange")
             
@@ -392,11 +418,16 @@ class IGIAApp:
         
         # Crear directorio de salida
         output_dir = os.path.join("output", output_name)
+        batch_size = self.batch_size.get()
         
         # Generar en thread separado
+        token = CancellationToken()
+        self.cancel_token = token
+        
         def generate_thread():
             self.is_generating = True
             self.gen_button.config(state=tk.DISABLED)
+            self.cancel_button.config(state=tk.NORMAL)
             self.progress_var.set(0)
             
             try:
@@ -405,16 +436,27 @@ class IGIAApp:
                     self.progress_var.set(progress)
                     self.log(f"[{current}/{total}] {message}")
                 
+                def preview_callback(step, steps, images):
+                    # Tk solo puede tocarse desde su propio hilo
+                    self.root.after(0, self.show_sampling_preview, step, steps, images)
+                
                 self.log(f"🎨 Iniciando generación de {len(prompts_list)} imagen(es)...")
                 self.log(f"📁 Guardando en: {output_dir}")
                 
+                # "Cantidad" también fija cuántas imágenes comparten cada sampling
                 generated = self.image_generator.generate_batch(
                     prompts_list, base_params, output_dir, 
-                    output_name, progress_callback
+                    output_name, progress_callback,
+                    batch_size=batch_size,
+                    preview_callback=preview_callback,
+                    token=token
                 )
                 
-                self.log(f"✅ Generación completada: {len(generated)} imágenes creadas")
-                messagebox.showinfo("Éxito", f"Se generaron {len(generated)} imágenes")
+                if token.cancelled.is_set():
+                    self.log(f"⏹ Generación cancelada: {len(generated)} imágenes guardadas")
+                else:
+                    self.log(f"✅ Generación completada: {len(generated)} imágenes creadas")
+                    messagebox.showinfo("Éxito", f"Se generaron {len(generated)} imágenes")
                 
             except Exception as e:
                 self.log(f"❌ Error durante la generación: {str(e)}")
@@ -422,12 +464,30 @@ class IGIAApp:
             
             finally:
                 self.is_generating = False
+                self.cancel_token = None
                 self.gen_button.config(state=tk.NORMAL)
+                self.cancel_button.config(state=tk.DISABLED)
                 self.progress_var.set(0)
         
         thread = threading.Thread(target=generate_thread, daemon=True)
         thread.start()
     
+    def cancel_generation(self):
+        """Cancela la generación en curso al terminar el paso de sampling actual"""
+        if self.cancel_token is not None:
+            self.cancel_token.cancel()
+            self.cancel_button.config(state=tk.DISABLED)
+            self.log("⏹ Cancelando generación...")
+    
+    def show_sampling_preview(self, step, steps, images, size=256):
+        """Muestra la preview aproximada de la primera imagen del lote en sampling"""
+        preview = images[0]
+        height = max(1, size * preview.height // preview.width)
+        preview = preview.resize((size, height), Image.NEAREST)
+        self.sampling_preview_image = ImageTk.PhotoImage(preview)
+        self.sampling_preview.config(image=self.sampling_preview_image,
+                                     text=f"Paso {step}/{steps}")
+    
     def log(self, message):
         """Añade mensaje al log"""
         self.log_text.insert(tk.END, f"[{datetime.now().strftime('%H:%M:%S')}] {message}\n")
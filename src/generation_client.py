@@ -0,0 +1,245 @@
+"""
+Cliente ligero del servidor local de generación (src/generation_server.py)
+Ofrece la misma interfaz que SD3ImageGenerator sin cargar el modelo ni importar torch
+"""
+import base64
+import io
+import json
+import os
+import socket
+import http.client
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+from PIL import Image
+
+
+DEFAULT_ADDRESS = "http://127.0.0.1:7860"
+
+
+class RequestCancelled(Exception):
+    """La petición se canceló desde el cliente"""
+
+
+class RemoteGenerationError(Exception):
+    """El servidor no pudo completar la generación"""
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """Conexión HTTP sobre un socket Unix"""
+    
+    def __init__(self, socket_path, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+    
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class GenerationClient:
+    """Generador remoto: envía las peticiones al servidor local que mantiene el modelo cargado"""
+    
+    def __init__(self, address=DEFAULT_ADDRESS, timeout=None):
+        """
+        Args:
+            address: 'http://host:puerto' o 'unix:/ruta/al/socket'
+            timeout: Timeout de las conexiones en segundos (None = sin límite)
+        """
+        self.address = address
+        self.timeout = timeout
+        self.is_loaded = False
+    
+    def _connect(self):
+        """Abre una conexión nueva con el servidor"""
+        if self.address.startswith("unix:"):
+            return UnixHTTPConnection(self.address[len("unix:"):], self.timeout)
+        url = urlparse(self.address)
+        return http.client.HTTPConnection(url.hostname, url.port or 80, timeout=self.timeout)
+    
+    def health(self):
+        """
+        Consulta el estado del servidor
+        
+        Returns:
+            dict: Estado devuelto por /health
+        """
+        connection = self._connect()
+        try:
+            connection.request("GET", "/health")
+            return json.loads(connection.getresponse().read())
+        finally:
+            connection.close()
+    
+    def load_model(self, callback=None, **kwargs):
+        """
+        Comprueba que el servidor está disponible; el modelo ya está cargado en él
+        
+        Args:
+            callback: Función para reportar progreso
+        
+        Returns:
+            bool: True si el servidor responde con el modelo cargado
+        """
+        try:
+            status = self.health()
+        except OSError as e:
+            if callback:
+                callback(f"✗ No se pudo conectar al servidor {self.address}: {str(e)}")
+            return False
+        
+        self.is_loaded = bool(status.get("loaded"))
+        if callback:
+            callback(f"✓ Conectado al servidor {self.address} ({status.get('device')}, "
+                     f"{status.get('precision')})")
+        return self.is_loaded
+    
+    def stream(self, request, token=None):
+        """
+        Envía una petición a /generate e itera los eventos que devuelve
+        
+        Args:
+            request: Dict con 'prompt' y los parámetros de generación
+            token: Objeto con un Event `cancelled` (p. ej. CancellationToken); al activarse se
+                   cierra la conexión, lo que cancela la generación en el servidor
+        
+        Raises:
+            RequestCancelled: Si se cancela con el token
+            RemoteGenerationError: Si el servidor rechaza la petición
+        """
+        connection = self._connect()
+        try:
+            connection.request("POST", "/generate", body=json.dumps(request),
+                               headers={"Content-Type": "application/json"})
+            response = connection.getresponse()
+            if response.status != 200:
+                raise RemoteGenerationError(json.loads(response.read()).get("error"))
+            for line in response:
+                if token is not None and token.cancelled.is_set():
+                    raise RequestCancelled()
+                yield json.loads(line)
+        finally:
+            connection.close()
+    
+    def generate_image(self, prompt, negative_prompt="", width=1024, height=1024,
+                      num_inference_steps=40, guidance_scale=4.5, seed=-1,
+                      preview_callback=None, step_callback=None, token=None):
+        """
+        Genera una imagen en el servidor
+        
+        Args:
+            prompt: Texto descriptivo de la imagen
+            negative_prompt: No usado en SD3.5 (se guarda en la metadata)
+            width: Ancho de la imagen (múltiplo de 64)
+            height: Alto de la imagen (múltiplo de 64)
+            num_inference_steps: Pasos de inferencia
+            guidance_scale: CFG scale
+            seed: Semilla para reproducibilidad (-1 = aleatorio)
+            preview_callback: Recibe (paso, total_pasos, [PIL.Image]) con previews aproximadas
+            step_callback: Recibe (paso, total_pasos) tras cada paso de sampling
+            token: CancellationToken para cancelar la petición
+        
+        Returns:
+            tuple: (PIL.Image, dict) - Imagen generada y metadata
+        """
+        request = {
+            "prompt": prompt,
+            "negative_prompt": negative_prompt,
+            "width": width,
+            "height": height,
+            "num_inference_steps": num_inference_steps,
+            "guidance_scale": guidance_scale,
+            "seed": seed,
+            "preview": preview_callback is not None,
+        }
+        for event in self.stream(request, token):
+            kind = event["event"]
+            if kind == "step" and step_callback:
+                step_callback(event["step"], event["steps"])
+            elif kind == "preview" and preview_callback:
+                preview_callback(event["step"], event["steps"], [decode_png(event["image"])])
+            elif kind == "done":
+                return decode_png(event["image"]), event["metadata"]
+            elif kind == "cancelled":
+                raise RequestCancelled()
+            elif kind == "error":
+                raise RemoteGenerationError(event["message"])
+        raise RemoteGenerationError("El servidor cerró la conexión sin terminar la imagen")
+    
+    def generate_batch(self, prompts_list, base_params, output_dir,
+                      name_prefix="sprite", callback=None, encode_window=8, batch_size=1,
+                      preview_callback=None, token=None):
+        """
+        Genera múltiples imágenes en el servidor con la misma interfaz que
+        SD3ImageGenerator.generate_batch
+        
+        Se mantienen batch_size peticiones en vuelo a la vez para que el servidor las
+        agrupe en los mismos forwards; encode_window lo decide el servidor.
+        
+        Returns:
+            List[str]: Rutas a las imágenes generadas
+        """
+        os.makedirs(output_dir, exist_ok=True)
+        total = len(prompts_list)
+        
+        def generate(idx, prompt_data):
+            if token is not None and token.cancelled.is_set():
+                return None
+            if isinstance(prompt_data, dict):
+                prompt = prompt_data.get("prompt", "")
+                params = {**base_params, **prompt_data.get("params", {})}
+            else:
+                prompt = str(prompt_data)
+                params = base_params
+            
+            try:
+                if callback:
+                    callback(idx + 1, total, f"Generando: {prompt[:50]}...")
+                image, metadata = self.generate_image(
+                    prompt,
+                    negative_prompt=params.get("negative_prompt", ""),
+                    width=params.get("width", 1024),
+                    height=params.get("height", 1024),
+                    num_inference_steps=params.get("num_inference_steps", 40),
+                    guidance_scale=params.get("guidance_scale", 4.5),
+                    seed=params.get("seed", -1),
+                    preview_callback=preview_callback,
+                    token=token
+                )
+                
+                filename = f"{name_prefix}_{idx+1:03d}.png"
+                filepath = os.path.join(output_dir, filename)
+                image.save(filepath)
+                metadata_path = os.path.join(output_dir, f"{name_prefix}_{idx+1:03d}_metadata.json")
+                with open(metadata_path, 'w', encoding='utf-8') as f:
+                    json.dump(metadata, f, indent=2, ensure_ascii=False)
+                
+                if callback:
+                    callback(idx + 1, total, f"✓ Guardado: {filename}")
+                return filepath
+            
+            except RequestCancelled:
+                return None
+            except Exception as e:
+                if callback:
+                    callback(idx + 1, total, f"✗ Error: {str(e)}")
+                return None
+        
+        with ThreadPoolExecutor(max_workers=max(1, batch_size)) as pool:
+            results = list(pool.map(generate, range(total), prompts_list))
+        
+        generated_files = [path for path in results if path is not None]
+        if token is not None and token.cancelled.is_set() and callback:
+            callback(len(generated_files), total, "⏹ Generación cancelada")
+        return generated_files
+    
+    def unload_model(self):
+        """Desconecta el cliente; el modelo sigue cargado en el servidor"""
+        self.is_loaded = False
+
+
+def decode_png(data):
+    """Decodifica una imagen PNG en base64 de un evento del servidor"""
+    image = Image.open(io.BytesIO(base64.b64decode(data)))
+    image.load()
+    return image
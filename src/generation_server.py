@@ -0,0 +1,486 @@
+"""
+Servidor local de generación para IGIA
+Mantiene un único SD3Inferencer cargado y lo comparte entre la interfaz y los scripts
+por HTTP en localhost o en un socket Unix
+
+Uso:
+    python -m src.generation_server --port 7860
+    python -m src.generation_server --socket /tmp/igia.sock
+"""
+import argparse
+import base64
+import io
+import ipaddress
+import json
+import os
+import queue
+import socket
+import socketserver
+import stat
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import torch
+from PIL import Image
+
+from src.sd3_generator import (
+    CONFIG_PATH, CancellationToken, GenerationCancelled, SD3ImageGenerator
+)
+from sd3_impls import SAMPLER_STEPS, LatentPreviewer
+
+
+# Parámetros aceptados por /generate y su valor por defecto
+REQUEST_DEFAULTS = {
+    "negative_prompt": "",
+    "width": 1024,
+    "height": 1024,
+    "num_inference_steps": 40,
+    "guidance_scale": 4.5,
+    "seed": -1,
+    "sampler": None,
+}
+
+
+def encode_png(image):
+    """
+    Codifica una imagen en PNG base64 para enviarla dentro de un evento JSON
+    
+    Args:
+        image: PIL.Image o array uint8 (H, W, 3)
+    
+    Returns:
+        str: PNG en base64
+    """
+    if not isinstance(image, Image.Image):
+        image = Image.fromarray(image)
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return base64.b64encode(buffer.getvalue()).decode("ascii")
+
+
+class GenerationTicket:
+    """Una generación en curso; todas las peticiones idénticas se suscriben al mismo ticket"""
+    
+    def __init__(self, key, request):
+        self.key = key
+        self.request = request
+        self.token = CancellationToken()
+        self.events = []
+        self.finished = False
+        self.subscribers = 0
+        self.condition = threading.Condition()
+    
+    def publish(self, event, final=False):
+        """Añade un evento para todos los suscriptores; final cierra el ticket"""
+        with self.condition:
+            self.events.append(event)
+            self.finished = self.finished or final
+            self.condition.notify_all()
+    
+    def stream(self):
+        """Itera los eventos desde el primero (los que se unen tarde reciben el historial)"""
+        index = 0
+        while True:
+            with self.condition:
+                while index >= len(self.events) and not self.finished:
+                    self.condition.wait()
+                events = self.events[index:]
+                finished = self.finished
+            index += len(events)
+            yield from events
+            if finished and index >= len(self.events):
+                return
+
+
+class GenerationService:
+    """
+    Cola de generación sobre un SD3ImageGenerator ya cargado
+    
+    Las peticiones idénticas en curso (misma semilla fija y parámetros) se sirven con una
+    sola generación. Las demás se codifican por ventanas en forwards batched y se samplean
+    en el ContinuousBatchScheduler, que junta en cada forward las que son compatibles.
+    """
+    
+    def __init__(self, generator, max_batch=4, encode_window=8, gather=0.05,
+                 preview_every=None):
+        """
+        Args:
+            generator: SD3ImageGenerator con el modelo cargado
+            max_batch: Máximo de imágenes por forward del MMDiT
+            encode_window: Máximo de prompts codificados juntos
+            gather: Segundos que se esperan peticiones para codificarlas en la misma ventana
+            preview_every: Cada cuántos pasos se manda una preview (None = default_config)
+        """
+        self.generator = generator
+        self.inferencer = generator.inferencer
+        self.scheduler = self.inferencer.get_scheduler(max_batch)
+        self.encode_window = max(1, encode_window)
+        self.gather = gather
+        self.preview_every = preview_every or generator.default_config["preview_every"]
+        
+        self.pending = queue.Queue()
+        self.inflight = {}
+        self.lock = threading.Lock()
+        self.decode_lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.stats = {"requests": 0, "coalesced": 0, "completed": 0, "cancelled": 0, "failed": 0}
+        
+        self.threads = [
+            threading.Thread(target=self.scheduler.serve, daemon=True),
+            threading.Thread(target=self._admit_loop, daemon=True),
+        ]
+        for thread in self.threads:
+            thread.start()
+    
+    def normalize(self, request):
+        """
+        Completa una petición con los valores por defecto y la valida
+        
+        Raises:
+            ValueError: Si falta el prompt o algún parámetro no es válido
+        """
+        if not isinstance(request, dict) or not isinstance(request.get("prompt"), str):
+            raise ValueError("La petición necesita un 'prompt' de texto")
+        unknown = set(request) - set(REQUEST_DEFAULTS) - {"prompt", "preview"}
+        if unknown:
+            raise ValueError(f"Parámetros desconocidos: {', '.join(sorted(unknown))}")
+        
+        normalized = {**REQUEST_DEFAULTS, **request}
+        normalized["sampler"] = normalized["sampler"] or self.generator.default_config["sampler"]
+        try:
+            for name in ("width", "height", "num_inference_steps", "seed"):
+                normalized[name] = int(normalized[name])
+            normalized["guidance_scale"] = float(normalized["guidance_scale"])
+        except (TypeError, ValueError):
+            raise ValueError("width, height, num_inference_steps, seed y guidance_scale deben ser numéricos")
+        if normalized["width"] % 64 or normalized["height"] % 64:
+            raise ValueError("width y height deben ser múltiplos de 64")
+        if normalized["num_inference_steps"] < 1:
+            raise ValueError("num_inference_steps debe ser al menos 1")
+        if normalized["sampler"] not in SAMPLER_STEPS:
+            raise ValueError(f"sampler debe ser uno de: {', '.join(SAMPLER_STEPS)}")
+        normalized["preview"] = bool(normalized.get("preview", False))
+        return normalized
+    
+    def submit(self, request):
+        """
+        Pone en cola una petición o la une a una idéntica que ya esté en curso
+        
+        Args:
+            request: Dict con 'prompt' y opcionalmente los parámetros de REQUEST_DEFAULTS y 'preview'
+        
+        Returns:
+            GenerationTicket: Ticket ya suscrito; llamar a release() al dejar de leerlo
+        """
+        request = self.normalize(request)
+        with self.lock:
+            self.stats["requests"] += 1
+            # Con semilla aleatoria dos peticiones iguales no deben dar la misma imagen
+            if request["seed"] < 0:
+                request["seed"] = torch.randint(0, 100000, (1,)).item()
+                key = None
+            else:
+                key = json.dumps({k: v for k, v in request.items() if k != "preview"}, sort_keys=True)
+            
+            ticket = self.inflight.get(key) if key is not None else None
+            if ticket is not None:
+                self.stats["coalesced"] += 1
+            else:
+                ticket = GenerationTicket(key, request)
+                if key is not None:
+                    self.inflight[key] = ticket
+                self.pending.put(ticket)
+                ticket.publish({"event": "queued", "seed": request["seed"]})
+            ticket.subscribers += 1
+        return ticket
+    
+    def release(self, ticket):
+        """Quita un suscriptor; si era el último y no ha terminado, se cancela la generación"""
+        with self.lock:
+            ticket.subscribers -= 1
+            if ticket.subscribers > 0 or ticket.finished:
+                return
+            ticket.token.cancel()
+            if self.inflight.get(ticket.key) is ticket:
+                del self.inflight[ticket.key]
+    
+    def status(self):
+        """Estado del servidor para /health"""
+        with self.lock:
+            return {
+                "loaded": self.generator.is_loaded,
+                "device": str(self.generator.policy.device),
+                "precision": str(self.generator.policy.dtype).replace("torch.", ""),
+                "queued": self.pending.qsize(),
+                "inflight": len(self.inflight),
+                "sampling": len(self.scheduler.jobs),
+                "occupancy": self.scheduler.occupancy,
+                **self.stats,
+            }
+    
+    def close(self):
+        """Detiene los hilos del servicio"""
+        self.stopped.set()
+        self.scheduler.stop()
+        for thread in self.threads:
+            thread.join(timeout=5)
+    
+    def _next_window(self):
+        """Espera una petición y recoge las que lleguen durante `gather` segundos"""
+        try:
+            window = [self.pending.get(timeout=0.1)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.gather
+        while len(window) < self.encode_window:
+            try:
+                window.append(self.pending.get(timeout=max(0.0, deadline - time.monotonic())))
+            except queue.Empty:
+                break
+        return window
+    
+    def _admit_loop(self):
+        """Codifica cada ventana de peticiones en un forward por encoder y las manda al scheduler"""
+        while not self.stopped.is_set():
+            window = []
+            for ticket in self._next_window():
+                if ticket.token.cancelled.is_set():
+                    self._close(ticket, {"event": "cancelled"}, "cancelled")
+                else:
+                    window.append(ticket)
+            if not window:
+                continue
+            
+            prompts = [""] + [ticket.request["prompt"] for ticket in window]
+            try:
+                conds = dict(zip(prompts, self.inferencer.get_cond_batch(prompts)))
+            except Exception as e:
+                for ticket in window:
+                    self._close(ticket, {"event": "error", "message": str(e)}, "failed")
+                continue
+            
+            for ticket in window:
+                try:
+                    self._start(ticket, conds[ticket.request["prompt"]], conds[""])
+                except Exception as e:
+                    self._close(ticket, {"event": "error", "message": str(e)}, "failed")
+    
+    def _start(self, ticket, conditioning, neg_cond):
+        """Encola el sampling de un ticket y lanza el hilo que lo decodifica al terminar"""
+        request = ticket.request
+        steps = request["num_inference_steps"]
+        previewer = None
+        if request["preview"]:
+            def on_preview(step, steps, previews):
+                ticket.publish({
+                    "event": "preview", "step": step, "steps": steps,
+                    "image": encode_png(previews[0])
+                })
+            previewer = LatentPreviewer(on_preview, steps, self.preview_every)
+        
+        def on_step(info):
+            ticket.publish({"event": "step", "step": info["i"] + 1, "steps": steps})
+            if previewer is not None:
+                previewer(info)
+        
+        latent = self.inferencer.get_empty_latent(
+            1, request["width"], request["height"], request["seed"], "cpu"
+        )
+        jobs = self.inferencer.submit_sampling(
+            latent, request["seed"], conditioning, neg_cond, steps,
+            request["guidance_scale"], request["sampler"],
+            scheduler=self.scheduler, callback=on_step, token=ticket.token
+        )
+        threading.Thread(target=self._finish, args=(ticket, jobs), daemon=True).start()
+    
+    def _finish(self, ticket, jobs):
+        """Espera el sampling de un ticket, lo decodifica y publica la imagen"""
+        request = ticket.request
+        try:
+            sampled_latent = self.inferencer.collect_sampling(jobs)
+            with self.decode_lock:
+                image = self.inferencer.vae_decode_images(sampled_latent)[0]
+        except GenerationCancelled:
+            self._close(ticket, {"event": "cancelled"}, "cancelled")
+            return
+        except Exception as e:
+            self._close(ticket, {"event": "error", "message": str(e)}, "failed")
+            return
+        
+        metadata = {
+            "prompt": request["prompt"],
+            "negative_prompt": request["negative_prompt"],  # Guardado para compatibilidad
+            "width": request["width"],
+            "height": request["height"],
+            "steps": request["num_inference_steps"],
+            "guidance_scale": request["guidance_scale"],
+            "seed": request["seed"],
+            "model": "SD3.5 Large",
+            "sampler": request["sampler"],
+            "device": str(self.generator.policy.device),
+            "precision": str(self.generator.policy.dtype).replace("torch.", ""),
+            "occupancy": self.scheduler.occupancy,
+            "timestamp": datetime.now().isoformat()
+        }
+        self._close(ticket, {"event": "done", "image": encode_png(image), "metadata": metadata},
+                    "completed")
+    
+    def _close(self, ticket, event, outcome):
+        """Publica el evento final de un ticket y lo saca de las peticiones en curso"""
+        with self.lock:
+            self.stats[outcome] += 1
+            if self.inflight.get(ticket.key) is ticket:
+                del self.inflight[ticket.key]
+        ticket.publish(event, final=True)
+
+
+class GenerationRequestHandler(BaseHTTPRequestHandler):
+    """
+    GET  /health    Estado del servidor
+    POST /generate  Petición JSON; responde con eventos JSON, uno por línea, hasta
+                    'done', 'error' o 'cancelled'. Cerrar la conexión cancela la
+                    generación si nadie más la espera.
+    """
+    
+    server_version = "IGIA/1.0"
+    
+    def address_string(self):
+        # En un socket Unix no hay dirección del cliente
+        return self.client_address[0] if self.client_address else "local"
+    
+    def do_GET(self):
+        if self.path != "/health":
+            self._send_json(404, {"error": "No encontrado"})
+            return
+        self._send_json(200, self.server.service.status())
+    
+    def do_POST(self):
+        if self.path != "/generate":
+            self._send_json(404, {"error": "No encontrado"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            ticket = self.server.service.submit(json.loads(self.rfile.read(length) or b"null"))
+        except ValueError as e:
+            self._send_json(400, {"error": str(e)})
+            return
+        
+        try:
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.send_header("Cache-Control", "no-cache")
+            self.end_headers()
+            for event in ticket.stream():
+                self.wfile.write(json.dumps(event).encode("utf-8") + b"\n")
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            self.server.service.release(ticket)
+    
+    def _send_json(self, code, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Servidor HTTP sobre un socket Unix, un hilo por conexión"""
+    
+    daemon_threads = True
+
+
+def create_server(service, host="127.0.0.1", port=7860, socket_path=None):
+    """
+    Crea el servidor HTTP del servicio, en localhost o en un socket Unix
+    
+    Args:
+        service: GenerationService a exponer
+        host: Dirección de escucha; solo se aceptan direcciones locales
+        port: Puerto TCP
+        socket_path: Ruta del socket Unix (si se indica, se ignoran host y port)
+    
+    Returns:
+        socketserver.BaseServer: Servidor listo para serve_forever()
+    """
+    if socket_path:
+        remove_socket(socket_path)
+        server = UnixHTTPServer(socket_path, GenerationRequestHandler)
+    else:
+        # Sin autenticación: el servidor nunca se expone fuera de la máquina
+        if not ipaddress.ip_address(socket.gethostbyname(host)).is_loopback:
+            raise ValueError(f"El servidor solo escucha en direcciones locales, no en {host}")
+        server = ThreadingHTTPServer((host, port), GenerationRequestHandler)
+        server.daemon_threads = True
+    server.service = service
+    return server
+
+
+def remove_socket(socket_path):
+    """
+    Borra un socket Unix que haya quedado de una ejecución anterior
+    
+    Raises:
+        FileExistsError: Si en la ruta hay algo que no es un socket, para no borrar datos
+    """
+    try:
+        mode = os.lstat(socket_path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise FileExistsError(f"{socket_path} existe y no es un socket Unix")
+    os.remove(socket_path)
+
+
+def default_model_folder(config_path=CONFIG_PATH):
+    """Carpeta del modelo según model_config.json, como en la interfaz"""
+    try:
+        with open(config_path, 'r') as f:
+            return json.load(f)["model_config"]["model_folder"]
+    except (OSError, ValueError, KeyError):
+        return "ia/sd3.5-main/models"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Servidor local de generación de IGIA")
+    parser.add_argument("--model-folder", default=None, help="Carpeta con los modelos SD3.5")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7860)
+    parser.add_argument("--socket", default=None, help="Escuchar en un socket Unix")
+    parser.add_argument("--device", default="auto")
+    parser.add_argument("--precision", default=None)
+    parser.add_argument("--max-batch", type=int, default=4,
+                        help="Máximo de imágenes por forward del MMDiT")
+    parser.add_argument("--encode-window", type=int, default=8,
+                        help="Máximo de prompts codificados juntos")
+    args = parser.parse_args()
+    
+    generator = SD3ImageGenerator(
+        model_folder=args.model_folder or default_model_folder(),
+        device=args.device,
+        precision=args.precision
+    )
+    if not generator.load_model(callback=print):
+        raise SystemExit(1)
+    
+    service = GenerationService(generator, args.max_batch, args.encode_window)
+    server = create_server(service, args.host, args.port, args.socket)
+    print(f"Servidor de generación en {args.socket or f'http://{args.host}:{args.port}'}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+        if args.socket:
+            remove_socket(args.socket)
+
+
+if __name__ == "__main__":
+    main()
@@ -6,20 +6,44 @@ import os
 import sys
 import json
 import torch
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from PIL import Image
 
 # Agregar el directorio del modelo SD3.5 al path
 SD3_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), "ia", "sd3.5-main")
 sys.path.insert(0, SD3_PATH)
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), "config", "model_config.json")
 
-from sd3_infer import SD3Inferencer
+from sd3_infer import SD3Inferencer, prepare_checkpoints
+from sd3_impls import (
+    CancellationToken, ExecutionPolicy, GenerationCancelled, GenerationPreempted
+)
+from other_impls import set_attention_backend
+
+
+def load_resolution_presets(config_path=CONFIG_PATH):
+    """
+    Lee las resoluciones predefinidas de la configuración del modelo
+    
+    Args:
+        config_path: Ruta de model_config.json
+    
+    Returns:
+        list: Tuplas (ancho, alto); vacía si no hay configuración
+    """
+    try:
+        with open(config_path, 'r') as f:
+            resolutions = json.load(f)["model_config"].get("resolutions", {})
+    except (OSError, ValueError, KeyError):
+        return []
+    return [(r["width"], r["height"]) for r in resolutions.values()]
 
 
 class SD3ImageGenerator:
     """Generador de imágenes con Stable Diffusion 3.5"""
     
-    def __init__(self, model_folder="models", device="auto"):
+    def __init__(self, model_folder="models", device="auto", precision=None):
         """
         Inicializa el generador SD3.5
         
@@ -28,9 +52,11 @@ class SD3ImageGenerator:
                          Debe contener: clip_g.safetensors, clip_l.safetensors, 
                          t5xxl.safetensors, sd3.5_large.safetensors
             device: 'cuda', 'cpu' o 'auto'
+            precision: 'fp16', 'bf16', 'fp32' o None (fp16 en CUDA, bf16/fp32 en CPU)
         """
         self.model_folder = model_folder
         self.device = self._get_device(device)
+        self.policy = ExecutionPolicy(self.device, precision)
         self.inferencer = None
         self.is_loaded = False
         
@@ -40,6 +66,9 @@ class SD3ImageGenerator:
             "steps": 40,
             "cfg": 4.5,
             "sampler": "dpmpp_2m",
+            "adaptive_cfg": None,  # 'truncate', 'alternate', 'converge' o dict de configuración
+            "block_cache": None,  # True o dict con head/tail/interval/threshold/warmup
+            "preview_every": 1,  # Cada cuántos pasos se emite una preview del latent
             "width": 1024,
             "height": 1024
         }
@@ -50,12 +79,45 @@ class SD3ImageGenerator:
             return "cuda" if torch.cuda.is_available() else "cpu"
         return device
     
-    def load_model(self, callback=None):
+    def _model_paths(self):
+        """Rutas del MMDiT y del VAE (None si el VAE va dentro del archivo del modelo)"""
+        model_path = os.path.join(self.model_folder, "sd3.5_large.safetensors")
+        vae_path = os.path.join(self.model_folder, "sd3_vae.safetensors")
+        
+        # Si no existe VAE separado, usar el mismo archivo del modelo
+        if not os.path.exists(vae_path):
+            vae_path = None
+        return model_path, vae_path
+    
+    def prepare_weights(self):
+        """
+        Convierte una sola vez los checkpoints en archivos preparados (ya en la precisión de
+        ejecución), que load_model mapea en memoria sin copiarlos
+        """
+        model_path, vae_path = self._model_paths()
+        prepare_checkpoints(
+            model=model_path,
+            vae=vae_path,
+            model_folder=self.model_folder,
+            policy=self.policy
+        )
+    
+    def load_model(self, callback=None, concurrent=True, memory_budget_gb=None,
+                   cond_cache_dir="auto", attention="auto", attention_budget_mb=None,
+                   shared_weights=False):
         """
         Carga el modelo SD3.5
         
         Args:
-            callback: Función para reportar progreso
+            callback: Función para reportar progreso (recibe un mensaje por componente)
+            concurrent: Cargar encoders, MMDiT y VAE en paralelo
+            memory_budget_gb: Límite de GB cargándose a la vez (None = sin límite)
+            cond_cache_dir: Carpeta de la caché en disco de condicionamientos de prompts
+                            ('auto' = <model_folder>/cond_cache, None = solo en memoria)
+            attention: Backend de atención ('auto', 'sdpa' o 'chunked')
+            attention_budget_mb: MB máximos de scores de atención a la vez (None = 512)
+            shared_weights: Mapear los pesos en solo lectura, para que varios procesos con los
+                            mismos archivos preparados compartan una sola copia en RAM
         
         Returns:
             bool: True si se cargó correctamente
@@ -83,22 +145,24 @@ class SD3ImageGenerator:
                     callback(error_msg)
                 return False
             
+            set_attention_backend(
+                attention, attention_budget_mb * 2**20 if attention_budget_mb else None
+            )
+            
             # Crear instancia del inferencer
-            self.inferencer = SD3Inferencer()
+            self.inferencer = SD3Inferencer(self.policy)
             
             if callback:
-                callback("Cargando encoders de texto...")
+                callback("Cargando encoders de texto, MMDiT y VAE...")
             
             # Cargar el modelo
-            model_path = os.path.join(self.model_folder, "sd3.5_large.safetensors")
-            vae_path = os.path.join(self.model_folder, "sd3_vae.safetensors")
-            
-            # Si no existe VAE separado, usar el mismo archivo del modelo
-            if not os.path.exists(vae_path):
-                vae_path = None
+            model_path, vae_path = self._model_paths()
             
             # Determinar dispositivo para encoders de texto
-            text_encoder_device = self.device if self.device == "cuda" else "cpu"
+            text_encoder_device = self.device if self.policy.device.type == "cuda" else "cpu"
+            
+            if cond_cache_dir == "auto":
+                cond_cache_dir = os.path.join(self.model_folder, "cond_cache")
             
             self.inferencer.load(
                 model=model_path,
@@ -108,13 +172,21 @@ class SD3ImageGenerator:
                 model_folder=self.model_folder,
                 text_encoder_device=text_encoder_device,
                 verbose=False,
-                load_tokenizers=True
+                load_tokenizers=True,
+                concurrent=concurrent,
+                memory_budget=int(memory_budget_gb * 2**30) if memory_budget_gb else None,
+                callback=callback,
+                cond_cache_dir=cond_cache_dir,
+                shared_weights=shared_weights
             )
             
+            # Recortar de antemano el embedding posicional de cada resolución predefinida
+            self.inferencer.precompute_pos_embeds(load_resolution_presets())
+            
             self.is_loaded = True
             
             if callback:
-                callback(f"✓ Modelo SD3.5 Large cargado en {self.device}")
+                callback(f"✓ Modelo SD3.5 Large cargado en {self.device} ({self.policy.dtype})")
             
             return True
             
@@ -124,7 +196,9 @@ class SD3ImageGenerator:
             return False
     
     def generate_image(self, prompt, negative_prompt="", width=1024, height=1024,
-                      num_inference_steps=40, guidance_scale=4.5, seed=-1):
+                      num_inference_steps=40, guidance_scale=4.5, seed=-1,
+                      conditioning=None, neg_cond=None, adaptive_cfg=None, block_cache=None,
+                      preview_callback=None, token=None):
         """
         Genera una imagen usando el prompt proporcionado
         
@@ -136,62 +210,171 @@ class SD3ImageGenerator:
             num_inference_steps: Pasos de inferencia (40 recomendado para SD3.5 Large)
             guidance_scale: CFG scale (4.5 recomendado para SD3.5 Large)
             seed: Semilla para reproducibilidad (-1 = aleatorio)
+            conditioning: Condicionamiento ya codificado del prompt (None = codificarlo aquí)
+            neg_cond: Condicionamiento ya codificado del prompt vacío (None = codificarlo aquí)
+            adaptive_cfg: Modo de CFG adaptativo (None = default_config["adaptive_cfg"])
+            block_cache: Reutilización de bloques del MMDiT entre pasos (None = default_config["block_cache"])
+            preview_callback: Recibe (paso, total_pasos, [PIL.Image]) con previews aproximadas
+            token: CancellationToken para cancelar o pausar la generación entre pasos
             
         Returns:
             tuple: (PIL.Image, dict) - Imagen generada y metadata
         """
+        images = self.generate_images(
+            [prompt], negative_prompt, width, height, num_inference_steps,
+            guidance_scale, [seed],
+            conditionings=None if conditioning is None else [conditioning],
+            neg_cond=neg_cond,
+            adaptive_cfg=adaptive_cfg,
+            block_cache=block_cache,
+            preview_callback=preview_callback,
+            token=token
+        )
+        return images[0]
+    
+    def generate_images(self, prompts, negative_prompt="", width=1024, height=1024,
+                       num_inference_steps=40, guidance_scale=4.5, seeds=None,
+                       conditionings=None, neg_cond=None, adaptive_cfg=None,
+                       block_cache=None, preview_callback=None, token=None):
+        """
+        Genera varias imágenes en un único sampling batched a través del MMDiT
+        
+        Cada imagen usa su propia semilla, condicionamiento y ruido, y sale igual que
+        si se generase sola con generate_image. Acepta los mismos argumentos que
+        sample_images.
+        
+        Returns:
+            List[tuple]: (PIL.Image, dict) por cada prompt, en el mismo orden
+        """
+        sampled_latent, metadatas = self.sample_images(
+            prompts, negative_prompt, width, height, num_inference_steps,
+            guidance_scale, seeds, conditionings, neg_cond, adaptive_cfg, block_cache,
+            preview_callback, token
+        )
+        images = self.inferencer.vae_decode_images(sampled_latent)
+        return list(zip(images, metadatas))
+    
+    def sample_images(self, prompts, negative_prompt="", width=1024, height=1024,
+                      num_inference_steps=40, guidance_scale=4.5, seeds=None,
+                      conditionings=None, neg_cond=None, adaptive_cfg=None,
+                      block_cache=None, preview_callback=None, token=None):
+        """
+        Hace el sampling batched de generate_images sin decodificar los latents, para
+        poder decodificarlos aparte mientras se samplea el siguiente lote
+        
+        Args:
+            prompts: Lista de prompts, uno por imagen
+            negative_prompt: No usado en SD3.5 (usa prompt vacío internamente)
+            width: Ancho de las imágenes (múltiplo de 64)
+            height: Alto de las imágenes (múltiplo de 64)
+            num_inference_steps: Pasos de inferencia
+            guidance_scale: CFG scale
+            seeds: Lista de semillas, una por imagen (-1 = aleatoria; None = todas aleatorias)
+            conditionings: Condicionamientos ya codificados, uno por prompt (None = codificarlos aquí)
+            neg_cond: Condicionamiento ya codificado del prompt vacío (None = codificarlo aquí)
+            adaptive_cfg: Omite pasadas incondicionales ('truncate', 'alternate', 'converge' o
+                          dict de configuración; None = default_config["adaptive_cfg"])
+            block_cache: Reutiliza los bloques intermedios del MMDiT entre pasos (True o dict
+                         de configuración; None = default_config["block_cache"])
+            preview_callback: Recibe (paso, total_pasos, [PIL.Image]) con una preview aproximada
+                              por imagen cada default_config["preview_every"] pasos
+            token: CancellationToken; cancel() lanza GenerationCancelled en el siguiente paso y
+                   preempt() detiene el sampling hasta resume() sin perder los pasos hechos
+            
+        Returns:
+            tuple: (latents de la salida del sampling, lista de metadata por prompt)
+        """
         if not self.is_loaded:
             raise Exception("El modelo no está cargado. Llama a load_model() primero.")
         
-        # Configurar semilla
-        if seed < 0:
-            seed = torch.randint(0, 100000, (1,)).item()
+        # Configurar semillas
+        seeds = list(seeds) if seeds is not None else [-1] * len(prompts)
+        seeds = [
+            torch.randint(0, 100000, (1,)).item() if seed < 0 else seed
+            for seed in seeds
+        ]
         
-        # Preparar latent vacío
-        latent = self.inferencer.get_empty_latent(1, width, height, seed, "cpu")
-        latent = latent.cuda() if self.device == "cuda" else latent
+        # Preparar latents vacíos (uno por semilla, como en el camino de una sola imagen)
+        latent = torch.cat([
+            self.inferencer.get_empty_latent(1, width, height, seed, "cpu")
+            for seed in seeds
+        ]).to(self.policy.device)
         
         # Obtener condicionamiento
-        conditioning = self.inferencer.get_cond(prompt)
-        neg_cond = self.inferencer.get_cond("")  # SD3.5 usa prompt vacío en lugar de negative
+        if conditionings is None:
+            conditionings = self.inferencer.get_cond_batch(prompts)
+        if neg_cond is None:
+            neg_cond = self.inferencer.get_cond("")  # SD3.5 usa prompt vacío en lugar de negative
         
-        # Sampling
-        sampled_latent = self.inferencer.do_sampling(
-            latent=latent,
-            seed=seed,
-            conditioning=conditioning,
-            neg_cond=neg_cond,
-            steps=num_inference_steps,
-            cfg_scale=guidance_scale,
-            sampler=self.default_config["sampler"],
-            controlnet_cond=None,
-            denoise=1.0,
-            skip_layer_config={}
-        )
+        # Sampling; si se pausa para otro trabajo, continúa desde el último paso completado
+        resume = None
+        while True:
+            try:
+                sampled_latent = self.inferencer.do_sampling(
+                    latent=latent,
+                    seed=seeds,
+                    conditioning=list(conditionings),
+                    neg_cond=neg_cond,
+                    steps=num_inference_steps,
+                    cfg_scale=guidance_scale,
+                    sampler=self.default_config["sampler"],
+                    controlnet_cond=None,
+                    denoise=1.0,
+                    skip_layer_config={},
+                    adaptive_cfg=adaptive_cfg or self.default_config["adaptive_cfg"],
+                    block_cache=block_cache or self.default_config["block_cache"],
+                    preview=self._preview_hook(preview_callback),
+                    preview_every=self.default_config["preview_every"],
+                    token=token,
+                    resume=resume
+                )
+                break
+            except GenerationPreempted as e:
+                resume = e.snapshot
+                token.check()
+        sampling_stats = self.inferencer.last_sampling_stats
         
-        # Decodificar a imagen
-        image = self.inferencer.vae_decode(sampled_latent)
+        metadatas = []
+        for prompt, seed in zip(prompts, seeds):
+            metadata = {
+                "prompt": prompt,
+                "negative_prompt": negative_prompt,  # Guardado para compatibilidad
+                "width": width,
+                "height": height,
+                "steps": num_inference_steps,
+                "guidance_scale": guidance_scale,
+                "seed": seed,
+                "model": "SD3.5 Large",
+                "sampler": self.default_config["sampler"],
+                "device": str(self.policy.device),
+                "precision": str(self.policy.dtype).replace("torch.", ""),
+                "batch_size": len(prompts),
+                "adaptive_cfg": sampling_stats.get("adaptive_cfg"),
+                "block_cache": sampling_stats.get("block_cache"),
+                "attention": sampling_stats.get("attention"),
+                "peak_memory": sampling_stats.get("peak_memory"),
+                "peak_memory_scope": sampling_stats.get("peak_memory_scope"),
+                "timestamp": datetime.now().isoformat()
+            }
+            metadatas.append(metadata)
         
-        # Preparar metadata
-        metadata = {
-            "prompt": prompt,
-            "negative_prompt": negative_prompt,  # Guardado para compatibilidad
-            "width": width,
-            "height": height,
-            "steps": num_inference_steps,
-            "guidance_scale": guidance_scale,
-            "seed": seed,
-            "model": "SD3.5 Large",
-            "sampler": self.default_config["sampler"],
-            "timestamp": datetime.now().isoformat()
-        }
+        return sampled_latent, metadatas
+    
+    def _preview_hook(self, preview_callback):
+        """Adapta un preview_callback de PIL.Image al hook de previews del sampler"""
+        if preview_callback is None:
+            return None
         
-        return image, metadata
+        def hook(step, steps, previews):
+            preview_callback(step, steps, [Image.fromarray(p) for p in previews])
+        
+        return hook
     
     def generate_batch(self, prompts_list, base_params, output_dir, 
-                      name_prefix="sprite", callback=None):
+                      name_prefix="sprite", callback=None, encode_window=8, batch_size=1,
+                      preview_callback=None, token=None):
         """
-        Genera múltiples imágenes en serie
+        Genera múltiples imágenes, agrupando las compatibles en samplings batched
         
         Args:
             prompts_list: Lista de prompts a generar
@@ -199,6 +382,13 @@ class SD3ImageGenerator:
             output_dir: Directorio donde guardar las imágenes
             name_prefix: Prefijo para los nombres de archivo
             callback: Función para reportar progreso (recibe: índice, total, mensaje)
+            encode_window: Cuántos prompts se codifican juntos en un solo forward por encoder
+            batch_size: Máximo de imágenes que pasan juntas por el MMDiT (misma resolución,
+                        pasos, CFG y longitud de contexto)
+            preview_callback: Recibe (paso, total_pasos, [PIL.Image]) durante el sampling de
+                              cada lote
+            token: CancellationToken; al cancelarlo se termina el lote en curso en su siguiente
+                   paso, se guardan los ya sampleados y se devuelven las rutas hasta ese momento
             
         Returns:
             List[str]: Rutas a las imágenes generadas
@@ -207,31 +397,135 @@ class SD3ImageGenerator:
         generated_files = []
         
         total = len(prompts_list)
+        batch_size = max(1, batch_size)
         
+        # Combinar cada prompt con sus parámetros
+        items = []
         for idx, prompt_data in enumerate(prompts_list):
+            if isinstance(prompt_data, dict):
+                full_prompt = prompt_data.get("prompt", "")
+                custom_params = {**base_params, **prompt_data.get("params", {})}
+            else:
+                full_prompt = str(prompt_data)
+                custom_params = base_params
+            items.append((idx, full_prompt, custom_params))
+        
+        # Ventanas múltiplo del tamaño de lote: se codifican juntas y se agrupan por compatibilidad.
+        # El VAE decodifica y guarda cada lote en su propio hilo mientras se samplea el siguiente
+        window_size = batch_size * -(-encode_window // batch_size)
+        with ThreadPoolExecutor(max_workers=1) as decoder:
             try:
-                # Combinar prompt con parámetros
-                if isinstance(prompt_data, dict):
-                    full_prompt = prompt_data.get("prompt", "")
-                    custom_params = {**base_params, **prompt_data.get("params", {})}
-                else:
-                    full_prompt = str(prompt_data)
-                    custom_params = base_params
-                
+                self._run_windows(
+                    items, window_size, batch_size, decoder, output_dir, name_prefix,
+                    callback, preview_callback, token, generated_files
+                )
+            except GenerationCancelled:
                 if callback:
-                    callback(idx + 1, total, f"Generando: {full_prompt[:50]}...")
+                    callback(len(generated_files), total, "⏹ Generación cancelada")
+        
+        return generated_files
+    
+    def _run_windows(self, items, window_size, batch_size, decoder, output_dir, name_prefix,
+                     callback, preview_callback, token, generated_files):
+        """Codifica, samplea y manda a decodificar cada ventana de generate_batch, acumulando
+        las rutas guardadas en generated_files (también si se cancela a mitad)"""
+        total = len(items)
+        pending = None
+        try:
+            for start in range(0, total, window_size):
+                window = items[start:start + window_size]
+                if token is not None:
+                    token.check()
+                try:
+                    # Codificar los prompts de la ventana (y el vacío) en forwards batched
+                    prompts = [""] + [prompt for _, prompt, _ in window]
+                    conds = dict(zip(prompts, self.inferencer.get_cond_batch(prompts)))
+                except Exception as e:
+                    if callback:
+                        for idx, _, _ in window:
+                            callback(idx + 1, total, f"✗ Error: {str(e)}")
+                    continue
                 
-                # Generar imagen
-                image, metadata = self.generate_image(
-                    prompt=full_prompt,
-                    negative_prompt=custom_params.get("negative_prompt", ""),
-                    width=custom_params.get("width", 1024),
-                    height=custom_params.get("height", 1024),
-                    num_inference_steps=custom_params.get("num_inference_steps", 40),
-                    guidance_scale=custom_params.get("guidance_scale", 4.5),
-                    seed=custom_params.get("seed", -1)
-                )
+                groups = {}
+                for item in window:
+                    params = item[2]
+                    key = (
+                        params.get("width", 1024),
+                        params.get("height", 1024),
+                        params.get("num_inference_steps", 40),
+                        params.get("guidance_scale", 4.5),
+                        json.dumps(params.get("adaptive_cfg"), sort_keys=True),
+                        json.dumps(params.get("block_cache"), sort_keys=True),
+                        tuple(conds[item[1]][0].shape),
+                    )
+                    groups.setdefault(key, []).append(item)
                 
+                for group in groups.values():
+                    for b in range(0, len(group), batch_size):
+                        batch = group[b:b + batch_size]
+                        if token is not None:
+                            token.check()
+                        sampled = self._sample_batch(
+                            batch, conds, total, callback, preview_callback, token
+                        )
+                        if pending is not None:
+                            generated_files.extend(pending.result())
+                        pending = None
+                        if sampled is not None:
+                            pending = decoder.submit(
+                                self._decode_and_save, batch, *sampled, output_dir,
+                                name_prefix, total, callback
+                            )
+        finally:
+            # Lo ya sampleado se guarda aunque se cancele el resto
+            if pending is not None:
+                generated_files.extend(pending.result())
+    
+    def _sample_batch(self, batch, conds, total, callback, preview_callback=None, token=None):
+        """Samplea un lote de imágenes compatibles, devuelve (latents, metadatas) o None si falla"""
+        params = batch[0][2]
+        try:
+            if callback:
+                for idx, prompt, _ in batch:
+                    callback(idx + 1, total, f"Generando: {prompt[:50]}...")
+            
+            return self.sample_images(
+                prompts=[prompt for _, prompt, _ in batch],
+                negative_prompt=params.get("negative_prompt", ""),
+                width=params.get("width", 1024),
+                height=params.get("height", 1024),
+                num_inference_steps=params.get("num_inference_steps", 40),
+                guidance_scale=params.get("guidance_scale", 4.5),
+                seeds=[p.get("seed", -1) for _, _, p in batch],
+                conditionings=[conds[prompt] for _, prompt, _ in batch],
+                neg_cond=conds[""],
+                adaptive_cfg=params.get("adaptive_cfg"),
+                block_cache=params.get("block_cache"),
+                preview_callback=preview_callback,
+                token=token
+            )
+        except GenerationCancelled:
+            raise
+        except Exception as e:
+            if callback:
+                for idx, _, _ in batch:
+                    callback(idx + 1, total, f"✗ Error: {str(e)}")
+            return None
+    
+    def _decode_and_save(self, batch, sampled_latent, metadatas, output_dir, name_prefix,
+                         total, callback):
+        """Decodifica un lote ya sampleado y guarda cada imagen con su metadata"""
+        try:
+            images = self.inferencer.vae_decode_images(sampled_latent)
+        except Exception as e:
+            if callback:
+                for idx, _, _ in batch:
+                    callback(idx + 1, total, f"✗ Error: {str(e)}")
+            return []
+        
+        generated_files = []
+        for (idx, _, _), image, metadata in zip(batch, images, metadatas):
+            try:
                 # Guardar imagen
                 filename = f"{name_prefix}_{idx+1:03d}.png"
                 filepath = os.path.join(output_dir, filename)
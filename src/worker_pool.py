@@ -0,0 +1,482 @@
+"""
+Pool de procesos de generación para aprovechar todos los núcleos y nodos NUMA
+Cada proceso tiene su propio SD3ImageGenerator, pero todos mapean en solo lectura los
+mismos checkpoints preparados, así que N procesos no cuestan N veces la RAM del modelo
+"""
+import glob
+import json
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+
+
+def available_cores():
+    """Núcleos en los que puede ejecutarse este proceso"""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def parse_cpulist(text):
+    """Convierte una lista de CPUs de Linux ('0-3,8,10-11') en una lista de enteros"""
+    cores = []
+    for part in text.strip().split(","):
+        if not part:
+            continue
+        start, _, end = part.partition("-")
+        cores.extend(range(int(start), int(end or start) + 1))
+    return cores
+
+
+def numa_nodes(cores=None):
+    """
+    Agrupa los núcleos disponibles por nodo NUMA
+    
+    Args:
+        cores: Núcleos a agrupar (None = available_cores())
+    
+    Returns:
+        List[list]: Núcleos de cada nodo; un solo grupo si no hay información NUMA
+    """
+    cores = available_cores() if cores is None else cores
+    allowed = set(cores)
+    nodes = []
+    for path in sorted(glob.glob("/sys/devices/system/node/node[0-9]*/cpulist")):
+        try:
+            with open(path) as f:
+                node = [core for core in parse_cpulist(f.read()) if core in allowed]
+        except (OSError, ValueError):
+            continue
+        if node:
+            nodes.append(node)
+    return nodes or [list(cores)]
+
+
+def plan_workers(workers=None, threads_per_worker=None, cores=None):
+    """
+    Reparte los núcleos entre los workers sin que ninguno cruce un nodo NUMA
+    
+    Args:
+        workers: Número de procesos (None = uno por nodo NUMA)
+        threads_per_worker: Hilos de torch por proceso (None = los núcleos de su nodo
+                            repartidos entre los workers del nodo)
+        cores: Núcleos utilizables (None = available_cores())
+    
+    Returns:
+        List[list]: Núcleos asignados a cada worker; su longitud es su número de hilos
+    """
+    nodes = numa_nodes(cores)
+    workers = workers or len(nodes)
+    # Los workers se reparten entre nodos por turnos, y cada nodo entre sus workers
+    per_node = [workers // len(nodes) + (i < workers % len(nodes)) for i in range(len(nodes))]
+    plan = []
+    for node, count in zip(nodes, per_node):
+        if count == 0:
+            continue
+        threads = threads_per_worker or max(1, len(node) // count)
+        for i in range(count):
+            start = (i * threads) % len(node)
+            plan.append([node[(start + j) % len(node)] for j in range(min(threads, len(node)))])
+    return plan
+
+
+class JobCancelled(Exception):
+    """La imagen se canceló mientras un worker la generaba"""
+
+
+class JobCancelFlag:
+    """
+    Sustituye al Event `cancelled` de un CancellationToken dentro de un worker: el
+    trabajo está cancelado cuando el pool ha enviado su id por la cola de cancelaciones
+    """
+    
+    def __init__(self, job_id, cancels, cancelled_ids):
+        self.job_id = job_id
+        self.cancels = cancels
+        self.cancelled_ids = cancelled_ids
+    
+    def is_set(self):
+        try:
+            while True:
+                self.cancelled_ids.add(self.cancels.get_nowait())
+        except queue.Empty:
+            pass
+        return self.job_id in self.cancelled_ids
+    
+    def set(self):
+        self.cancelled_ids.add(self.job_id)
+
+
+def load_generator(generator_kwargs, load_kwargs):
+    """Crea y carga el generador de un worker, con los pesos compartidos en solo lectura"""
+    from src.sd3_generator import SD3ImageGenerator
+    
+    generator = SD3ImageGenerator(**generator_kwargs)
+    if not generator.load_model(callback=None, shared_weights=True, **load_kwargs):
+        raise RuntimeError(f"No se pudo cargar el modelo de {generator.model_folder}")
+    return generator
+
+
+def _worker_main(index, cores, loader, generator_kwargs, load_kwargs, jobs, cancels, results):
+    """Bucle de un proceso worker: fija sus núcleos y hilos, carga el modelo y genera"""
+    if cores and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    import torch
+    
+    torch.set_num_threads(max(1, len(cores)))
+    try:
+        generator = loader(generator_kwargs, load_kwargs)
+    except Exception as e:
+        results.put(("failed", index, None, str(e)))
+        return
+    from src.sd3_generator import CancellationToken, GenerationCancelled
+    
+    results.put(("ready", index, None, None))
+    cancelled_ids = set()
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        job_id, prompt, params = job
+        # Cada worker recibe sus trabajos en orden, las cancelaciones anteriores ya no sirven
+        cancelled_ids.difference_update([i for i in cancelled_ids if i < job_id])
+        token = CancellationToken()
+        token.cancelled = JobCancelFlag(job_id, cancels, cancelled_ids)
+        try:
+            if token.cancelled.is_set():
+                raise GenerationCancelled()
+            image, metadata = generator.generate_image(
+                prompt,
+                negative_prompt=params.get("negative_prompt", ""),
+                width=params.get("width", 1024),
+                height=params.get("height", 1024),
+                num_inference_steps=params.get("num_inference_steps", 40),
+                guidance_scale=params.get("guidance_scale", 4.5),
+                seed=params.get("seed", -1),
+                adaptive_cfg=params.get("adaptive_cfg"),
+                block_cache=params.get("block_cache"),
+                token=token
+            )
+            metadata["worker"] = index
+            results.put(("done", index, job_id, (image, metadata)))
+        except GenerationCancelled:
+            results.put(("cancelled", index, job_id, None))
+        except Exception as e:
+            results.put(("error", index, job_id, str(e)))
+
+
+class PoolJob:
+    """Una imagen pendiente en el pool"""
+    
+    def __init__(self, job_id, prompt, params):
+        self.job_id = job_id
+        self.prompt = prompt
+        self.params = params
+        self.future = Future()
+        self.worker = None
+        self.started = None
+        # Coste relativo: píxeles por paso, lo que escala el trabajo del MMDiT
+        self.cost = (params.get("width", 1024) * params.get("height", 1024)
+                     * params.get("num_inference_steps", 40))
+
+
+class PoolWorker:
+    """Estado de un proceso worker visto desde el scheduler del pool"""
+    
+    def __init__(self, index, cores, process, jobs, cancels):
+        self.index = index
+        self.cores = cores
+        self.process = process
+        self.jobs = jobs
+        self.cancels = cancels
+        self.ready = False
+        self.running = {}
+        self.completed = 0
+        # Coste procesado por segundo; hasta medirlo se estima por el número de hilos
+        self.throughput = None
+    
+    @property
+    def speed(self):
+        return self.throughput or len(self.cores)
+    
+    @property
+    def outstanding(self):
+        return sum(job.cost for job in self.running.values())
+
+
+class WorkerPool:
+    """
+    Pool de procesos de generación con un scheduler que reparte cada imagen al worker
+    que antes la terminaría, según su trabajo pendiente y su velocidad (sus hilos hasta
+    que hay medidas reales)
+    """
+    
+    def __init__(self, model_folder="models", workers=None, threads_per_worker=None,
+                 precision=None, prefetch=1, loader=load_generator, **load_kwargs):
+        """
+        Args:
+            model_folder: Carpeta donde están los archivos del modelo
+            workers: Número de procesos (None = uno por nodo NUMA)
+            threads_per_worker: Hilos de torch por proceso (None = repartir los núcleos)
+            precision: 'bf16', 'fp32' o None (según el hardware)
+            prefetch: Imágenes en cola por worker además de la que está generando
+            loader: Función (generator_kwargs, load_kwargs) -> generador cargado, ejecutada
+                    en cada worker; debe poder importarse desde el proceso hijo
+            **load_kwargs: Argumentos extra para SD3ImageGenerator.load_model
+        """
+        self.generator_kwargs = {"model_folder": model_folder, "device": "cpu",
+                                 "precision": precision}
+        self.load_kwargs = load_kwargs
+        self.plan = plan_workers(workers, threads_per_worker)
+        self.prefetch = max(0, prefetch)
+        self.loader = loader
+        self.workers = []
+        self.backlog = []
+        self.next_id = 0
+        self.lock = threading.Lock()
+        self.context = multiprocessing.get_context("spawn")
+        self.results = None
+        self.collector = None
+        self.closed = threading.Event()
+    
+    def start(self, callback=None, prepare=True, timeout=None):
+        """
+        Prepara los pesos una sola vez y arranca los workers
+        
+        Args:
+            callback: Función para reportar progreso
+            prepare: Generar los checkpoints preparados que comparten los workers
+            timeout: Segundos máximos esperando a que carguen (None = sin límite)
+        
+        Returns:
+            int: Número de workers listos
+        """
+        if prepare:
+            if callback:
+                callback("Preparando checkpoints compartidos...")
+            from src.sd3_generator import SD3ImageGenerator
+            SD3ImageGenerator(**self.generator_kwargs).prepare_weights()
+        
+        self.results = self.context.Queue()
+        for index, cores in enumerate(self.plan):
+            jobs = self.context.Queue()
+            cancels = self.context.Queue()
+            process = self.context.Process(
+                target=_worker_main,
+                args=(index, cores, self.loader, self.generator_kwargs, self.load_kwargs,
+                      jobs, cancels, self.results),
+                daemon=True
+            )
+            process.start()
+            self.workers.append(PoolWorker(index, cores, process, jobs, cancels))
+            if callback:
+                callback(f"Worker {index}: {len(cores)} hilos en núcleos {cores}")
+        
+        # Esperar a que cada worker cargue, falle o muera antes de avisar
+        pending = set(range(len(self.workers)))
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while pending and (deadline is None or time.monotonic() < deadline):
+            try:
+                kind, index, _, message = self.results.get(timeout=0.5)
+            except queue.Empty:
+                for index in [i for i in pending if not self.workers[i].process.is_alive()]:
+                    pending.discard(index)
+                    if callback:
+                        callback(f"✗ Worker {index} terminó al cargar el modelo")
+                continue
+            pending.discard(index)
+            if kind == "ready":
+                self.workers[index].ready = True
+            if callback:
+                callback(f"✓ Worker {index} listo" if kind == "ready"
+                         else f"✗ Worker {index}: {message}")
+        
+        self.collector = threading.Thread(target=self._collect, daemon=True)
+        self.collector.start()
+        return sum(worker.ready for worker in self.workers)
+    
+    def submit(self, prompt, params=None):
+        """
+        Encola una imagen
+        
+        Returns:
+            Future: Se resuelve con (PIL.Image, dict) - imagen y metadata
+        """
+        with self.lock:
+            job = PoolJob(self.next_id, prompt, dict(params or {}))
+            self.next_id += 1
+            self.backlog.append(job)
+            self._dispatch()
+        return job.future
+    
+    def cancel(self, future):
+        """
+        Cancela una imagen: si aún no ha empezado se descarta, y si un worker la está
+        generando se le avisa para que pare en el siguiente paso (su Future falla con
+        JobCancelled)
+        """
+        if future.cancel():
+            return
+        with self.lock:
+            for worker in self.workers:
+                for job in worker.running.values():
+                    if job.future is future:
+                        worker.cancels.put(job.job_id)
+                        return
+    
+    def _dispatch(self):
+        """Asigna trabajos del backlog mientras haya workers con hueco (con el lock tomado)"""
+        while self.backlog:
+            free = [w for w in self.workers
+                    if w.ready and len(w.running) <= self.prefetch]
+            if not free:
+                return
+            job = self.backlog.pop(0)
+            if not job.future.set_running_or_notify_cancel():
+                continue
+            # Worker con el final estimado más temprano para este trabajo
+            worker = min(free, key=lambda w: (w.outstanding + job.cost) / w.speed)
+            job.worker = worker.index
+            job.started = time.monotonic()
+            worker.running[job.job_id] = job
+            worker.jobs.put((job.job_id, job.prompt, job.params))
+    
+    def _collect(self):
+        """Hilo que recoge los resultados de los workers y reparte más trabajo"""
+        while not self.closed.is_set():
+            try:
+                kind, index, job_id, payload = self.results.get(timeout=0.5)
+            except queue.Empty:
+                self._check_workers()
+                continue
+            except (EOFError, OSError):
+                return
+            
+            with self.lock:
+                worker = self.workers[index]
+                job = worker.running.pop(job_id, None)
+                if job is not None and kind == "done":
+                    worker.completed += 1
+                    # Media móvil del coste por segundo medido en este worker
+                    measured = job.cost / max(1e-6, time.monotonic() - job.started)
+                    worker.throughput = (measured if worker.throughput is None
+                                         else 0.7 * worker.throughput + 0.3 * measured)
+                self._dispatch()
+            
+            if job is None:
+                continue
+            if kind == "done":
+                job.future.set_result(payload)
+            elif kind == "cancelled":
+                job.future.set_exception(JobCancelled())
+            else:
+                job.future.set_exception(RuntimeError(payload))
+    
+    def _check_workers(self):
+        """Falla los trabajos de los workers que hayan muerto y los saca del reparto"""
+        with self.lock:
+            for worker in self.workers:
+                if worker.ready and not worker.process.is_alive():
+                    worker.ready = False
+                    for job in worker.running.values():
+                        job.future.set_exception(
+                            RuntimeError(f"El worker {worker.index} terminó inesperadamente")
+                        )
+                    worker.running.clear()
+            if not any(worker.ready for worker in self.workers):
+                for job in self.backlog:
+                    if job.future.set_running_or_notify_cancel():
+                        job.future.set_exception(RuntimeError("No quedan workers activos"))
+                self.backlog.clear()
+            self._dispatch()
+    
+    def stats(self):
+        """Imágenes completadas, trabajo pendiente y velocidad medida de cada worker"""
+        with self.lock:
+            return [{"worker": w.index, "cores": w.cores, "ready": w.ready,
+                     "running": len(w.running), "completed": w.completed,
+                     "throughput": w.throughput} for w in self.workers]
+    
+    def generate_batch(self, prompts_list, base_params, output_dir,
+                      name_prefix="sprite", callback=None, encode_window=8, batch_size=1,
+                      preview_callback=None, token=None):
+        """
+        Genera múltiples imágenes repartidas entre los workers, con la misma interfaz
+        que SD3ImageGenerator.generate_batch (encode_window, batch_size y las previews
+        los gestiona cada worker)
+        
+        Returns:
+            List[str]: Rutas a las imágenes generadas
+        """
+        os.makedirs(output_dir, exist_ok=True)
+        total = len(prompts_list)
+        
+        futures = []
+        for idx, prompt_data in enumerate(prompts_list):
+            if isinstance(prompt_data, dict):
+                prompt = prompt_data.get("prompt", "")
+                params = {**base_params, **prompt_data.get("params", {})}
+            else:
+                prompt = str(prompt_data)
+                params = base_params
+            futures.append((idx, self.submit(prompt, params)))
+            if callback:
+                callback(idx + 1, total, f"En cola: {prompt[:50]}...")
+        
+        generated_files = []
+        pending = {future: idx for idx, future in futures}
+        cancelled = False
+        while pending:
+            # Al cancelar se descarta lo pendiente y los workers paran lo que está en marcha
+            if not cancelled and token is not None and token.cancelled.is_set():
+                cancelled = True
+                for future in pending:
+                    self.cancel(future)
+            done, _ = wait(pending, timeout=0.5, return_when=FIRST_COMPLETED)
+            for future in sorted(done, key=pending.get):
+                idx = pending.pop(future)
+                try:
+                    image, metadata = future.result()
+                except JobCancelled:
+                    continue
+                except Exception as e:
+                    if callback and not future.cancelled():
+                        callback(idx + 1, total, f"✗ Error: {str(e)}")
+                    continue
+                
+                filename = f"{name_prefix}_{idx+1:03d}.png"
+                filepath = os.path.join(output_dir, filename)
+                image.save(filepath)
+                metadata_path = os.path.join(output_dir, f"{name_prefix}_{idx+1:03d}_metadata.json")
+                with open(metadata_path, 'w', encoding='utf-8') as f:
+                    json.dump(metadata, f, indent=2, ensure_ascii=False)
+                generated_files.append((idx, filepath))
+                if callback:
+                    callback(idx + 1, total, f"✓ Guardado: {filename} (worker {metadata['worker']})")
+        generated_files = [path for _, path in sorted(generated_files)]
+        
+        if token is not None and token.cancelled.is_set() and callback:
+            callback(len(generated_files), total, "⏹ Generación cancelada")
+        return generated_files
+    
+    def close(self):
+        """Termina los workers cuando acaban la imagen en curso"""
+        self.closed.set()
+        for worker in self.workers:
+            if worker.process.is_alive():
+                worker.jobs.put(None)
+        for worker in self.workers:
+            worker.process.join(timeout=30)
+            if worker.process.is_alive():
+                worker.process.terminate()
+        if self.collector is not None:
+            self.collector.join(timeout=5)
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,75 @@
+"""
+ModulationSchedule: los pasos precalculados, los que superan el presupuesto de bytes y
+los presupuestos menores que un paso deben dar lo mismo que evaluar la modulación en vivo
+
+Ejecutar con:
+    python -m unittest discover tests
+"""
+import os
+import sys
+import unittest
+
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "ia", "sd3.5-main"))
+
+from mmditx import MMDiTX, ModulationSchedule  # noqa: E402
+
+
+def tiny_mmdit(depth=2):
+    """MMDiTX diminuto con pesos aleatorios"""
+    torch.manual_seed(0)
+    model = MMDiTX(
+        input_size=None, pos_embed_max_size=8, patch_size=2, in_channels=16, depth=depth,
+        num_patches=64, adm_in_channels=16, qk_norm="rms", x_block_self_attn_layers=[0],
+        context_embedder_config={
+            "target": "torch.nn.Linear",
+            "params": {"in_features": 32, "out_features": 64 * depth},
+        },
+        dtype=torch.float32, device="cpu",
+    ).eval()
+    with torch.no_grad():
+        for param in model.parameters():
+            param.copy_(torch.randn_like(param) * 0.05)
+    return model
+
+
+class TestModulationSchedule(unittest.TestCase):
+    
+    def setUp(self):
+        self.model = tiny_mmdit()
+        self.timesteps = torch.tensor([999.0, 750.0, 500.0, 250.0])
+        generator = torch.Generator().manual_seed(1)
+        self.x = torch.randn(2, 16, 8, 8, generator=generator)
+        self.y = torch.randn(2, 16, generator=generator)
+        self.context = torch.randn(2, 10, 32, generator=generator)
+    
+    def run_steps(self, schedule):
+        self.model.set_modulation_schedule(schedule)
+        try:
+            with torch.no_grad():
+                return [
+                    self.model(self.x, t.expand(2), self.y, self.context)
+                    for t in self.timesteps
+                ]
+        finally:
+            self.model.set_modulation_schedule(None)
+    
+    def schedule(self, max_bytes):
+        return ModulationSchedule(self.model, self.timesteps, [self.y], torch.float32, max_bytes)
+    
+    def test_budgets_match_live(self):
+        live = self.run_steps(None)
+        per_step = ModulationSchedule.bytes_per_step(self.model, [self.y], torch.float32)
+        for max_bytes, steps in ((None, 4), (2 * per_step, 2), (per_step - 1, 0), (10, 0), (0, 0)):
+            with self.subTest(max_bytes=max_bytes):
+                schedule = self.schedule(max_bytes)
+                self.assertEqual(schedule.steps, steps)
+                self.assertEqual(schedule.bytes, steps * per_step)
+                for expected, out in zip(live, self.run_steps(schedule)):
+                    torch.testing.assert_close(out, expected, rtol=1e-5, atol=1e-6)
+                self.assertEqual(schedule.stats()["hits"], len(self.timesteps))
+
+
+if __name__ == "__main__":
+    unittest.main()
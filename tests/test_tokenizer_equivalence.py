@@ -0,0 +1,142 @@
+"""
+Equivalencia del tokenizado por lotes con caché de palabras (SDTokenizer.tokenize_words)
+con el bucle original, que llamaba al tokenizer de HF una vez por palabra
+
+Ejecutar con:
+    python -m unittest discover tests
+"""
+import os
+import random
+import sys
+import unittest
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "ia", "sd3.5-main"))
+
+from other_impls import SDTokenizer  # noqa: E402
+
+
+class WordPieceTokenizer:
+    """
+    Sustituto determinista del tokenizer de HF: parte cada palabra en piezas de 3
+    caracteres, con tokens de inicio y fin como CLIP o solo de fin como T5
+    """
+    
+    def __init__(self, start=49406, end=49407, vocab_size=49000, has_start=True):
+        self.start = start
+        self.end = end
+        self.vocab_size = vocab_size
+        self.has_start = has_start
+        self.calls = 0
+    
+    def encode(self, text):
+        ids = [
+            zlib.crc32(word[i:i + 3].encode("utf-8")) % self.vocab_size + 2
+            for word in text.split()
+            for i in range(0, len(word), 3)
+        ]
+        return ([self.start] if self.has_start else []) + ids + [self.end]
+    
+    def __call__(self, text):
+        self.calls += 1
+        if isinstance(text, list):
+            return {"input_ids": [self.encode(t) for t in text]}
+        return {"input_ids": self.encode(text)}
+    
+    def get_vocab(self):
+        return {str(i): i for i in range(10)}
+
+
+class PerWordTokenizer(SDTokenizer):
+    """SDTokenizer con el bucle original: una llamada al tokenizer por palabra y sin caché"""
+    
+    def tokenize_words(self, words):
+        return [self.tokenizer(word)["input_ids"][self.tokens_start:-1] for word in words]
+
+
+# Mismos argumentos que SDTokenizer (CLIP-L), SDXLClipGTokenizer y T5XXLTokenizer
+CONFIGS = {
+    "clip_l": ({}, {}),
+    "clip_g": ({}, {"pad_with_end": False}),
+    "t5xxl": (
+        {"end": 1, "vocab_size": 32000, "has_start": False},
+        {"pad_with_end": False, "has_start_token": False, "pad_to_max_length": False,
+         "max_length": 99999999, "min_length": 77},
+    ),
+}
+
+PROMPTS = [
+    "",
+    "   ",
+    "pixel art knight",
+    "pixel art\nknight,  16x16 sprite",
+    "(glowing sword:1.3), dark (cave)",
+    "((very important)), [less important]",
+    "escaped \\(parentheses\\) and \\(weighted:1.2\\)",
+    "(unclosed weight:1.4",
+    "supercalifragilisticexpialidocious " + "a" * 80,
+    "word " * 200,
+    " ".join(["knight", "slime", "(glowing:1.3)"] * 40),
+]
+
+
+def random_prompts(count, seed=0):
+    """Prompts aleatorios con pesos, escapes, saltos de línea y palabras muy largas"""
+    rng = random.Random(seed)
+    vocab = ["knight", "slime", "(glowing:1.3)", "\\(x\\)", "pixel", "art,", "16x16", "\n",
+             "forest", "(dark", "cave)", "", "(red:0.8)", "a" * 40]
+    return [" ".join(rng.choice(vocab) for _ in range(rng.randint(1, 120))) for _ in range(count)]
+
+
+def make(cls, name, **kwargs):
+    hf_kwargs, tokenizer_kwargs = CONFIGS[name]
+    return cls(tokenizer=WordPieceTokenizer(**hf_kwargs), **tokenizer_kwargs, **kwargs)
+
+
+class TestTokenizerEquivalence(unittest.TestCase):
+    
+    def assert_equivalent(self, name, prompts, **kwargs):
+        batched = make(SDTokenizer, name, **kwargs)
+        per_word = make(PerWordTokenizer, name)
+        for prompt in prompts:
+            for return_word_ids in (False, True):
+                with self.subTest(config=name, prompt=prompt[:40], word_ids=return_word_ids):
+                    self.assertEqual(
+                        batched.tokenize_with_weights(prompt, return_word_ids),
+                        per_word.tokenize_with_weights(prompt, return_word_ids),
+                    )
+        return batched
+    
+    def test_fixed_prompts(self):
+        for name in CONFIGS:
+            self.assert_equivalent(name, PROMPTS)
+    
+    def test_random_prompts(self):
+        for name in CONFIGS:
+            self.assert_equivalent(name, random_prompts(100))
+    
+    def test_cache_hits(self):
+        for name in CONFIGS:
+            tokenizer = self.assert_equivalent(name, PROMPTS)
+            calls = tokenizer.tokenizer.calls
+            # Segunda pasada: todas las palabras están en caché y no se llama al tokenizer
+            for prompt in PROMPTS:
+                self.assertEqual(
+                    tokenizer.tokenize_with_weights(prompt),
+                    make(PerWordTokenizer, name).tokenize_with_weights(prompt),
+                )
+            self.assertEqual(tokenizer.tokenizer.calls, calls)
+    
+    def test_one_tokenizer_call_per_prompt(self):
+        tokenizer = make(SDTokenizer, "clip_l")
+        calls = tokenizer.tokenizer.calls
+        tokenizer.tokenize_with_weights("a (b:1.2) c \\(d\\) e")
+        self.assertEqual(tokenizer.tokenizer.calls, calls + 1)
+    
+    def test_bounded_cache(self):
+        tokenizer = self.assert_equivalent("clip_l", random_prompts(30, seed=1), word_cache_size=5)
+        self.assertLessEqual(len(tokenizer.word_cache), 5)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+"""
+Decodificar un batch de latents en el VAE debe dar lo mismo que decodificar cada imagen
+por separado, tanto por debajo como por encima del umbral de tiling
+
+Ejecutar con:
+    python -m unittest discover tests
+"""
+import os
+import sys
+import types
+import unittest
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "ia", "sd3.5-main"))
+
+from sd3_impls import SDVAE, ExecutionPolicy  # noqa: E402
+from sd3_infer import SD3Inferencer  # noqa: E402
+
+
+class TestVAEBatchDecode(unittest.TestCase):
+    
+    @classmethod
+    def setUpClass(cls):
+        torch.manual_seed(0)
+        cls.inferencer = SD3Inferencer(ExecutionPolicy("cpu", torch.float32, channels_last=False))
+        cls.inferencer.vae = types.SimpleNamespace(model=SDVAE(device="cpu").eval())
+        # Umbral de 32x32 píxeles: un latent de 4x4 justo en el umbral se decodifica entero y uno
+        # de 4x6 en tiles
+        cls.inferencer.vae_tiling.update({"threshold": 32 * 32, "tile": 4, "overlap": 2, "workers": 1})
+    
+    def assert_batch_matches_single(self, height, width, tiled):
+        latent = torch.randn(5, 16, height, width, generator=torch.Generator().manual_seed(1))
+        self.assertEqual(self.inferencer.use_vae_tiling(latent, 8), tiled)
+        with torch.no_grad():
+            batch = self.inferencer.vae_decode_batch(latent)
+            single = np.concatenate(
+                [self.inferencer.vae_decode_batch(latent[i:i + 1]) for i in range(len(latent))]
+            )
+        self.assertEqual(batch.shape, (5, height * 8, width * 8, 3))
+        # Las convoluciones con otro tamaño de batch redondean distinto como mucho un nivel;
+        # cambiar de decodificación entera a tiles cambia decenas
+        difference = np.abs(batch.astype(int) - single.astype(int)).max()
+        self.assertLessEqual(difference, 1)
+    
+    def test_below_threshold(self):
+        # El batch entero (5 x 32x32) supera el umbral, pero cada imagen no: sin tiles
+        self.assert_batch_matches_single(4, 4, tiled=False)
+    
+    def test_sub_batched(self):
+        # 5 imágenes de 16x16 se decodifican enteras en sub-batches de 4
+        self.assert_batch_matches_single(2, 2, tiled=False)
+    
+    def test_above_threshold(self):
+        self.assert_batch_matches_single(4, 6, tiled=True)
+    
+    def test_sub_batches_bound_pixels(self):
+        latent = torch.zeros(5, 16, 2, 2)
+        self.assertEqual(self.inferencer.vae_sub_batch(latent, 8), 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -140,6 +140,29 @@ def check_model_files():
     
     return all_present
 
+def check_model_architecture():
+    """Inspecciona la arquitectura del modelo SD3.5 leyendo solo la cabecera del safetensors"""
+    model_file = Path("ia/sd3.5-main/models/sd3.5_large.safetensors")
+    if not model_file.exists():
+        print_status("Arquitectura del modelo", "warning", "Modelo no encontrado, se omite")
+        return True
+
+    sys.path.insert(0, str(Path("ia/sd3.5-main").absolute()))
+    try:
+        from sd3_impls import mmdit_config
+        from sd3_weights import SafetensorsFile
+
+        with SafetensorsFile(str(model_file)) as f:
+            config = mmdit_config(f, "model.diffusion_model.")
+        print_status("Arquitectura del modelo", "ok",
+                    f"depth={config['depth']}, patch_size={config['patch_size']}, "
+                    f"pos_embed_max_size={config['pos_embed_max_size']}, qk_norm={config['qk_norm']}, "
+                    f"x_block_self_attn_layers={config['x_block_self_attn_layers']}")
+        return True
+    except Exception as e:
+        print_status("Arquitectura del modelo", "error", f"No se pudo leer la cabecera: {e}")
+        return False
+
 def check_project_structure():
     """Verifica la estructura del proyecto"""
     required_paths = [
@@ -188,6 +211,10 @@ def main():
     print("📌 Verificando archivos del modelo SD3.5...")
     results['models'] = check_model_files()
     print()
+
+    print("📌 Verificando arquitectura del modelo...")
+    results['architecture'] = check_model_architecture()
+    print()
     
     print("📌 Verificando estructura del proyecto...")
     results['structure'] = check_project_structure()
@@ -211,7 +238,7 @@ def main():
             print("  2. Instala PyTorch con CUDA: pip install torch torchvision --index-url https://download.pytorch.org/whl/cu118")
         if not results['deps']:
             print("  3. Instala dependencias: pip install -r requirements.txt")
-        if not results['models']:
+        if not results['models'] or not results['architecture']:
             print("  4. Descarga los archivos del modelo SD3.5 Large")
             print("     https://huggingface.co/stabilityai/stable-diffusion-3.5-large")
         if not results['structure']: